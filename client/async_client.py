@@ -0,0 +1,772 @@
+import os
+import shutil
+import hashlib
+import asyncio
+import logging
+import threading
+import urllib.parse
+import concurrent.futures
+from tqdm import tqdm
+
+import httpx
+
+try:
+    from .client import (
+        UpdateClient, UpdateTrace, SequentialHasher,
+        APP_NAME, DOWNLOAD_URL, DOWNLOAD_CONFIG, DELTA_DECODERS, BLOCK_RETRIES, READ_CHUNK_SIZE, JOURNAL_INTERVAL
+    )
+except ImportError:
+    # 在 client 目录中直接运行时
+    from client import (
+        UpdateClient, UpdateTrace, SequentialHasher,
+        APP_NAME, DOWNLOAD_URL, DOWNLOAD_CONFIG, DELTA_DECODERS, BLOCK_RETRIES, READ_CHUNK_SIZE, JOURNAL_INTERVAL
+    )
+
+
+async def gather_all(coros):
+    """并发运行多个协程并按顺序返回结果；任何一个失败或整体被取消时取消其余的，等它们结束后再向上传递"""
+    tasks = [asyncio.ensure_future(coro) for coro in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+class AsyncUpdateClient(UpdateClient):
+    """asyncio 版的客户端核心：检查更新（check）、规划路径（plan）、下载（download）、校验（verify）和应用（apply）
+
+    网络请求使用 httpx.AsyncClient（长连接复用，每个请求有连接和读取超时），大文件按字节区间并发下载。
+    差异文件合成、备份、替换等本地操作与 UpdateClient 共用实现，在线程中执行以免阻塞事件循环。
+    所有操作都是可取消的协程：下载中取消时保留临时文件和分段下载日志，下次从中断处续传；
+    本地安装步骤开始后推迟取消到安装完成，当前版本不会处于替换了一半的状态。
+    可在 Qt 集成的事件循环中直接 await，也可用 asyncio.run 无界面运行；同步代码使用 BlockingUpdateClient。
+    """
+
+    def __init__(self):
+        super().__init__()
+        # 单个请求的超时（秒）：建立连接、两次读取之间的最长间隔
+        self.request_timeout = DOWNLOAD_CONFIG.get('timeout_seconds', 30)
+        self.http = None
+        self.http_loop = None
+        # 更新或回滚进行中（只在事件循环中访问），两者都会改动暂存目录和当前版本目录，不能同时进行
+        self.busy = False
+
+    def http_client(self):
+        """当前事件循环使用的 HTTP 客户端（首次使用或切换事件循环时创建）"""
+        loop = asyncio.get_running_loop()
+        if self.http is None or self.http_loop is not loop:
+            self.http = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.request_timeout, connect=10),
+                limits=httpx.Limits(max_connections=max(self.download_segments, 1) * 2),
+                # 下载默认不接受压缩编码，需要预压缩版本时按请求单独指定
+                headers={'Accept-Encoding': 'identity'}
+            )
+            self.http_loop = loop
+        return self.http
+
+    async def aclose(self):
+        """关闭 HTTP 连接"""
+        if self.http is not None:
+            await self.http.aclose()
+            self.http = None
+
+    async def check(self):
+        """检查是否有更新可用，返回版本信息或 None"""
+        try:
+            self.print_log(f"正在检查更新，连接地址: {self.server_url}")
+            # 每次检查更新开始一次新的更新尝试追踪
+            self.trace = UpdateTrace(self.current_version, self.server_url)
+            with self.phase('check', "检查更新") as phase:
+                # 附带当前版本和上次的 ETag，未变化时服务器返回 304
+                headers = {'Accept-Encoding': 'gzip'}
+                if self.check_update_etag and self.check_update_cache is not None:
+                    headers['If-None-Match'] = self.check_update_etag
+                response = await self.http_client().get(
+                    f"{self.server_url}/check_update",
+                    params={'current_version': self.current_version},
+                    headers=headers,
+                    timeout=10
+                )
+                phase.details['status'] = response.status_code
+                phase.advance(len(response.content))
+                if response.status_code == 304:
+                    version_info = self.check_update_cache
+                else:
+                    response.raise_for_status()
+                    version_info = response.json()
+                    self.check_update_etag = response.headers.get('ETag')
+                    self.check_update_cache = version_info
+            return self.evaluate_version_info(version_info)
+        except Exception as e:
+            self.print_log(f"检查更新失败: {str(e)}")
+            return None
+
+    async def plan(self, target_version):
+        """向服务器请求从当前版本到目标版本的更新路径规划，失败时返回 None"""
+        try:
+            with self.phase('plan', "规划更新路径") as phase:
+                response = await self.http_client().get(
+                    f"{self.server_url}/update_plan", params=self.plan_params(target_version), timeout=10
+                )
+                if response.status_code != 200:
+                    logging.warning(f"获取更新路径失败: HTTP {response.status_code}")
+                    phase.fail(f"HTTP {response.status_code}")
+                    return None
+                plan = response.json()
+                phase.details.update(method=plan['method'], steps=len(plan['steps']), total_size=plan['total_size'])
+                return plan
+        except Exception as e:
+            logging.warning(f"获取更新路径失败: {str(e)}")
+            return None
+
+    async def wait_for_patch(self, target_version):
+        """等待服务器按需生成差异文件，生成完成后重新请求更新路径；超时或生成失败时返回 None"""
+        with self.phase('plan_wait', "等待服务器生成差异文件") as phase:
+            url = f"{await self.resolve_download_url()}/download_patch/{self.current_version}/{target_version}"
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + self.patch_wait_seconds
+            self.print_log("服务器正在生成从当前版本出发的差异文件，等待生成完成...")
+            while loop.time() < deadline:
+                try:
+                    response = await self.http_client().head(url, follow_redirects=True, timeout=10)
+                except Exception as e:
+                    logging.warning(f"查询差异文件生成状态失败: {str(e)}")
+                    phase.fail(str(e))
+                    return None
+                if response.status_code == 200:
+                    plan = await self.plan(target_version)
+                    if plan is None or plan['method'] == 'patch' or not plan.get('on_demand'):
+                        return plan
+                    # 差异文件已生成但服务器的版本配置快照尚未更新
+                    retry_after = 1
+                elif response.status_code == 202:
+                    retry_after = float(response.headers.get('Retry-After', 5))
+                else:
+                    logging.warning(f"差异文件生成失败: HTTP {response.status_code}")
+                    phase.fail(f"HTTP {response.status_code}")
+                    return None
+                await asyncio.sleep(max(min(retry_after, deadline - loop.time()), 0))
+            self.print_log("等待差异文件生成超时")
+            phase.fail("等待超时")
+            return None
+
+    async def resolve_download_url(self):
+        """下载文件使用的服务地址：优先使用零拷贝下载服务，无法连接时使用主服务"""
+        if self.download_url is None:
+            download_url = self.server_url
+            if DOWNLOAD_URL:
+                try:
+                    await self.http_client().head(f"{DOWNLOAD_URL}/download_patch/0/0", timeout=3)
+                    download_url = DOWNLOAD_URL
+                except httpx.HTTPError as e:
+                    logging.warning(f"无法连接下载服务，使用主服务下载: {str(e)}")
+            self.download_url = download_url
+        return self.download_url
+
+    async def fetch_verifier(self, blocks, total_size):
+        """下载块哈希清单并用版本信息中的 Merkle 根校验，不可用时返回 None（只做整体摘要校验）"""
+        if not blocks or total_size is None:
+            return None
+        try:
+            response = await self.http_client().get(f"{self.server_url}/block_hashes/{blocks['file']}")
+            response.raise_for_status()
+            return self.build_block_verifier(blocks, total_size, response.json()['blocks'])
+        except Exception as e:
+            logging.warning(f"获取块哈希清单失败: {str(e)}")
+            return None
+
+    async def verified_blocks(self, chunks, offset, verifier, url, etag, encoding=None):
+        """iter_verified_blocks 的异步版：按块对齐逐块校验响应数据，损坏的块单独重新下载"""
+        if verifier is None:
+            async for chunk in chunks:
+                if chunk:
+                    yield offset, chunk
+                    offset += len(chunk)
+            return
+        buffer = bytearray()
+        async for chunk in chunks:
+            buffer += chunk
+            for block_offset, data in verifier.split_blocks(buffer, offset):
+                if not verifier.check(block_offset, data):
+                    data = await self.refetch(url, etag, verifier, block_offset, len(data), encoding)
+                yield block_offset, data
+                offset = block_offset + len(data)
+        if buffer:
+            yield offset, bytes(buffer)
+
+    async def refetch(self, url, etag, verifier, offset, length, encoding=None):
+        """重新下载校验失败的块"""
+        logging.warning(f"块校验失败，重新下载: {url} 偏移 {offset}")
+        for _ in range(BLOCK_RETRIES):
+            headers = self.block_range_headers(offset, length, etag, encoding)
+            response = await self.http_client().get(url, headers=headers)
+            if response.status_code == 206 and verifier.check(offset, response.content):
+                return response.content
+        raise IOError(f"块多次校验失败: 偏移 {offset}")
+
+    async def download(self, url, local_file, desc="下载文件", hasher=None, verifier=None, encoding=None):
+        """支持断点续传的下载，大文件且服务器支持 Range 时按区间并发下载（参数含义与 download_with_resume 相同）"""
+        with self.phase('download', desc, url=url, encoding=encoding) as phase:
+            result = None
+            if self.download_segments > 1 and encoding is None:
+                result = await self.download_segmented(url, local_file, desc, hasher, verifier)
+                phase.details['segmented'] = result is not None
+            if result is None:
+                result = await self.download_stream(url, local_file, desc, hasher, verifier, encoding)
+            if not result:
+                phase.fail("下载未完成")
+            return result
+
+    async def download_stream(self, url, local_file, desc="下载文件", hasher=None, verifier=None, encoding=None):
+        """单连接顺序下载，支持断点续传；续传校验、摘要补算和收尾与 UpdateClient.download_stream 共用，读取文件在线程中执行"""
+        temp_file, etag_file, out_file = self.stream_temp_files(local_file, encoding)
+        headers, resume_size = await asyncio.to_thread(
+            self.resume_headers, temp_file, etag_file, verifier, encoding
+        )
+
+        async with self.http_client().stream('GET', url, headers=headers) as response:
+            restart = self.resume_mismatch(response.status_code, response.headers, resume_size, encoding)
+            if not restart:
+                response.raise_for_status()
+                total_size, resume_size, verifier, decoder = await asyncio.to_thread(
+                    self.begin_stream, response.status_code, response.headers, temp_file, etag_file, out_file,
+                    resume_size, hasher, verifier, encoding
+                )
+                # 客户端默认不接受压缩编码，按原样读取响应体（预压缩版本由 decoder 解压）
+                chunks = response.aiter_raw(READ_CHUNK_SIZE)
+                etag = response.headers.get('ETag')
+                content_encoding = encoding if decoder is not None else None
+                with self.stream_writer(temp_file, out_file, desc, total_size, resume_size, decoder, hasher) as write:
+                    async for _, data in self.verified_blocks(chunks, resume_size, verifier, url, etag, content_encoding):
+                        write(data)
+
+        if restart:
+            # 本地临时文件与服务器文件不一致，丢弃后重新下载
+            logging.warning(f"续传位置无效，重新下载: {url}")
+            os.remove(temp_file)
+            return await self.download_stream(url, local_file, desc, hasher, verifier, encoding)
+        return self.finish_stream(url, local_file, temp_file, etag_file, out_file, total_size, decoder)
+
+    async def download_segmented(self, url, local_file, desc="下载文件", hasher=None, verifier=None):
+        """按字节区间并发下载（每段一个协程）并写入预分配文件，每段进度记录在下载日志中以便续传
+
+        文件过小或服务器不支持 Range 时返回 None，由调用方改用单连接下载。某段失败时取消其余各段并返回 False；
+        被取消时保存下载日志后继续向上传递取消。分段规划、续传校验和摘要补算与 UpdateClient.download_segmented 共用。
+        """
+        head = await self.http_client().head(url, timeout=10)
+        target = self.segmented_target(head.status_code, head.headers, verifier)
+        if target is None:
+            return None
+        total_size, etag, verifier = target
+        temp_file, journal_file, journal, verifier = await asyncio.to_thread(
+            self.prepare_segments, url, local_file, total_size, etag, verifier
+        )
+
+        downloaded = sum(seg['pos'] - seg['start'] for seg in journal['segments'])
+        sequential = SequentialHasher(hasher, temp_file, journal['segments'])
+        # 从磁盘补算期间持有 hash_lock，此时不在内存中计算
+        hash_lock = asyncio.Lock()
+
+        async def catch_up_hash():
+            if hasher is None:
+                return
+            async with hash_lock:
+                await asyncio.to_thread(sequential.catch_up)
+
+        # 续传时先补算第一段已下载的部分
+        await catch_up_hash()
+        if self.current_phase is not None:
+            self.current_phase.set_total(total_size, downloaded)
+
+        with tqdm(total=total_size, initial=downloaded, unit='B', unit_scale=True, desc=desc) as pbar:
+            async def fetch_segment(segment):
+                if segment['pos'] > segment['end']:
+                    return
+                headers = self.segment_headers(segment, etag)
+                async with self.http_client().stream('GET', url, headers=headers) as response:
+                    if response.status_code != 206:
+                        raise IOError(f"分段请求未返回 206: HTTP {response.status_code}")
+                    with open(temp_file, 'r+b') as f:
+                        f.seek(segment['pos'])
+                        position = segment['pos']
+                        chunks = response.aiter_raw(READ_CHUNK_SIZE)
+                        try:
+                            async for _, chunk in self.verified_blocks(chunks, position, verifier, url, etag):
+                                f.write(chunk)
+                                pbar.update(len(chunk))
+                                self.advance_phase(len(chunk))
+                                if not hash_lock.locked():
+                                    sequential.feed(position, chunk)
+                                position += len(chunk)
+                                # 每写入 JOURNAL_INTERVAL 落盘并刷新日志，日志只记录已落盘的位置
+                                if position - segment['pos'] >= JOURNAL_INTERVAL:
+                                    f.flush()
+                                    segment['pos'] = position
+                                    self.save_download_journal(journal_file, journal)
+                                    await catch_up_hash()
+                        finally:
+                            f.flush()
+                            segment['pos'] = position
+                await catch_up_hash()
+                if segment['pos'] <= segment['end']:
+                    raise IOError(f"分段下载不完整: {segment['pos']}/{segment['end'] + 1}")
+
+            try:
+                await gather_all(fetch_segment(seg) for seg in journal['segments'])
+            except BaseException as e:
+                # 一段失败或整体被取消时其余各段已停止，保存已落盘的进度
+                self.save_download_journal(journal_file, journal)
+                if not isinstance(e, Exception):
+                    raise
+                logging.error(f"分段下载失败: {str(e)}")
+                return False
+
+        await catch_up_hash()
+        shutil.move(temp_file, local_file)
+        os.remove(journal_file)
+        return True
+
+    async def verify(self, file_path, algorithm, expected, label="校验文件"):
+        """计算文件摘要并与期望值比较（在线程中读取文件），结果记为一个校验阶段"""
+        with self.phase('verify', label, os.path.getsize(file_path), algorithm=algorithm) as phase:
+            if await asyncio.to_thread(self.get_file_digest, file_path, algorithm) != expected:
+                phase.fail(f"{algorithm} 不一致")
+        return phase.ok
+
+    async def apply(self, version, patch_paths, base_version=None):
+        """在暂存目录中从基准版本应用已下载的差异文件链，成功后切换并记录新版本号（失败时当前版本不受影响）"""
+        return await self.run_local(self.install_patch_chain, version, patch_paths, base_version)
+
+    async def run_local(self, func, *args):
+        """在线程中执行本地安装步骤；执行期间收到的取消推迟到步骤完成后再向上传递"""
+        task = asyncio.ensure_future(asyncio.to_thread(func, *args))
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.done():
+                self.print_log("正在完成当前安装步骤，完成后取消更新")
+                await asyncio.wait([task])
+            raise
+
+    async def fetch_index(self, path, label):
+        """下载服务器发布的 JSON 清单（目录版本的文件清单、块索引），不存在或获取失败时返回 None"""
+        try:
+            response = await self.http_client().get(f"{self.server_url}{path}")
+            if response.status_code != 200:
+                return None
+            return response.json()
+        except Exception as e:
+            logging.warning(f"获取{label}失败: {str(e)}")
+            return None
+
+    async def fetch_file(self, url, dest_file, hasher):
+        """直接下载到指定文件并同时计算摘要（用于目录版本中的小文件），返回字节数"""
+        size = 0
+        async with self.http_client().stream('GET', url) as response:
+            response.raise_for_status()
+            with open(dest_file, 'wb') as f:
+                async for chunk in response.aiter_raw(READ_CHUNK_SIZE):
+                    f.write(chunk)
+                    hasher.update(chunk)
+                    size += len(chunk)
+        return size
+
+    async def tree_update(self, version_info):
+        """目录版本更新（_tree_update 的异步版）：变化的文件按协程并发下载，下载期间可以取消或超时
+
+        扫描本地目录、合成差异文件在线程中执行；放入暂存目录并切换版本的步骤开始后推迟取消到完成。
+        """
+        latest_version = version_info['latest_version']
+        staging_dir = os.path.join(self.temp_dir, 'tree_staging')
+        try:
+            manifest = await self.fetch_index(f"/tree_manifest/{latest_version}", f"版本 {latest_version} 的文件清单")
+            if manifest is None:
+                self.print_log("获取文件清单失败")
+                return False
+            self.note_method('tree')
+            state, local_files, changed, managed = await asyncio.to_thread(self.scan_tree_changes, manifest)
+            if not managed:
+                managed = await self.fetch_index(
+                    f"/tree_manifest/{self.current_version}", f"版本 {self.current_version} 的文件清单"
+                ) or {}
+            patches, removed = self.plan_tree_update(manifest, local_files, changed, managed, staging_dir)
+            target_files = manifest['files']
+            download_url = await self.resolve_download_url()
+            semaphore = asyncio.Semaphore(max(self.download_segments, 1) * 2)
+
+            async def fetch_entry(rel_path):
+                staged_file = self.tree_staging_path(staging_dir, rel_path)
+                quoted = urllib.parse.quote(rel_path)
+                if self.tree_patch_usable(rel_path, local_files, patches):
+                    patch_response = await self.http_client().get(
+                        f"{self.server_url}/download_tree_patch/{self.current_version}/{latest_version}/{quoted}"
+                    )
+                    if patch_response.status_code == 200 and await asyncio.to_thread(
+                            self.apply_tree_patch, rel_path, target_files[rel_path], patches[rel_path],
+                            patch_response.content, staged_file):
+                        return len(patch_response.content)
+                    logging.warning(f"差异文件应用失败，改为下载完整文件: {rel_path}")
+
+                algorithm, expected = self.expected_digest(target_files[rel_path])
+                hasher = hashlib.new(algorithm)
+                size = await self.fetch_file(f"{download_url}/download/{latest_version}/{quoted}", staged_file, hasher)
+                if hasher.hexdigest() != expected:
+                    raise IOError(f"文件{algorithm}校验失败: {rel_path}")
+                return size
+
+            async def fetch_counted(rel_path):
+                async with semaphore:
+                    size = await fetch_entry(rel_path)
+                self.advance_phase(1)
+                return size
+
+            with self.phase('download', "下载变化的文件", len(changed), unit='file') as phase:
+                downloaded = sum(await gather_all(fetch_counted(rel_path) for rel_path in changed))
+                phase.details['bytes'] = downloaded
+            self.print_log(f"已下载 {downloaded/1024/1024:.2f} MB")
+
+            await self.run_local(
+                self.install_tree, latest_version, target_files, changed, removed, staging_dir, manifest.get('links')
+            )
+            self.print_log("目录版本更新完成！")
+            return True
+
+        except Exception as e:
+            logging.error(f"目录版本更新失败: {str(e)}")
+            self.print_log(f"目录版本更新失败: {str(e)}")
+            return False
+        finally:
+            if os.path.exists(staging_dir):
+                shutil.rmtree(staging_dir)
+
+    async def chunk_update(self, version_info):
+        """块同步（_chunk_update 的异步版）：缺少的块按协程并发下载，下载期间可以取消或超时
+
+        复用本地块和校验合成结果在线程中执行；切换版本的步骤开始后推迟取消到完成。
+        """
+        latest_version = version_info['latest_version']
+        staging_file = os.path.join(self.temp_dir, APP_NAME + '.chunksync')
+        try:
+            target_index = await self.fetch_index(f"/chunk_index/{latest_version}", f"版本 {latest_version} 的块索引")
+            if target_index is None:
+                return False
+            self.note_method('chunk')
+
+            # 本地文件的块位置：借助服务器发布的对应版本块索引定位，读取时再按摘要校验
+            local_indexes = []
+            for version, file_path in await asyncio.to_thread(self.local_version_files):
+                if version == latest_version:
+                    index = target_index
+                else:
+                    index = await self.fetch_index(f"/chunk_index/{version}", f"版本 {version} 的块索引")
+                local_indexes.append((file_path, index))
+            missing = await asyncio.to_thread(self.reuse_local_chunks, target_index, local_indexes, staging_file)
+            missing_bytes = sum(size for _, size, _ in missing)
+            runs = self.chunk_runs(missing)
+
+            file_url = f"{await self.resolve_download_url()}/download/{latest_version}/{APP_NAME}"
+            semaphore = asyncio.Semaphore(max(self.download_segments, 1))
+            with self.phase('download', "下载缺少的块", missing_bytes, url=file_url, runs=len(runs)), \
+                    tqdm(total=missing_bytes, unit='B', unit_scale=True, desc="下载缺少的块") as pbar:
+                async def fetch_run(run):
+                    start = run[0][0]
+                    end = run[-1][0] + run[-1][1] - 1
+                    async with semaphore:
+                        response = await self.http_client().get(file_url, headers={'Range': f'bytes={start}-{end}'})
+                    if response.status_code != 206:
+                        raise IOError(f"块下载失败: HTTP {response.status_code}")
+                    self.write_chunk_run(staging_file, run, response.content)
+                    self.advance_phase(end - start + 1)
+                    pbar.update(end - start + 1)
+
+                await gather_all(fetch_run(run) for run in runs)
+
+            if not await asyncio.to_thread(self.verify_chunk_result, version_info, staging_file):
+                return False
+            # 放入暂存目录后整体切换，原版本保留为备份
+            await self.run_local(self.install_full_file, latest_version, staging_file)
+            self.print_log("块同步更新完成！")
+            return True
+
+        except Exception as e:
+            logging.error(f"块同步失败: {str(e)}")
+            self.print_log(f"块同步失败: {str(e)}")
+            return False
+        finally:
+            if os.path.exists(staging_file):
+                os.remove(staging_file)
+
+    async def update(self, version_info, timeout=None):
+        """下载并应用更新，返回是否成功；整个过程记录为一次更新尝试的追踪
+
+        timeout 为整个更新的时限（秒），超时按失败处理；被取消时向上传递取消，已下载的部分留待续传。
+        超时或取消发生在安装步骤中时，安装步骤完成后才结束，此时新版本已经切换，按成功返回。
+        """
+        if self.busy:
+            self.print_log("另一个更新或回滚正在进行")
+            return False
+        self.busy = True
+        trace = self.begin_trace()
+        trace.to_version = version_info['latest_version']
+        success = False
+        try:
+            success = await asyncio.wait_for(self.run_update(version_info), timeout)
+            return success
+        except asyncio.TimeoutError:
+            if self.current_version == trace.to_version:
+                self.print_log(f"更新超时（{timeout} 秒）前安装步骤已开始，已更新到版本: {trace.to_version}")
+                success = True
+                return True
+            logging.error(f"更新超时（{timeout} 秒）")
+            self.print_log(f"更新超时（{timeout} 秒），已下载的部分将在下次更新时继续")
+            return False
+        except asyncio.CancelledError:
+            if self.current_version == trace.to_version:
+                # 取消请求到达时正在安装，安装已完成：不再向上传递取消
+                asyncio.current_task().uncancel()
+                self.print_log(f"取消前安装步骤已开始，已更新到版本: {trace.to_version}")
+                success = True
+                return True
+            self.print_log("更新已取消，已下载的部分将在下次更新时继续")
+            raise
+        finally:
+            self.busy = False
+            self.finish_trace(success)
+
+    async def revert(self, version=None):
+        """回滚到最近的备份（version 为空时）或切换到本地持有的指定版本，返回是否成功；更新进行中时拒绝"""
+        if self.busy:
+            self.print_log("更新进行中，无法回滚")
+            return False
+        self.busy = True
+        try:
+            if version is None:
+                return await self.run_local(self.rollback)
+            return await self.run_local(self.rollback_to, version)
+        finally:
+            self.busy = False
+
+    async def run_update(self, version_info):
+        """选择更新方式（目录、增量、块同步或完整更新）并执行"""
+        try:
+            latest_version = version_info['latest_version']
+            version_data = version_info['versions'][latest_version]
+
+            self.print_log(f"正在更新到版本 {latest_version}")
+            self.print_log(f"更新说明: {version_data.get('description', '无')}")
+
+            if version_data.get('type') == 'tree':
+                return await self.tree_update(version_info)
+
+            # 本地缓存或备份中已有目标版本时直接安装，不需要下载
+            if await self.run_local(self.install_held_target, version_info):
+                return True
+
+            # 优先使用服务器规划的更新路径（检查更新时已随响应返回则直接使用；本地还持有其他版本时重新规划）
+            plan = version_info.get('plan')
+            if plan is None or plan.get('target_version') != latest_version or len(self.local_version_sources()) > 1:
+                plan = await self.plan(latest_version) or plan
+            if plan is not None and plan['method'] == 'full' and plan.get('on_demand') and self.patch_wait_seconds > 0:
+                plan = await self.wait_for_patch(latest_version) or plan
+            if plan is not None:
+                if plan['method'] == 'patch':
+                    base_version = plan.get('base_version', self.current_version)
+                    self.print_log(
+                        f"使用增量更新从版本 {base_version} 更新到版本 {latest_version}，"
+                        f"共 {len(plan['steps'])} 个差异文件，"
+                        f"{plan['total_size']/1024/1024:.2f} MB"
+                    )
+                    return await self.patch_update(version_info, plan['steps'], base_version)
+                if 'chunk_index' in version_data:
+                    self.print_log(f"使用块同步从版本 {self.current_version} 更新到版本 {latest_version}")
+                    if await self.chunk_update(version_info):
+                        return True
+                self.print_log(f"使用完整更新从版本 {self.current_version} 更新到版本 {latest_version}")
+                return await self.full_update(version_info)
+
+            # 旧版服务器：版本信息中只有到最新版本的单个差异文件
+            if 'patch' in version_data and version_data['patch']['from_version'] == self.current_version:
+                self.print_log(f"使用增量更新从版本 {self.current_version} 更新到版本 {latest_version}")
+                return await self.patch_update(version_info, self.legacy_patch_steps(version_info))
+            self.print_log(f"使用完整更新从版本 {self.current_version} 更新到版本 {latest_version}")
+            return await self.full_update(version_info)
+
+        except Exception as e:
+            logging.error(f"更新失败: {str(e)}")
+            self.print_log(f"更新失败: {str(e)}")
+            return False
+
+    async def patch_update(self, version_info, steps, base_version=None):
+        """按顺序下载（缓存中已有的直接使用）并校验差异文件链后从基准版本应用，任何一步失败时改用完整更新"""
+        latest_version = version_info['latest_version']
+
+        # 差异文件使用了本地不支持的编码（如未安装 zstandard）时直接完整更新
+        unsupported = {step.get('codec', 'bsdiff') for step in steps} - set(DELTA_DECODERS)
+        if unsupported:
+            self.print_log(f"客户端不支持差异编码 {', '.join(sorted(unsupported))}，改用完整更新")
+            return await self.full_update(version_info)
+
+        self.note_method('patch')
+        patch_paths = []
+        for index, step in enumerate(steps, 1):
+            cached = self.cached_patch(step)
+            if cached:
+                patch_paths.append((cached, self.expected_digest(step, 'target_')))
+                continue
+            patch_url = f"{await self.resolve_download_url()}/download_patch/{step['from_version']}/{step['to_version']}"
+            patch_path = os.path.join(self.temp_dir, step['patch_file'])
+
+            algorithm, expected = self.expected_digest(step)
+            hasher = hashlib.new(algorithm)
+            verifier = await self.fetch_verifier(step.get('blocks'), step.get('size'))
+            if not await self.download(patch_url, patch_path, f"下载差异文件 {index}/{len(steps)}", hasher, verifier):
+                logging.error(f"下载差异文件失败: {step['patch_file']}")
+                self.print_log("下载差异文件失败，改用完整更新")
+                return await self.full_update(version_info)
+
+            if not self.check_digest(f"校验差异文件 {index}/{len(steps)}", hasher, algorithm, expected):
+                logging.error(f"差异文件{algorithm}校验失败: {step['patch_file']}")
+                self.print_log(f"差异文件{algorithm}校验失败，改用完整更新")
+                os.remove(patch_path)
+                return await self.full_update(version_info)
+
+            patch_paths.append((patch_path, self.expected_digest(step, 'target_')))
+
+        if not await self.apply(latest_version, patch_paths, base_version):
+            self.print_log("应用差异文件失败，改用完整更新")
+            return await self.full_update(version_info)
+        self.cache_patches(steps, patch_paths)
+        return True
+
+    async def full_update(self, version_info):
+        """完整更新：下载并校验完整文件后再备份和替换，下载或校验失败时当前版本不受影响"""
+        latest_version = version_info['latest_version']
+        version_data = version_info['versions'][latest_version]
+        self.print_log("使用完整更新")
+        self.note_method('full')
+
+        file_url = f"{await self.resolve_download_url()}/download/{latest_version}/{APP_NAME}"
+        staged_file = os.path.join(self.temp_dir, f"{APP_NAME}.full")
+
+        algorithm, expected = self.expected_digest(version_data)
+        hasher = hashlib.new(algorithm)
+        # 有本地可解压的预压缩版本时下载压缩数据，块哈希清单对应压缩后的数据
+        encoding, encoding_info = self.choose_encoding(version_data)
+        if encoding:
+            self.print_log(f"使用预压缩版本: {encoding} ({encoding_info['size']/1024/1024:.2f} MB)")
+            verifier = await self.fetch_verifier(encoding_info.get('blocks'), encoding_info['size'])
+        else:
+            verifier = await self.fetch_verifier(version_data.get('blocks'), version_data.get('size'))
+        if not await self.download(file_url, staged_file, f"下载 {APP_NAME}", hasher, verifier, encoding):
+            logging.error("下载文件失败")
+            self.print_log("更新失败: 下载文件失败")
+            return False
+
+        if not self.check_digest("校验下载的文件", hasher, algorithm, expected):
+            logging.error(f"文件{algorithm}校验失败，文件可能已损坏")
+            self.print_log(f"更新失败: 文件{algorithm}校验失败，文件可能已损坏")
+            os.remove(staged_file)
+            return False
+
+        await self.run_local(self.install_full_file, latest_version, staged_file)
+        self.print_log("更新成功！")
+        self.print_log(f"已更新到版本: {latest_version}")
+        return True
+
+
+class BlockingUpdateClient:
+    """AsyncUpdateClient 的同步外观：在后台线程的事件循环中运行协程，供 UpdateManager 等同步代码调用
+
+    同步方法与 UpdateClient 一致（check_for_updates、download_update、rollback、rollback_to），回滚同样在事件循环中执行，
+    更新进行中时拒绝。submit 返回 concurrent.futures.Future，可在任意线程中调用 cancel 取消正在进行的操作。
+    其他属性（current_version、last_trace_path 等）转发给引擎。
+    """
+
+    def __init__(self, engine=None):
+        self.engine = engine or AsyncUpdateClient()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='update-client', daemon=True)
+        self.thread.start()
+        # 进行中的协程对应的任务（只在后台事件循环中访问）
+        self.tasks = set()
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
+
+    def submit(self, coro):
+        """在后台事件循环中运行协程，返回 concurrent.futures.Future（操作真正结束后才完成）"""
+        future = concurrent.futures.Future()
+
+        def settle(task):
+            self.tasks.discard(task)
+            if task.cancelled():
+                future.cancel()
+            elif task.exception() is not None:
+                future.set_exception(task.exception())
+            else:
+                future.set_result(task.result())
+
+        def start():
+            # 在事件循环中按提交顺序创建任务，之后调度的 cancel 一定能取消到它
+            task = self.loop.create_task(coro)
+            self.tasks.add(task)
+            task.add_done_callback(settle)
+
+        self.loop.call_soon_threadsafe(start)
+        return future
+
+    def run(self, coro, timeout=None):
+        """运行协程并等待结果"""
+        return self.submit(coro).result(timeout)
+
+    def check_for_updates(self):
+        return self.run(self.engine.check())
+
+    def download_update(self, version_info, timeout=None):
+        return self.run(self.engine.update(version_info, timeout))
+
+    def rollback(self):
+        return self.run(self.engine.revert())
+
+    def rollback_to(self, version):
+        return self.run(self.engine.revert(version))
+
+    def cancel(self):
+        """取消所有进行中的操作（下载中的部分留待续传，正在执行的安装步骤完成后才结束）"""
+        self.loop.call_soon_threadsafe(self.cancel_tasks)
+
+    def cancel_tasks(self):
+        for task in list(self.tasks):
+            task.cancel()
+
+    async def shutdown(self):
+        self.cancel_tasks()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        await self.engine.aclose()
+
+    def close(self):
+        """取消进行中的操作并等待其结束，关闭连接后停止后台事件循环"""
+        if not self.thread.is_alive():
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result()
+        except Exception as e:
+            logging.warning(f"关闭更新客户端失败: {str(e)}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(5)
+
+
+if __name__ == "__main__":
+    async def main():
+        client = AsyncUpdateClient()
+        try:
+            update_info = await client.check()
+            if update_info:
+                await client.update(update_info)
+        finally:
+            await client.aclose()
+
+    asyncio.run(main())
@@ -8,27 +8,447 @@ from tqdm import tqdm
 import time
 import platform
 import psutil
-import bsdiff4
+import lzma
+import zlib
 import sys
+import threading
+import urllib.parse
+import functools
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from datetime import datetime
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 与服务器共用的文件格式定义在 server/tools/update_formats.py，两端导入同一份实现
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server'))
+from tools.update_formats import (  # noqa: E402
+    CODECS, WINDOWED_MAGIC, block_digest, merkle_root, decode_detected, plan_windows, windowed_prefix,
+    read_windowed_header, apply_windowed
+)
+
+try:
+    import fcntl
+except ImportError:
+    # Windows 没有 fcntl，暂存目录只能复制
+    fcntl = None
+
 # 加载配置
 with open(os.path.join(os.path.dirname(__file__), 'client_config.json'), 'r') as f:
     config = json.load(f)
     SERVER_URL = f"{config['SERVER']['URL']}:{config['SERVER']['PORT']}"
+    # 零拷贝下载服务地址（可选）
+    DOWNLOAD_PORT = config['SERVER'].get('DOWNLOAD_PORT')
+    DOWNLOAD_URL = f"{config['SERVER']['URL']}:{DOWNLOAD_PORT}" if DOWNLOAD_PORT else None
     APP_NAME = config['APP_NAME']
+    DOWNLOAD_CONFIG = config.get('DOWNLOAD', {})
+    BACKUP_CONFIG = config.get('BACKUP', {})
+    CACHE_CONFIG = config.get('CACHE', {})
     SYSTEM_TYPE = platform.system()  # 返回 'Darwin', 'Windows' 或 'Linux'
 
+# 单个损坏块的最大重新下载次数
+BLOCK_RETRIES = 3
+# 读取响应体的块大小
+READ_CHUNK_SIZE = 256 * 1024
+# 分段下载每写入多少字节落盘并刷新下载日志
+JOURNAL_INTERVAL = 4 * 1024 * 1024
+# 阶段进度回调的最小间隔（秒）
+PROGRESS_INTERVAL = 0.25
+# 保留的更新追踪文件数
+TRACE_KEEP = 20
+# 反向差异备份的清单文件名（存在即表示该备份以差异形式保存）
+REVERSE_DELTA_MANIFEST = '.reverse_delta.json'
+# Linux 的 FICLONE ioctl：在支持写时复制的文件系统（btrfs、XFS 等）上共享数据块克隆文件
+FICLONE = 0x40049409
+
+# 差异编码解码注册表（与服务器共用 update_formats）：名称 -> (文件头魔数, 解码函数)
+DELTA_DECODERS = {name: (magic, decode) for name, (magic, _, decode) in CODECS.items()}
+
+# 完整文件预压缩版本的流式解压器（与服务器的 Content-Encoding 一致）：编码 -> 创建解压器的函数
+DECOMPRESSORS = {
+    'gzip': lambda: zlib.decompressobj(31),
+    'xz': lzma.LZMADecompressor
+}
+if zstandard is not None:
+    DECOMPRESSORS['zstd'] = lambda: zstandard.ZstdDecompressor().decompressobj()
+
+# 备份压缩使用的差异编码：名称 -> 编码函数(旧数据, 新数据)
+BACKUP_ENCODERS = {'bsdiff': CODECS['bsdiff'][1]}
+if 'zstd-dict' in CODECS:
+    # 以旧数据为字典压缩，比 bsdiff 快一到两个数量级；备份压缩在每次更新后运行，使用较低的压缩级别
+    BACKUP_ENCODERS['zstd-dict'] = functools.partial(CODECS['zstd-dict'][1], level=12)
+
+def clone_file(src, dst, allow_hardlink=False):
+    """建立文件副本：优先 reflink（写时复制，不复制数据），不支持时复制，返回使用的方式
+
+    allow_hardlink 为真时以硬链接代替复制，只用于两侧都不会再被修改的文件（备份内部）：
+    硬链接共享 inode，任何一侧的原地修改都会改变另一侧。当前版本目录中的文件不能与备份共享 inode，
+    否则应用原地写入自身文件（配置、数据）时会同时改掉备份。
+    """
+    if fcntl is not None:
+        try:
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            shutil.copystat(src, dst)
+            return 'reflink'
+        except OSError:
+            if os.path.exists(dst):
+                os.remove(dst)
+    if allow_hardlink:
+        try:
+            os.link(src, dst)
+            return 'hardlink'
+        except OSError:
+            pass
+    shutil.copy2(src, dst)
+    return 'copy'
+
+def fsync_path(path):
+    """把文件或目录落盘（Windows 无法打开目录，忽略不支持的情况）"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def fsync_tree(directory):
+    """把目录下的全部文件和子目录落盘"""
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in filenames:
+            file_path = os.path.join(dirpath, filename)
+            if not os.path.islink(file_path):
+                fsync_path(file_path)
+        fsync_path(dirpath)
+
+class BlockVerifier:
+    """按服务器发布的块哈希清单逐块校验文件数据"""
+    def __init__(self, block_size, leaves, total_size):
+        self.block_size = block_size
+        self.leaves = leaves
+        self.total_size = total_size
+    
+    def block_end(self, offset):
+        """offset 所在块的结束位置（不含）"""
+        return min(offset - offset % self.block_size + self.block_size, self.total_size)
+    
+    def check(self, offset, data):
+        """校验从块边界 offset 开始的一整块数据"""
+        return block_digest(data) == self.leaves[offset // self.block_size]
+    
+    def valid_prefix(self, file_path, start, end):
+        """从块边界 start 开始校验文件中已有的 [start, end) 数据，返回第一个损坏或不完整的块的起始位置"""
+        offset = start
+        with open(file_path, 'rb') as f:
+            f.seek(start)
+            while offset < end:
+                block_end = self.block_end(offset)
+                if block_end > end:
+                    break
+                data = f.read(block_end - offset)
+                if len(data) != block_end - offset or not self.check(offset, data):
+                    break
+                offset = block_end
+        return offset
+    
+    def split_blocks(self, buffer, offset):
+        """从缓冲区开头依次取出完整的块（offset 为缓冲区开头在文件中的位置），产出 (偏移, 数据)"""
+        while buffer and offset < self.total_size and len(buffer) >= self.block_end(offset) - offset:
+            length = self.block_end(offset) - offset
+            data = bytes(buffer[:length])
+            del buffer[:length]
+            yield offset, data
+            offset += length
+
+
+class SequentialHasher:
+    """分段下载时按文件顺序计算摘要：正好接续已计算位置的数据直接在内存中计算，其余数据落盘后从文件补算
+
+    同步和异步下载共用，调用方负责加锁（补算期间各段仍可继续写入，落盘位置只读取一次）。
+    """
+    def __init__(self, hasher, temp_file, segments):
+        self.hasher = hasher
+        self.temp_file = temp_file
+        self.segments = segments
+        # 已计算到的位置
+        self.pos = 0
+    
+    def feed(self, position, data):
+        """写入 position 处的数据后调用，正好接续已计算位置时直接计算"""
+        if self.hasher is not None and self.pos == position:
+            self.hasher.update(data)
+            self.pos += len(data)
+    
+    def catch_up(self):
+        """把已落盘且紧接已计算位置的数据从临时文件补算进摘要"""
+        if self.hasher is None:
+            return
+        for seg in self.segments:
+            end = seg['pos']
+            if seg['start'] <= self.pos < end:
+                with open(self.temp_file, 'rb') as f:
+                    f.seek(self.pos)
+                    remaining = end - self.pos
+                    while remaining > 0:
+                        data = f.read(min(1024 * 1024, remaining))
+                        if not data:
+                            break
+                        self.hasher.update(data)
+                        remaining -= len(data)
+                self.pos = end
+
+class TracePhase:
+    """更新过程中的一个阶段（检查、规划、下载、校验、应用差异文件、备份、替换、恢复）
+
+    记录耗时、处理量（unit 为 B 时是字节，否则为步数或文件数）和吞吐，处理量变化时按间隔回调进度。
+    分段下载在多个线程中调用 advance，计数加锁。
+    """
+    def __init__(self, name, label, total=None, unit='B', on_progress=None, details=None):
+        self.name = name
+        self.label = label
+        self.total = total
+        self.unit = unit
+        self.on_progress = on_progress
+        self.details = details or {}
+        # 本次处理的量和续传前已有的量（只有本次处理的量计入吞吐）
+        self.done = 0
+        self.initial = 0
+        self.started = time.monotonic()
+        self.duration = None
+        self.ok = None
+        self.error = None
+        self.lock = threading.Lock()
+        self.last_report = 0
+    
+    def set_total(self, total, initial=0):
+        """确定总量（如下载响应头中的文件大小）和续传前已有的量"""
+        self.total = total
+        self.initial = initial
+        self.report()
+    
+    def advance(self, amount):
+        with self.lock:
+            self.done += amount
+            now = time.monotonic()
+            if now - self.last_report < PROGRESS_INTERVAL:
+                return
+            self.last_report = now
+        self.report()
+    
+    def fail(self, error):
+        self.ok = False
+        self.error = error
+    
+    def finish(self, error=None):
+        self.duration = time.monotonic() - self.started
+        if error is not None:
+            self.fail(error)
+        elif self.ok is None:
+            self.ok = True
+        self.report()
+    
+    def percent(self):
+        if self.duration is not None and self.ok:
+            return 100
+        if not self.total:
+            return 0
+        return min(int((self.initial + self.done) * 100 / self.total), 100)
+    
+    def throughput(self):
+        """每秒处理量"""
+        elapsed = self.duration if self.duration is not None else time.monotonic() - self.started
+        return self.done / elapsed if elapsed > 0 else 0
+    
+    def describe(self):
+        """进度描述，如：下载差异文件 1/2 12.0/40.0 MB（8.50 MB/s）"""
+        if self.unit != 'B':
+            return f"{self.label} {self.initial + self.done}/{self.total}" if self.total else self.label
+        if not self.done and not self.initial:
+            return self.label
+        mb = 1024 * 1024
+        progress = f"{(self.initial + self.done)/mb:.1f}" + (f"/{self.total/mb:.1f}" if self.total else "")
+        return f"{self.label} {progress} MB（{self.throughput()/mb:.2f} MB/s）"
+    
+    def report(self):
+        if self.on_progress is not None:
+            self.on_progress(self.describe(), self.percent())
+    
+    def to_dict(self, origin):
+        """导出为追踪记录，start 为相对更新开始的秒数"""
+        record = {
+            'phase': self.name,
+            'label': self.label,
+            'start': round(self.started - origin, 3),
+            'duration': round(self.duration if self.duration is not None else time.monotonic() - self.started, 3),
+            'ok': self.ok,
+            'unit': self.unit,
+            'done': self.done,
+            'total': self.total
+        }
+        if self.initial:
+            record['initial'] = self.initial
+        if self.unit == 'B' and self.done:
+            record['throughput_bps'] = int(self.throughput())
+        if self.error:
+            record['error'] = self.error
+        if self.details:
+            record['details'] = self.details
+        return record
+
+class UpdateTrace:
+    """一次更新尝试的阶段追踪：从检查更新开始，到更新成功或失败结束，结束后导出为 JSON"""
+    def __init__(self, from_version, server_url):
+        self.attempt_id = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+        self.started_at = time.time()
+        self.origin = time.monotonic()
+        self.from_version = from_version
+        self.to_version = None
+        self.server_url = server_url
+        self.download_url = None
+        # 依次尝试的更新方式（增量失败后改用完整更新时有多个）
+        self.methods = []
+        self.phases = []
+        self.result = None
+        self.duration = None
+    
+    def finish(self, success):
+        self.result = 'success' if success else 'failure'
+        self.duration = time.monotonic() - self.origin
+    
+    def to_dict(self):
+        phases = [phase.to_dict(self.origin) for phase in self.phases]
+        summary = {}
+        for record in phases:
+            entry = summary.setdefault(record['phase'], {'count': 0, 'duration': 0.0, 'bytes': 0})
+            entry['count'] += 1
+            entry['duration'] = round(entry['duration'] + record['duration'], 3)
+            if record['unit'] == 'B':
+                entry['bytes'] += record['done']
+        failed = next((record for record in phases if record['ok'] is False), None)
+        return {
+            'attempt_id': self.attempt_id,
+            'started_at': datetime.fromtimestamp(self.started_at).isoformat(timespec='seconds'),
+            'from_version': self.from_version,
+            'to_version': self.to_version,
+            'server_url': self.server_url,
+            'download_url': self.download_url,
+            'system': f"{SYSTEM_TYPE} {platform.release()} / Python {platform.python_version()}",
+            'methods': self.methods,
+            'result': self.result,
+            'duration': round(self.duration if self.duration is not None else time.monotonic() - self.origin, 3),
+            'first_failure': f"{failed['phase']}: {failed.get('error', '')}" if failed else None,
+            'summary': summary,
+            'phases': phases
+        }
+    
+    def export(self, path):
+        """原子写入追踪 JSON"""
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+        os.replace(path + '.tmp', path)
+        return path
+
+class ArtifactCache:
+    """本地内容寻址缓存：按 MD5 保存下载过的差异文件和回滚时替换下来的版本文件
+
+    对象保存在 objects/<前两位>/<MD5>，索引记录每个对象的类型（patch 或 version）、版本号或文件名和最近使用时间，
+    总大小超出预算时淘汰最久未用的对象。对象只整体写入和删除，放入暂存目录时用 reflink 或复制。
+    """
+
+    def __init__(self, cache_dir, budget):
+        self.cache_dir = cache_dir
+        self.objects_dir = os.path.join(cache_dir, 'objects')
+        self.index_file = os.path.join(cache_dir, 'index.json')
+        self.budget = budget
+        os.makedirs(self.objects_dir, exist_ok=True)
+        try:
+            with open(self.index_file, 'r', encoding='utf-8') as f:
+                self.index = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.index = {}
+        # 丢弃文件已不存在的条目
+        self.index = {md5: entry for md5, entry in self.index.items() if os.path.exists(self.object_path(md5))}
+
+    def object_path(self, md5):
+        return os.path.join(self.objects_dir, md5[:2], md5)
+
+    def get(self, md5):
+        """返回对象路径并记录使用时间，没有时返回 None"""
+        if md5 not in self.index or not os.path.exists(self.object_path(md5)):
+            return None
+        self.index[md5]['used'] = time.time()
+        self.save()
+        return self.object_path(md5)
+
+    def versions(self):
+        """缓存中的版本文件：版本号 -> 对象路径"""
+        return {
+            entry['version']: self.object_path(md5)
+            for md5, entry in self.index.items() if entry['kind'] == 'version'
+        }
+
+    def add(self, src, md5, kind, move=False, **info):
+        """把文件加入缓存（move 为真时移动，否则 reflink 或复制），返回对象路径；超出预算时淘汰旧对象"""
+        dst = self.object_path(md5)
+        if os.path.abspath(src) != os.path.abspath(dst):
+            if os.path.exists(dst):
+                if move:
+                    os.remove(src)
+            else:
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                if move:
+                    os.replace(src, dst)
+                else:
+                    clone_file(src, dst)
+        self.index[md5] = {'kind': kind, 'size': os.path.getsize(dst), 'used': time.time(), **info}
+        self.evict(keep=md5)
+        self.save()
+        return dst
+
+    def evict(self, keep=None):
+        """从最久未用的对象开始删除，直到总大小不超过预算"""
+        total = sum(entry['size'] for entry in self.index.values())
+        for md5, entry in sorted(self.index.items(), key=lambda item: item[1]['used']):
+            if total <= self.budget:
+                break
+            if md5 == keep:
+                continue
+            try:
+                os.remove(self.object_path(md5))
+            except FileNotFoundError:
+                pass
+            del self.index[md5]
+            total -= entry['size']
+            logging.info(f"已从本地缓存淘汰: {entry.get('version') or entry.get('name')} ({md5})")
+
+    def save(self):
+        with open(self.index_file + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self.index, f, ensure_ascii=False)
+        os.replace(self.index_file + '.tmp', self.index_file)
+
 class UpdateClient:
     def __init__(self):
         self.server_url = SERVER_URL
+        # 下载文件使用的服务地址，首次下载时确定
+        self.download_url = None
         self.current_dir = os.path.join(os.path.dirname(__file__), 'current_version')
         self.backup_dir = os.path.join(os.path.dirname(__file__), 'backup')
         self.temp_dir = os.path.join(os.path.dirname(__file__), 'temp')
         self.config_file = os.path.join(os.path.dirname(__file__), 'client_config.json')
+        self.tree_state_file = os.path.join(os.path.dirname(__file__), 'tree_state.json')
         
         # 配置日志
         log_dir = os.path.join(os.path.dirname(__file__), 'logs')
+        # 每次更新尝试的阶段追踪
+        self.trace_dir = os.path.join(log_dir, 'traces')
         os.makedirs(log_dir, exist_ok=True)
         logging.basicConfig(
             filename=os.path.join(log_dir, 'client.log'),
@@ -36,10 +456,54 @@ class UpdateClient:
             format='%(asctime)s - %(levelname)s - %(message)s'
         )
         
-        # 确保必要的目录存在
-        os.makedirs(self.current_dir, exist_ok=True)
+        # 新版本先在暂存目录中建立，再整体切换为当前版本；切换过程记录在安装日志中
+        self.stage_dir = os.path.join(self.temp_dir, 'stage')
+        self.install_journal = os.path.join(self.temp_dir, 'install.json')
+        
+        # 确保必要的目录存在（上次切换目录时中断则先恢复，再确认当前版本目录存在）
         os.makedirs(self.backup_dir, exist_ok=True)
         os.makedirs(self.temp_dir, exist_ok=True)
+        self.recover_interrupted_install()
+        os.makedirs(self.current_dir, exist_ok=True)
+        
+        # 分段下载配置
+        self.download_segments = DOWNLOAD_CONFIG.get('segments', 4)
+        self.min_segment_size = DOWNLOAD_CONFIG.get('min_segment_size_mb', 8) * 1024 * 1024
+        # 服务器按需生成差异文件时最多等待的时间（秒），0 表示不等待直接完整更新
+        self.patch_wait_seconds = DOWNLOAD_CONFIG.get('patch_wait_seconds', 60)
+        
+        # 备份：最新的备份保存完整目录，更早的保存为相对下一个较新备份的反向差异，总占用不超过预算
+        self.backup_budget = BACKUP_CONFIG.get('budget_mb', 1024) * 1024 * 1024
+        # 默认使用 zstd 字典压缩（需安装 zstandard），否则使用 bsdiff
+        self.backup_codec = BACKUP_CONFIG.get('delta_codec') or ('zstd-dict' if 'zstd-dict' in BACKUP_ENCODERS else 'bsdiff')
+        if self.backup_codec not in BACKUP_ENCODERS:
+            logging.warning(f"备份差异编码 {self.backup_codec} 不可用，使用 bsdiff")
+            self.backup_codec = 'bsdiff'
+        self.backup_window_size = BACKUP_CONFIG.get('window_size_mb', 16) * 1024 * 1024
+        
+        # 本地缓存：下载过的差异文件和回滚时替换下来的版本，可作为之后更新的基准或直接安装
+        self.cache = ArtifactCache(
+            os.path.join(os.path.dirname(__file__), 'cache'), CACHE_CONFIG.get('budget_mb', 512) * 1024 * 1024
+        )
+        
+        # 复用长连接的会话，连接池大小与分段数一致
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(self.download_segments, 1))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # 下载默认不接受压缩编码，需要预压缩版本时按请求单独指定
+        self.session.headers['Accept-Encoding'] = 'identity'
+        
+        # 检查更新响应缓存，用于 If-None-Match 条件请求
+        self.check_update_etag = None
+        self.check_update_cache = None
+        
+        # 当前更新尝试的追踪、正在进行的阶段和最近一次导出的追踪文件
+        self.trace = None
+        self.current_phase = None
+        self.last_trace_path = None
+        # 阶段进度回调 callback(描述, 百分比)，由界面层设置（可能在工作线程中调用）
+        self.progress_callback = None
         
         # 加载当前版本号
         self.current_version = self.load_current_version()
@@ -77,84 +541,593 @@ class UpdateClient:
 
     def get_file_md5(self, file_path):
         """计算文件的MD5值"""
+        return self.get_file_digest(file_path, 'md5')
+
+    def get_file_digest(self, file_path, algorithm):
+        """计算文件摘要（algorithm 为 hashlib 算法名）"""
         try:
-            md5_hash = hashlib.md5()
+            hasher = hashlib.new(algorithm)
             with open(file_path, "rb") as f:
-                # 使用更大的缓冲区
-                for chunk in iter(lambda: f.read(8192), b""):
-                    md5_hash.update(chunk)
-            md5_value = md5_hash.hexdigest()
-            self.print_log(f"计算的MD5值: {md5_value}")  # 添加调试输出
-            return md5_value
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    hasher.update(chunk)
+                    self.advance_phase(len(chunk))
+            value = hasher.hexdigest()
+            self.print_log(f"计算的{algorithm}值: {value}")
+            return value
         except Exception as e:
-            logging.error(f"计算MD5失败: {str(e)}")
+            logging.error(f"计算{algorithm}失败: {str(e)}")
             raise
 
-    def backup_current_version(self):
-        """备份当前版本"""
-        # 创建新的备份
-        backup_path = os.path.join(self.backup_dir, f"backup_{self.current_version}_{int(time.time())}")
-        os.makedirs(backup_path, exist_ok=True)
-        
-        src_file = os.path.join(self.current_dir, APP_NAME)
-        if os.path.exists(src_file):
-            shutil.copy2(
-                src_file,
-                os.path.join(backup_path, APP_NAME)
+    def expected_digest(self, info, prefix=''):
+        """返回校验用的 (算法, 期望值)：优先使用服务器下发的 digest（如 blake2b），没有或不支持时使用 MD5"""
+        digest = info.get(prefix + 'digest')
+        if digest:
+            algorithm, _, value = digest.partition(':')
+            if algorithm in hashlib.algorithms_available:
+                return algorithm, value
+        return 'md5', info[prefix + 'md5']
+
+    @contextmanager
+    def phase(self, name, label, total=None, unit='B', **details):
+        """记录一个更新阶段的耗时、处理量和吞吐，期间的进度通过 progress_callback 回调
+
+        未处于更新尝试中（如单独调用 apply_patch_chain）时只回调进度，不记录追踪。
+        阶段内抛出异常或调用 fail 时记为失败。
+        """
+        phase = TracePhase(name, label, total, unit, self.report_progress, details)
+        if self.trace is not None:
+            self.trace.phases.append(phase)
+        previous, self.current_phase = self.current_phase, phase
+        phase.report()
+        try:
+            yield phase
+        except BaseException as e:
+            phase.finish(str(e) or type(e).__name__)
+            raise
+        else:
+            phase.finish()
+        finally:
+            self.current_phase = previous
+            logging.info(
+                f"阶段 {name}（{label}）{'完成' if phase.ok else '失败'}: 用时 {phase.duration:.2f} 秒"
+                + (f", {phase.done} 字节, {phase.throughput()/1024/1024:.2f} MB/s" if unit == 'B' and phase.done else "")
+                + (f", {phase.error}" if phase.error else "")
             )
+
+    def advance_phase(self, amount):
+        """当前阶段的处理量增加 amount（下载、复制时按字节调用）"""
+        if self.current_phase is not None:
+            self.current_phase.advance(amount)
+
+    def report_progress(self, desc, percent):
+        if self.progress_callback is not None:
+            try:
+                self.progress_callback(desc, percent)
+            except Exception as e:
+                logging.warning(f"进度回调失败: {str(e)}")
+
+    def begin_trace(self):
+        """开始新的更新尝试追踪（上一次已结束或不存在时），返回当前追踪"""
+        if self.trace is None or self.trace.result is not None:
+            self.trace = UpdateTrace(self.current_version, self.server_url)
+        return self.trace
+
+    def note_method(self, method):
+        """记录本次尝试使用的更新方式"""
+        if self.trace is not None:
+            self.trace.methods.append(method)
+
+    def finish_trace(self, success):
+        """结束当前更新尝试，导出追踪 JSON 并只保留最近 TRACE_KEEP 份"""
+        trace = self.trace
+        if trace is None or trace.result is not None:
+            return None
+        trace.finish(success)
+        trace.download_url = self.download_url
+        try:
+            os.makedirs(self.trace_dir, exist_ok=True)
+            path = os.path.join(
+                self.trace_dir, f"update_{trace.attempt_id}_{trace.from_version}_to_{trace.to_version}.json"
+            )
+            self.last_trace_path = trace.export(path)
+            traces = sorted(name for name in os.listdir(self.trace_dir) if name.startswith('update_'))
+            for name in traces[:-TRACE_KEEP]:
+                os.remove(os.path.join(self.trace_dir, name))
+        except Exception as e:
+            logging.error(f"导出更新追踪失败: {str(e)}")
+            return None
+        summary = ', '.join(
+            f"{name} {entry['duration']:.1f}s" for name, entry in trace.to_dict()['summary'].items()
+        )
+        logging.info(f"更新追踪 {trace.attempt_id}: {trace.result}, 用时 {trace.duration:.1f} 秒（{summary}）")
+        return self.last_trace_path
+
+    def stage_current_version(self, exclude=()):
+        """在暂存目录中建立当前版本的副本，返回暂存目录；支持 reflink 的文件系统上不复制数据，否则复制
+
+        exclude 为即将被替换或删除的文件（相对路径），不放入副本。不使用硬链接：切换后原当前版本成为备份，
+        与新的当前版本共享 inode 时应用的原地写入会同时改掉备份。
+        """
+        if os.path.exists(self.stage_dir):
+            shutil.rmtree(self.stage_dir)
+        excluded = {os.path.normcase(os.path.join(self.current_dir, *rel_path.split('/'))) for rel_path in exclude}
+        methods = {}
+        
+        def ignore(directory, names):
+            return [name for name in names if os.path.normcase(os.path.join(directory, name)) in excluded]
+        
+        def clone_counted(src, dst):
+            method = clone_file(src, dst)
+            methods[method] = methods.get(method, 0) + 1
+            self.advance_phase(os.lstat(dst).st_size)
+        
+        with self.phase('stage', "准备暂存目录", self.tree_size(self.current_dir)) as phase:
+            shutil.copytree(self.current_dir, self.stage_dir, symlinks=True, ignore=ignore, copy_function=clone_counted)
+            phase.details.update(methods)
+        return self.stage_dir
+
+    def discard_stage(self):
+        """丢弃暂存目录（暂存目录是独立副本，当前版本不受影响）"""
+        if os.path.exists(self.stage_dir):
+            shutil.rmtree(self.stage_dir, ignore_errors=True)
+
+    def commit_stage(self, version):
+        """把暂存目录落盘后切换为当前版本：原当前版本目录改名为备份，暂存目录改名为当前版本目录
+
+        两次改名都在同一文件系统内完成，与版本大小无关；中途中断时下次启动按安装日志自动恢复。
+        返回备份路径。
+        """
+        timestamp = int(time.time())
+        while os.path.exists(os.path.join(self.backup_dir, f"backup_{self.current_version}_{timestamp}")):
+            timestamp += 1
+        backup_path = os.path.join(self.backup_dir, f"backup_{self.current_version}_{timestamp}")
         
-        logging.info(f"已备份当前版本到: {backup_path}")
+        with self.phase('swap', "切换到新版本"):
+            # 原当前版本直接成为备份
+            self.swap_into_current(self.stage_dir, backup_path, version)
+        os.remove(self.install_journal)
+        logging.info(f"已切换到版本 {version}，原版本保留为备份: {backup_path}")
         
         # 清理旧备份
         self.cleanup_old_backups()
         
         return backup_path
 
-    def cleanup_old_backups(self, max_backups=10):
-        """清理旧的备份，只保留最近的几个版本"""
-        try:
-            # 获取所有备份目录
-            backups = []
-            for item in os.listdir(self.backup_dir):
-                item_path = os.path.join(self.backup_dir, item)
-                if os.path.isdir(item_path) and item.startswith('backup_'):
-                    # 获取备份时间戳
-                    timestamp = int(item.split('_')[-1])
-                    backups.append((timestamp, item_path))
-            
-            # 按时间戳排序
-            backups.sort(reverse=True)  # 最新的在前面
-            
-            # 如果备份数量超过限制，删除旧的备份
-            if len(backups) > max_backups:
-                for _, backup_path in backups[max_backups:]:
-                    try:
-                        shutil.rmtree(backup_path)
-                        self.print_log(f"已删除旧备份: {backup_path}")
-                    except Exception as e:
-                        logging.error(f"删除旧备份失败 {backup_path}: {str(e)}")
-                
-                remaining = len(backups) - len(backups[max_backups:])
-                self.print_log(f"已清理旧备份，当前保留 {remaining} 个最新备份")
+    def swap_into_current(self, source_dir, retired_path, version, discard=False):
+        """把 source_dir 落盘后切换为当前版本目录，原当前版本目录改名为 retired_path，并保存版本号
+
+        切换前写入安装日志（discard 为真表示 retired_path 在切换完成后删除），日志由调用方在收尾工作完成后删除；
+        任一步骤中断时，下次启动由 recover_interrupted_install 按日志回退到原版本或补完切换。
+        """
+        fsync_tree(source_dir)
+        with open(self.install_journal, 'w') as f:
+            json.dump({'version': version, 'backup': retired_path, 'stage': source_dir, 'discard': discard}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(self.current_dir, retired_path)
+        try:
+            os.rename(source_dir, self.current_dir)
+        except OSError:
+            os.rename(retired_path, self.current_dir)
+            os.remove(self.install_journal)
+            raise
+        fsync_path(os.path.dirname(self.current_dir))
+        fsync_path(os.path.dirname(retired_path))
+        self.current_version = version
+        self.save_current_version(version)
+
+    def recover_interrupted_install(self):
+        """上次切换目录时中断（断电、进程被终止）则恢复到一致状态"""
+        if not os.path.exists(self.install_journal):
+            return
+        try:
+            with open(self.install_journal, 'r') as f:
+                journal = json.load(f)
+            if not os.path.exists(self.current_dir) and os.path.exists(journal['backup']):
+                # 原当前版本已改名，新版本尚未就位：改回原版本
+                os.rename(journal['backup'], self.current_dir)
+                logging.warning("上次安装在切换目录时中断，已恢复原版本")
+            elif not os.path.exists(journal['stage']) and os.path.exists(journal['backup']):
+                # 切换已完成，补记版本号
+                self.save_current_version(journal['version'])
+                logging.warning(f"上次安装已切换到版本 {journal['version']}，补记版本号")
+                if journal.get('discard'):
+                    shutil.rmtree(journal['backup'], ignore_errors=True)
+            # 只删除暂存目录；回滚时直接改名的备份在切换前中断则原样保留
+            if journal['stage'] == self.stage_dir and os.path.exists(journal['stage']):
+                shutil.rmtree(journal['stage'], ignore_errors=True)
+            os.remove(self.install_journal)
+        except Exception as e:
+            logging.error(f"恢复中断的安装失败: {str(e)}")
+
+    def tree_size(self, directory):
+        """目录下全部文件的总大小（不跟随符号链接）"""
+        total = 0
+        for dirpath, _, filenames in os.walk(directory):
+            for filename in filenames:
+                total += os.lstat(os.path.join(dirpath, filename)).st_size
+        return total
+
+    def list_backups(self):
+        """列出全部备份，返回 [(时间戳, 版本号, 路径)]，最新的在前面"""
+        backups = []
+        for item in os.listdir(self.backup_dir):
+            item_path = os.path.join(self.backup_dir, item)
+            if os.path.isdir(item_path) and item.startswith('backup_'):
+                _, version, timestamp = item.rsplit('_', 2)
+                backups.append((int(timestamp), version, item_path))
+        backups.sort(reverse=True)
+        return backups
+
+    def cleanup_old_backups(self):
+        """压缩旧备份后按字节预算清理：最新的备份始终保留，从最旧的开始删除直到总占用不超过预算"""
+        try:
+            self.compact_backups()
+            backups = self.list_backups()
+            
+            # 与当前版本共享 inode 的文件（旧版本客户端建立的硬链接）不计入备份占用
+            seen = self.tree_inodes(self.current_dir)
+            used = 0
+            for index, (_, _, backup_path) in enumerate(backups):
+                used += self.backup_disk_usage(backup_path, seen)
+                if index > 0 and used > self.backup_budget:
+                    # 更早的备份都以较新的备份为基准，从这里开始全部删除不会破坏保留的备份
+                    for _, _, old_path in backups[index:]:
+                        try:
+                            shutil.rmtree(old_path)
+                            self.print_log(f"已删除旧备份: {old_path}")
+                        except Exception as e:
+                            logging.error(f"删除旧备份失败 {old_path}: {str(e)}")
+                    self.print_log(f"已清理旧备份，当前保留 {index} 个最新备份")
+                    break
             
         except Exception as e:
             logging.error(f"清理旧备份失败: {str(e)}")
 
+    def tree_inodes(self, directory):
+        """目录下全部文件的 (设备, inode) 集合"""
+        inodes = set()
+        for dirpath, _, filenames in os.walk(directory):
+            for filename in filenames:
+                stat_result = os.lstat(os.path.join(dirpath, filename))
+                inodes.add((stat_result.st_dev, stat_result.st_ino))
+        return inodes
+
+    def backup_disk_usage(self, backup_path, seen):
+        """备份实际占用的字节数：已计入 seen 的文件（硬链接到同一 inode）不重复计算"""
+        total = 0
+        for dirpath, _, filenames in os.walk(backup_path):
+            for filename in filenames:
+                stat_result = os.lstat(os.path.join(dirpath, filename))
+                key = (stat_result.st_dev, stat_result.st_ino)
+                if key not in seen:
+                    seen.add(key)
+                    total += stat_result.st_size
+        return total
+
+    def is_delta_backup(self, backup_path):
+        return os.path.exists(os.path.join(backup_path, REVERSE_DELTA_MANIFEST))
+
+    def compact_backups(self):
+        """把除最新备份以外的完整备份转换为相对下一个较新备份的反向差异
+
+        从最旧的开始转换，转换时作为基准的较新备份仍是完整目录。中断留下的临时目录在下次压缩时清理。
+        """
+        for item in os.listdir(self.backup_dir):
+            item_path = os.path.join(self.backup_dir, item)
+            if item.startswith('.') and item.endswith('.delta'):
+                shutil.rmtree(item_path, ignore_errors=True)
+            elif item.startswith('.') and item.endswith('.old'):
+                # 替换备份目录时中断：差异目录未就位则改回原备份
+                original = os.path.join(self.backup_dir, item[1:-len('.old')])
+                if os.path.exists(original):
+                    shutil.rmtree(item_path, ignore_errors=True)
+                else:
+                    os.rename(item_path, original)
+        backups = self.list_backups()
+        for index in range(len(backups) - 1, 0, -1):
+            backup_path = backups[index][2]
+            base_path = backups[index - 1][2]
+            if self.is_delta_backup(backup_path) or self.is_delta_backup(base_path):
+                continue
+            try:
+                self.encode_reverse_backup(backup_path, base_path)
+            except Exception as e:
+                logging.error(f"压缩备份失败 {backup_path}: {str(e)}")
+
+    def encode_reverse_backup(self, backup_path, base_path):
+        """把完整备份转换为相对 base_path 的反向差异：与基准相同的文件只记录摘要，其余文件保存差异或原文件
+
+        先写入临时目录，完成后替换原备份目录。
+        """
+        name = os.path.basename(backup_path)
+        delta_path = os.path.join(self.backup_dir, f".{name}.delta")
+        os.makedirs(delta_path)
+        manifest = {'base': os.path.basename(base_path), 'codec': self.backup_codec, 'files': {}, 'symlinks': {}}
+        original_size = self.tree_size(backup_path)
+        with self.phase('backup', "压缩旧备份", original_size, backup=name) as phase:
+            for dirpath, dirnames, filenames in os.walk(backup_path):
+                for filename in dirnames + filenames:
+                    file_path = os.path.join(dirpath, filename)
+                    rel_path = os.path.relpath(file_path, backup_path).replace(os.sep, '/')
+                    if os.path.islink(file_path):
+                        manifest['symlinks'][rel_path] = os.readlink(file_path)
+                        continue
+                    if filename in dirnames:
+                        continue
+                    base_file = os.path.join(base_path, *rel_path.split('/'))
+                    stat_result = os.stat(file_path)
+                    entry = {'mode': stat_result.st_mode & 0o7777, 'md5': self.calculate_md5_quiet(file_path)}
+                    stored_name = str(len(manifest['files']))
+                    stored_file = os.path.join(delta_path, stored_name)
+                    if os.path.isfile(base_file) and not os.path.islink(base_file):
+                        # 与基准相同（且权限相同，重建时直接克隆基准文件）只记录摘要
+                        if (os.stat(base_file).st_mode & 0o7777) == entry['mode'] and (
+                                os.path.samefile(base_file, file_path)
+                                or (os.path.getsize(base_file) == stat_result.st_size
+                                    and self.calculate_md5_quiet(base_file) == entry['md5'])):
+                            entry['kind'] = 'same'
+                        elif self.encode_reverse_file(base_file, file_path, stored_file) < stat_result.st_size:
+                            entry['kind'] = 'patch'
+                            entry['stored'] = stored_name
+                        else:
+                            os.remove(stored_file)
+                    if 'kind' not in entry:
+                        # 基准中没有对应文件或差异不比原文件小：保存原文件
+                        # 备份内部的文件不再被修改，可以硬链接
+                        clone_file(file_path, stored_file, allow_hardlink=True)
+                        entry['kind'] = 'file'
+                        entry['stored'] = stored_name
+                    manifest['files'][rel_path] = entry
+                    phase.advance(stat_result.st_size)
+            with open(os.path.join(delta_path, REVERSE_DELTA_MANIFEST), 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, ensure_ascii=False)
+            fsync_tree(delta_path)
+            phase.details['stored_bytes'] = self.tree_size(delta_path)
+        
+        # 替换原备份目录（中断时原备份或临时目录总有一个完整）
+        old_path = os.path.join(self.backup_dir, f".{name}.old")
+        os.rename(backup_path, old_path)
+        os.rename(delta_path, backup_path)
+        shutil.rmtree(old_path, ignore_errors=True)
+        logging.info(
+            f"已压缩备份 {name}: {original_size/1024/1024:.2f} MB -> {phase.details['stored_bytes']/1024/1024:.2f} MB"
+        )
+
+    def encode_reverse_file(self, base_file, target_file, patch_file):
+        """按窗口计算从 base_file 合成 target_file 的差异，写成分窗口差异文件，返回差异文件大小
+
+        每次只读取一个窗口及其对应的基准区间，内存占用只与窗口大小有关。
+        """
+        base_size = os.path.getsize(base_file)
+        target_size = os.path.getsize(target_file)
+        windows = plan_windows(base_size, target_size, self.backup_window_size)
+        encode = BACKUP_ENCODERS[self.backup_codec]
+        parts = []
+        with open(base_file, 'rb') as fbase, open(target_file, 'rb') as ftarget:
+            for base_offset, base_length, target_offset, target_length in windows:
+                fbase.seek(base_offset)
+                ftarget.seek(target_offset)
+                parts.append(encode(fbase.read(base_length), ftarget.read(target_length)))
+        with open(patch_file, 'wb') as f:
+            for data in [windowed_prefix(self.backup_codec, base_size, target_size, windows, parts)] + parts:
+                f.write(data)
+        return os.path.getsize(patch_file)
+
+    def materialize_backup(self, backup_path, dest_dir):
+        """在 dest_dir 中重建备份的完整目录：完整备份直接克隆，反向差异备份从最近的完整备份沿链依次合成"""
+        chain = [backup_path]
+        while self.is_delta_backup(chain[-1]):
+            with open(os.path.join(chain[-1], REVERSE_DELTA_MANIFEST), 'r', encoding='utf-8') as f:
+                base = json.load(f)['base']
+            base_path = os.path.join(self.backup_dir, base)
+            if not os.path.isdir(base_path):
+                raise FileNotFoundError(f"备份 {os.path.basename(chain[-1])} 的基准备份已不存在: {base}")
+            chain.append(base_path)
+        
+        # 从完整备份开始逐级合成，中间结果写入临时目录，用完即删
+        source = chain.pop()
+        intermediates = []
+        try:
+            if not chain:
+                shutil.copytree(source, dest_dir, symlinks=True, copy_function=clone_file)
+                return
+            while chain:
+                delta_path = chain.pop()
+                target = dest_dir if not chain else os.path.join(self.temp_dir, f"rebuild_{len(chain)}")
+                if target != dest_dir:
+                    if os.path.exists(target):
+                        shutil.rmtree(target)
+                    intermediates.append(target)
+                self.apply_reverse_backup(source, delta_path, target)
+                source = target
+        finally:
+            for intermediate in intermediates:
+                shutil.rmtree(intermediate, ignore_errors=True)
+
+    def apply_reverse_backup(self, base_dir, delta_path, dest_dir):
+        """按反向差异清单由 base_dir 合成一级备份到 dest_dir，每个文件按记录的 MD5 校验"""
+        with open(os.path.join(delta_path, REVERSE_DELTA_MANIFEST), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        os.makedirs(dest_dir)
+        for rel_path, entry in manifest['files'].items():
+            dest_file = os.path.join(dest_dir, *rel_path.split('/'))
+            base_file = os.path.join(base_dir, *rel_path.split('/'))
+            os.makedirs(os.path.dirname(dest_file), exist_ok=True)
+            if entry['kind'] == 'same':
+                clone_file(base_file, dest_file)
+            elif entry['kind'] == 'file':
+                clone_file(os.path.join(delta_path, entry['stored']), dest_file)
+            else:
+                hasher = hashlib.md5()
+                self.apply_windowed_patch(base_file, dest_file, os.path.join(delta_path, entry['stored']), hasher)
+                if hasher.hexdigest() != entry['md5']:
+                    raise ValueError(f"备份文件合成结果MD5不一致: {rel_path}")
+                os.chmod(dest_file, entry['mode'])
+            self.advance_phase(os.path.getsize(dest_file))
+        for rel_path, link_target in manifest['symlinks'].items():
+            link_path = os.path.join(dest_dir, *rel_path.split('/'))
+            os.makedirs(os.path.dirname(link_path), exist_ok=True)
+            os.symlink(link_target, link_path)
+
+    def backup_is_base(self, backup_path):
+        """是否有反向差异备份以该备份为基准"""
+        name = os.path.basename(backup_path)
+        for _, _, path in self.list_backups():
+            if self.is_delta_backup(path):
+                with open(os.path.join(path, REVERSE_DELTA_MANIFEST), 'r', encoding='utf-8') as f:
+                    if json.load(f)['base'] == name:
+                        return True
+        return False
+
     def restore_from_backup(self, backup_path):
-        """从备份恢复"""
+        """回滚到备份并切换为当前版本，被替换的当前版本丢弃（版本文件移入缓存）
+
+        没有其他备份以它为基准的完整备份直接改名为当前版本目录，不复制数据；其余情况在暂存目录中重建备份
+        （完整备份用 reflink 或复制，反向差异备份按需合成），备份本身保留，仍作为更早备份的基准。
+        切换与安装一样写入安装日志，中途中断时下次启动自动恢复。
+        """
         try:
-            for file in os.listdir(backup_path):
-                shutil.copy2(
-                    os.path.join(backup_path, file),
-                    os.path.join(self.current_dir, file)
-                )
-            logging.info("已从备份恢复")
+            version = os.path.basename(backup_path).rsplit('_', 2)[1]
+            discarded = os.path.join(self.temp_dir, f"rollback_{int(time.time())}")
+            self.discard_stage()
+            with self.phase('restore', "回滚到备份", version=version) as phase:
+                if self.is_delta_backup(backup_path) or self.backup_is_base(backup_path):
+                    self.materialize_backup(backup_path, self.stage_dir)
+                    source_dir = self.stage_dir
+                else:
+                    source_dir = backup_path
+                phase.details['renamed'] = source_dir == backup_path
+                replaced_version = self.current_version
+                self.swap_into_current(source_dir, discarded, version, discard=True)
+            # 被替换的版本文件移入缓存，之后可不经网络重新安装
+            replaced_file = os.path.join(discarded, APP_NAME)
+            if os.path.isfile(replaced_file):
+                try:
+                    self.cache.add(
+                        replaced_file, self.calculate_md5_quiet(replaced_file), 'version', move=True,
+                        version=replaced_version
+                    )
+                except Exception as e:
+                    logging.warning(f"缓存被替换的版本失败: {str(e)}")
+            shutil.rmtree(discarded, ignore_errors=True)
+            os.remove(self.install_journal)
+            logging.info(f"已回滚到备份: {backup_path}")
+            self.print_log(f"已回滚到版本: {version}")
             return True
         except Exception as e:
+            self.discard_stage()
             logging.error(f"恢复备份失败: {str(e)}")
             self.print_log(f"警告: 恢复备份失败: {str(e)}")
             return False
 
+    def local_version_sources(self):
+        """本地持有的单文件版本：版本号 -> (来源, 路径)，来源为 current、cache 或 backup，同一版本优先直接可用的文件"""
+        sources = {}
+        current_file = os.path.join(self.current_dir, APP_NAME)
+        if os.path.exists(current_file):
+            sources[self.current_version] = ('current', current_file)
+        for version, path in self.cache.versions().items():
+            sources.setdefault(version, ('cache', path))
+        for _, version, backup_path in self.list_backups():
+            if self.is_delta_backup(backup_path):
+                with open(os.path.join(backup_path, REVERSE_DELTA_MANIFEST), 'r', encoding='utf-8') as f:
+                    if APP_NAME not in json.load(f)['files']:
+                        continue
+            elif not os.path.exists(os.path.join(backup_path, APP_NAME)):
+                continue
+            sources.setdefault(version, ('backup', backup_path))
+        return sources
+
+    def materialize_version(self, version):
+        """取得本地持有版本的文件，返回 (文件路径, 用完后需删除的临时目录或 None)；反向差异备份在临时目录中合成"""
+        source, path = self.local_version_sources()[version]
+        if source != 'backup':
+            return path, None
+        if not self.is_delta_backup(path):
+            return os.path.join(path, APP_NAME), None
+        rebuild_dir = os.path.join(self.temp_dir, f"base_{version}")
+        if os.path.exists(rebuild_dir):
+            shutil.rmtree(rebuild_dir)
+        with self.phase('restore', f"重建本地版本 {version}", version=version):
+            self.materialize_backup(path, rebuild_dir)
+        return os.path.join(rebuild_dir, APP_NAME), rebuild_dir
+
+    def install_local_version(self, version, algorithm=None, expected=None):
+        """不连接服务器安装本地持有的版本：放入暂存目录后切换，当前版本保留为备份，返回是否成功
+
+        提供期望摘要时先校验；缓存中的版本按 MD5 寻址，始终校验。
+        """
+        try:
+            source, path = self.local_version_sources()[version]
+            if source == 'cache' and algorithm is None:
+                algorithm, expected = 'md5', os.path.basename(path)
+            file_path, rebuild_dir = self.materialize_version(version)
+            try:
+                if algorithm is not None:
+                    with self.phase('verify', f"校验本地版本 {version}", os.path.getsize(file_path),
+                                    algorithm=algorithm) as phase:
+                        if self.get_file_digest(file_path, algorithm) != expected:
+                            phase.fail(f"{algorithm} 不一致")
+                    if not phase.ok:
+                        logging.error(f"本地版本 {version} 校验失败（{source}）")
+                        return False
+                stage = self.stage_current_version(exclude=[APP_NAME])
+                clone_file(file_path, os.path.join(stage, APP_NAME))
+            finally:
+                if rebuild_dir:
+                    shutil.rmtree(rebuild_dir, ignore_errors=True)
+            self.commit_stage(version)
+            self.print_log(f"已从本地{'缓存' if source == 'cache' else '备份'}安装版本: {version}")
+            return True
+        except Exception as e:
+            self.discard_stage()
+            logging.error(f"安装本地版本 {version} 失败: {str(e)}")
+            self.print_log(f"安装本地版本失败: {str(e)}")
+            return False
+
+    def install_held_target(self, version_info):
+        """本地已持有目标版本时直接安装（校验服务器下发的摘要），返回是否已安装"""
+        latest_version = version_info['latest_version']
+        if latest_version == self.current_version or latest_version not in self.local_version_sources():
+            return False
+        self.print_log(f"本地已有版本 {latest_version}，无需下载")
+        self.note_method('local')
+        algorithm, expected = self.expected_digest(version_info['versions'][latest_version])
+        return self.install_local_version(latest_version, algorithm, expected)
+
+    def rollback_to(self, version):
+        """回滚（或切换）到本地持有的指定版本，不需要连接服务器，返回是否成功"""
+        if version == self.current_version:
+            return True
+        if version not in self.local_version_sources():
+            self.print_log(f"本地没有版本 {version}")
+            return False
+        return self.install_local_version(version)
+
+    def cached_patch(self, step):
+        """缓存中已有的差异文件路径（按 MD5 寻址），没有时返回 None"""
+        path = self.cache.get(step['md5'])
+        if path:
+            self.print_log(f"使用本地缓存的差异文件: {step['patch_file']}")
+        return path
+
+    def cache_patches(self, steps, patch_paths):
+        """把应用成功的差异文件移入本地缓存"""
+        for step, (patch_path, _) in zip(steps, patch_paths):
+            try:
+                self.cache.add(patch_path, step['md5'], 'patch', move=True, name=step['patch_file'])
+            except Exception as e:
+                logging.warning(f"缓存差异文件失败 {step['patch_file']}: {str(e)}")
+
+    def rollback(self):
+        """回滚到最近的备份（不需要连接服务器），返回是否成功"""
+        backups = self.list_backups()
+        if not backups:
+            self.print_log("没有可用的备份")
+            return False
+        return self.restore_from_backup(backups[0][2])
+
     def version_compare(self, v1, v2):
         """比较两个版本号"""
         def parse_version(v):
@@ -174,70 +1147,483 @@ class UpdateClient:
         try:
             current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             self.print_log(f"正在检查更新，连接地址: {self.server_url}")
-            response = requests.get(f"{self.server_url}/check_update")
-            version_info = response.json()
-            
-            self.print_log(f"当前版本: {self.current_version}")
-            
-            # 格式化显示服务器返回信息
-            latest_version = version_info['latest_version']
-            latest_desc = version_info['versions'][latest_version].get('description', '无')
-            self.print_log(f"服务器版本信息:")
-            self.print_log(f"最新版本: {latest_version}")
-            self.print_log(f"更新说明: {latest_desc}")
-            
-            if self.version_compare(latest_version, self.current_version):
-                self.print_log(f"发现新版本: {latest_version}")
-                return version_info
-            else:
-                self.print_log(f"当前已是最新版本")
-                return None
+            # 每次检查更新开始一次新的更新尝试追踪
+            self.trace = UpdateTrace(self.current_version, self.server_url)
+            with self.phase('check', "检查更新") as phase:
+                # 附带当前版本和上次的 ETag，未变化时服务器返回 304
+                headers = {}
+                if self.check_update_etag and self.check_update_cache is not None:
+                    headers['If-None-Match'] = self.check_update_etag
+                response = self.session.get(
+                    f"{self.server_url}/check_update",
+                    params={'current_version': self.current_version},
+                    headers={'Accept-Encoding': 'gzip', **headers},
+                    timeout=10
+                )
+                phase.details['status'] = response.status_code
+                phase.advance(len(response.content))
+                if response.status_code == 304:
+                    version_info = self.check_update_cache
+                else:
+                    response.raise_for_status()
+                    version_info = response.json()
+                    self.check_update_etag = response.headers.get('ETag')
+                    self.check_update_cache = version_info
+            return self.evaluate_version_info(version_info)
             
         except Exception as e:
             current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             self.print_log(f"检查更新失败: {str(e)}")
             return None
 
-    def download_with_resume(self, url, local_file, desc="下载文件"):
-        """支持断点续传的下载"""
-        temp_file = os.path.join(self.temp_dir, os.path.basename(local_file) + '.temp')
+    def evaluate_version_info(self, version_info):
+        """显示服务器返回的版本信息，有新版本时返回版本信息，否则返回 None"""
+        self.print_log(f"当前版本: {self.current_version}")
+        
+        # 格式化显示服务器返回信息
+        latest_version = version_info['latest_version']
+        latest_desc = version_info['versions'][latest_version].get('description', '无')
+        self.print_log(f"服务器版本信息:")
+        self.print_log(f"最新版本: {latest_version}")
+        self.print_log(f"更新说明: {latest_desc}")
         
-        # 获取已下载的文件大小
+        if self.version_compare(latest_version, self.current_version):
+            self.print_log(f"发现新版本: {latest_version}")
+            return version_info
+        else:
+            self.print_log(f"当前已是最新版本")
+            return None
+
+    def download_with_resume(self, url, local_file, desc="下载文件", hasher=None, verifier=None, encoding=None):
+        """支持断点续传的下载，大文件且服务器支持 Range 时使用多连接分段下载
+
+        提供 hasher 时在写入过程中按文件顺序计算摘要，下载完成后无需再次读取文件；
+        提供 verifier（块哈希清单）时逐块校验，只重新下载损坏的块，续传前先校验已下载的部分。
+        指定 encoding 时请求该预压缩版本并边下载边解压（需顺序解压，只使用单连接），
+        此时 verifier 对应压缩后的数据，hasher 计算解压后的数据。
+        """
+        with self.phase('download', desc, url=url, encoding=encoding) as phase:
+            result = None
+            if self.download_segments > 1 and encoding is None:
+                result = self.download_segmented(url, local_file, desc, hasher, verifier)
+                phase.details['segmented'] = result is not None
+            if result is None:
+                result = self.download_stream(url, local_file, desc, hasher, verifier, encoding)
+            if not result:
+                phase.fail("下载未完成")
+            return result
+
+    def choose_encoding(self, version_data):
+        """从版本信息的预压缩版本中选择本地可解压的最小版本，没有时返回 (None, None)"""
+        encodings = {
+            name: info for name, info in version_data.get('encodings', {}).items()
+            if name in DECOMPRESSORS
+        }
+        if not encodings:
+            return None, None
+        name = min(encodings, key=lambda name: encodings[name]['size'])
+        return name, encodings[name]
+
+    def decode_prefix(self, temp_file, out_file, decoder, hasher):
+        """续传预压缩版本时重新解压已下载的部分，重建解压输出并补算摘要"""
+        with open(temp_file, 'rb') as fsrc, open(out_file, 'wb') as fdst:
+            for chunk in iter(lambda: fsrc.read(1024 * 1024), b""):
+                data = decoder.decompress(chunk)
+                fdst.write(data)
+                if hasher is not None:
+                    hasher.update(data)
+
+    def get_download_url(self):
+        """下载文件使用的服务地址：优先使用零拷贝下载服务，无法连接时使用主服务"""
+        if self.download_url is None:
+            self.download_url = self.server_url
+            if DOWNLOAD_URL:
+                try:
+                    self.session.head(f"{DOWNLOAD_URL}/download_patch/0/0", timeout=3)
+                    self.download_url = DOWNLOAD_URL
+                except requests.RequestException as e:
+                    logging.warning(f"无法连接下载服务，使用主服务下载: {str(e)}")
+        return self.download_url
+
+    def fetch_block_verifier(self, blocks, total_size):
+        """下载块哈希清单并用版本信息中的 Merkle 根校验，不可用时返回 None（只做整体摘要校验）"""
+        if not blocks or total_size is None:
+            return None
+        try:
+            response = self.session.get(f"{self.server_url}/block_hashes/{blocks['file']}", timeout=30)
+            response.raise_for_status()
+            return self.build_block_verifier(blocks, total_size, response.json()['blocks'])
+        except Exception as e:
+            logging.warning(f"获取块哈希清单失败: {str(e)}")
+            return None
+
+    def build_block_verifier(self, blocks, total_size, leaves):
+        """用版本信息中的 Merkle 根和文件大小核对下载的块哈希清单，不一致时返回 None"""
+        if merkle_root(leaves) != blocks['root']:
+            logging.warning(f"块哈希清单与 Merkle 根不一致: {blocks['file']}")
+            return None
+        if len(leaves) != max(-(-total_size // blocks['block_size']), 1):
+            logging.warning(f"块哈希清单的块数与文件大小不符: {blocks['file']}")
+            return None
+        return BlockVerifier(blocks['block_size'], leaves, total_size)
+
+    def block_range_headers(self, offset, length, etag, encoding=None):
+        """重新下载单个块的请求头（encoding 为预压缩版本时请求同一个压缩版本的区间）"""
+        headers = {'Range': f'bytes={offset}-{offset + length - 1}'}
+        if etag:
+            headers['If-Range'] = etag
+        if encoding:
+            headers['Accept-Encoding'] = encoding
+        return headers
+
+    def iter_verified_blocks(self, chunks, offset, verifier, url, etag, encoding=None):
+        """把响应数据整理为 (偏移, 数据)；有块哈希清单时按块对齐逐块校验，损坏的块单独重新下载
+
+        响应提前结束时最后返回未校验的剩余部分，续传前会重新校验。
+        """
+        if verifier is None:
+            for chunk in chunks:
+                if chunk:
+                    yield offset, chunk
+                    offset += len(chunk)
+            return
+        buffer = bytearray()
+        for chunk in chunks:
+            buffer += chunk
+            for block_offset, data in verifier.split_blocks(buffer, offset):
+                if not verifier.check(block_offset, data):
+                    data = self.refetch_block(url, etag, verifier, block_offset, len(data), encoding)
+                yield block_offset, data
+                offset = block_offset + len(data)
+        if buffer:
+            yield offset, bytes(buffer)
+
+    def refetch_block(self, url, etag, verifier, offset, length, encoding=None):
+        """重新下载校验失败的块"""
+        logging.warning(f"块校验失败，重新下载: {url} 偏移 {offset}")
+        for _ in range(BLOCK_RETRIES):
+            headers = self.block_range_headers(offset, length, etag, encoding)
+            response = self.session.get(url, headers=headers, timeout=30)
+            if response.status_code == 206 and verifier.check(offset, response.content):
+                return response.content
+        raise IOError(f"块多次校验失败: 偏移 {offset}")
+
+    def download_stream(self, url, local_file, desc="下载文件", hasher=None, verifier=None, encoding=None):
+        """单连接顺序下载，支持断点续传；指定 encoding 时临时文件保存压缩数据，边下载边解压"""
+        temp_file, etag_file, out_file = self.stream_temp_files(local_file, encoding)
+        headers, resume_size = self.resume_headers(temp_file, etag_file, verifier, encoding)
+        
+        with self.session.get(url, stream=True, headers=headers) as response:
+            restart = self.resume_mismatch(response.status_code, response.headers, resume_size, encoding)
+            if not restart:
+                response.raise_for_status()
+                total_size, resume_size, verifier, decoder = self.begin_stream(
+                    response.status_code, response.headers, temp_file, etag_file, out_file,
+                    resume_size, hasher, verifier, encoding
+                )
+                if encoding:
+                    # 按原样读取压缩数据，由 decoder 解压
+                    chunks = response.raw.stream(READ_CHUNK_SIZE, decode_content=False)
+                else:
+                    chunks = response.iter_content(chunk_size=READ_CHUNK_SIZE)
+                etag = response.headers.get('ETag')
+                content_encoding = encoding if decoder is not None else None
+                with self.stream_writer(temp_file, out_file, desc, total_size, resume_size, decoder, hasher) as write:
+                    for _, data in self.iter_verified_blocks(chunks, resume_size, verifier, url, etag, content_encoding):
+                        write(data)
+        
+        if restart:
+            # 本地临时文件与服务器文件不一致，丢弃后重新下载
+            logging.warning(f"续传位置无效，重新下载: {url}")
+            os.remove(temp_file)
+            return self.download_stream(url, local_file, desc, hasher, verifier, encoding)
+        return self.finish_stream(url, local_file, temp_file, etag_file, out_file, total_size, decoder)
+
+    def stream_temp_files(self, local_file, encoding=None):
+        """单连接下载的临时文件（收到的原始数据）、ETag 记录和解压输出文件的路径"""
+        suffix = f'.{encoding}.temp' if encoding else '.temp'
+        temp_file = os.path.join(self.temp_dir, os.path.basename(local_file) + suffix)
+        return temp_file, temp_file + '.etag', temp_file + '.out'
+
+    def resume_headers(self, temp_file, etag_file, verifier=None, encoding=None):
+        """单连接下载的请求头：续传前校验并截断已下载的部分，用 If-Range 保证续传的仍是同一个文件
+
+        返回 (请求头, 已下载大小)。
+        """
+        headers = {'Accept-Encoding': encoding} if encoding else {}
+        resume_size = 0
         if os.path.exists(temp_file):
             resume_size = os.path.getsize(temp_file)
-            headers = {'Range': f'bytes={resume_size}-'}
-        else:
+            if verifier is not None and resume_size > 0:
+                # 续传前校验已下载的部分，从第一个损坏或不完整的块重新下载
+                valid_size = verifier.valid_prefix(temp_file, 0, min(resume_size, verifier.total_size))
+                if valid_size < resume_size:
+                    logging.warning(f"临时文件从 {valid_size} 字节处开始无效，截断后续传")
+                    with open(temp_file, 'r+b') as f:
+                        f.truncate(valid_size)
+                    resume_size = valid_size
+            if resume_size > 0:
+                headers['Range'] = f'bytes={resume_size}-'
+                if os.path.exists(etag_file):
+                    with open(etag_file, 'r') as f:
+                        headers['If-Range'] = f.read().strip()
+        return headers, resume_size
+
+    def resume_mismatch(self, status_code, headers, resume_size, encoding=None):
+        """续传是否无效（需丢弃临时文件重新下载）
+
+        服务器拒绝了续传区间（416）、返回的续传位置与本地临时文件不一致，或续传预压缩版本时返回了原文件的区间。
+        """
+        if status_code == 416:
+            return True
+        if status_code == 206:
+            content_range = headers.get('Content-Range', '')
+            if int(content_range.split(' ')[-1].split('-')[0]) != resume_size:
+                logging.warning(f"服务器返回的续传位置不匹配: {content_range}")
+                return True
+            if encoding and headers.get('Content-Encoding') != encoding:
+                logging.warning(f"服务器未返回预压缩版本 {encoding} 的区间")
+                return True
+        return False
+
+    def begin_stream(self, status_code, headers, temp_file, etag_file, out_file, resume_size, hasher, verifier,
+                     encoding):
+        """收到响应头后准备写入：确定总大小、记录 ETag、选择解压器，续传时补算已下载部分的摘要
+
+        返回 (总大小, 续传位置, 块校验器, 解压器)；服务器忽略了 Range 时续传位置为 0。
+        """
+        if status_code != 206 and resume_size > 0:
+            # 服务器忽略了 Range（文件已变化或不支持续传），从头下载
+            self.print_log("服务器未接受断点续传，重新下载完整文件")
             resume_size = 0
-            headers = {}
-        
-        # 发起请求
-        response = requests.get(url, stream=True, headers=headers)
         
         # 获取文件总大小
-        if 'Content-Range' in response.headers:
-            total_size = int(response.headers['Content-Range'].split('/')[-1])
+        if 'Content-Range' in headers:
+            total_size = int(headers['Content-Range'].split('/')[-1])
         else:
-            total_size = int(response.headers.get('content-length', 0))
+            total_size = int(headers.get('content-length', 0))
+        if verifier is not None and verifier.total_size != total_size:
+            logging.warning("块哈希清单与服务器文件大小不符，只做整体校验")
+            verifier = None
+        if self.current_phase is not None:
+            self.current_phase.set_total(total_size, resume_size)
+        
+        # 记录 ETag 以便下次续传时校验
+        if headers.get('ETag'):
+            with open(etag_file, 'w') as f:
+                f.write(headers['ETag'])
+        
+        # 服务器返回了请求的压缩编码时边下载边解压，压缩数据写入临时文件，解压数据写入输出文件
+        decoder = None
+        if encoding and headers.get('Content-Encoding') == encoding:
+            decoder = DECOMPRESSORS[encoding]()
+        elif os.path.exists(out_file):
+            os.remove(out_file)
         
-        # 创建或追加模式打开文件
+        # 续传时先补算已下载部分的摘要（压缩数据需重新解压）
+        if decoder is not None and resume_size > 0:
+            self.decode_prefix(temp_file, out_file, decoder, hasher)
+        elif hasher is not None and resume_size > 0:
+            self.hash_file_prefix(temp_file, hasher)
+        return total_size, resume_size, verifier, decoder
+
+    def hash_file_prefix(self, file_path, hasher):
+        """把已下载的临时文件内容补算进摘要"""
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                hasher.update(chunk)
+
+    @contextmanager
+    def stream_writer(self, temp_file, out_file, desc, total_size, resume_size, decoder, hasher):
+        """打开临时文件（续传时追加）和进度条，产出写入函数
+
+        写入函数写入一块已校验的数据并更新进度，需要时解压到输出文件，摘要按解压后的数据计算。
+        """
         mode = 'ab' if resume_size > 0 else 'wb'
-        with open(temp_file, mode) as f:
-            with tqdm(
-                total=total_size,
-                initial=resume_size,
-                unit='B',
-                unit_scale=True,
-                desc=desc
-            ) as pbar:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
-                        pbar.update(len(chunk))
+        with open(temp_file, mode) as f, open(out_file if decoder is not None else os.devnull, mode) as out, \
+                tqdm(total=total_size, initial=resume_size, unit='B', unit_scale=True, desc=desc) as pbar:
+            def write(data):
+                f.write(data)
+                pbar.update(len(data))
+                self.advance_phase(len(data))
+                if decoder is not None:
+                    data = decoder.decompress(data)
+                    out.write(data)
+                if hasher is not None:
+                    hasher.update(data)
+            
+            yield write
+
+    def finish_stream(self, url, local_file, temp_file, etag_file, out_file, total_size, decoder):
+        """检查单连接下载是否完整，完整时移动到最终位置；不完整时保留临时文件，下次继续续传"""
+        if total_size and os.path.getsize(temp_file) != total_size:
+            logging.error(f"下载不完整: {os.path.getsize(temp_file)}/{total_size}")
+            return False
+        if decoder is not None and not decoder.eof:
+            logging.error(f"压缩数据不完整: {url}")
+            os.remove(temp_file)
+            os.remove(out_file)
+            return False
+        
+        if decoder is not None:
+            shutil.move(out_file, local_file)
+            os.remove(temp_file)
+        else:
+            shutil.move(temp_file, local_file)
+            if os.path.exists(out_file):
+                os.remove(out_file)
+        if os.path.exists(etag_file):
+            os.remove(etag_file)
+        return True
+
+    def download_segmented(self, url, local_file, desc="下载文件", hasher=None, verifier=None):
+        """多连接分段下载：按字节区间并发拉取并写入预分配文件，每段进度记录在日志文件中以便续传
+
+        文件过小或服务器不支持 Range 时返回 None，由调用方改用单连接下载。
+        """
+        head = self.session.head(url, timeout=10)
+        target = self.segmented_target(head.status_code, head.headers, verifier)
+        if target is None:
+            return None
+        total_size, etag, verifier = target
+        temp_file, journal_file, journal, verifier = self.prepare_segments(url, local_file, total_size, etag, verifier)
+        
+        lock = threading.Lock()
+        downloaded = sum(seg['pos'] - seg['start'] for seg in journal['segments'])
+        sequential = SequentialHasher(hasher, temp_file, journal['segments'])
+        
+        # 续传时先补算第一段已下载的部分
+        sequential.catch_up()
+        if self.current_phase is not None:
+            self.current_phase.set_total(total_size, downloaded)
+        
+        with tqdm(total=total_size, initial=downloaded, unit='B', unit_scale=True, desc=desc) as pbar:
+            def fetch_segment(segment):
+                if segment['pos'] > segment['end']:
+                    return
+                headers = self.segment_headers(segment, etag)
+                with self.session.get(url, stream=True, headers=headers, timeout=30) as response:
+                    if response.status_code != 206:
+                        raise IOError(f"分段请求未返回 206: HTTP {response.status_code}")
+                    with open(temp_file, 'r+b') as f:
+                        f.seek(segment['pos'])
+                        position = segment['pos']
+                        chunks = response.iter_content(chunk_size=READ_CHUNK_SIZE)
+                        for _, chunk in self.iter_verified_blocks(chunks, position, verifier, url, etag):
+                            f.write(chunk)
+                            self.advance_phase(len(chunk))
+                            with lock:
+                                pbar.update(len(chunk))
+                                sequential.feed(position, chunk)
+                            position += len(chunk)
+                            # 每写入 JOURNAL_INTERVAL 落盘并刷新日志，日志只记录已落盘的位置
+                            if position - segment['pos'] >= JOURNAL_INTERVAL:
+                                f.flush()
+                                with lock:
+                                    segment['pos'] = position
+                                    self.save_download_journal(journal_file, journal)
+                                    sequential.catch_up()
+                        f.flush()
+                        with lock:
+                            segment['pos'] = position
+                            sequential.catch_up()
+                if segment['pos'] <= segment['end']:
+                    raise IOError(f"分段下载不完整: {segment['pos']}/{segment['end'] + 1}")
+            
+            try:
+                with ThreadPoolExecutor(max_workers=len(journal['segments'])) as executor:
+                    for future in [executor.submit(fetch_segment, seg) for seg in journal['segments']]:
+                        future.result()
+            except Exception as e:
+                logging.error(f"分段下载失败: {str(e)}")
+                with lock:
+                    self.save_download_journal(journal_file, journal)
+                return False
         
-        # 下载完成后移动到最终位置
+        sequential.catch_up()
         shutil.move(temp_file, local_file)
+        os.remove(journal_file)
         return True
 
+    def segmented_target(self, status_code, headers, verifier):
+        """根据 HEAD 响应判断能否分段下载：不能时返回 None，否则返回 (总大小, ETag, 块校验器)"""
+        if status_code != 200 or headers.get('Accept-Ranges') != 'bytes':
+            return None
+        total_size = int(headers.get('Content-Length', 0))
+        if total_size < self.min_segment_size * 2:
+            return None
+        if verifier is not None and verifier.total_size != total_size:
+            logging.warning("块哈希清单与服务器文件大小不符，只做整体校验")
+            verifier = None
+        return total_size, headers.get('ETag'), verifier
+
+    def prepare_segments(self, url, local_file, total_size, etag, verifier):
+        """加载分段下载日志并逐段校验已落盘的数据；没有可续传的日志时预分配临时文件并切分区间
+
+        返回 (临时文件, 日志文件, 下载日志, 块校验器)；续传的分段未按块对齐时不再逐块校验。
+        """
+        temp_file = os.path.join(self.temp_dir, os.path.basename(local_file) + '.temp')
+        journal_file = temp_file + '.journal'
+        journal = self.load_download_journal(journal_file, url, etag, total_size, temp_file)
+        if journal is not None and verifier is not None:
+            if any(seg['start'] % verifier.block_size for seg in journal['segments']):
+                verifier = None
+            else:
+                # 续传前逐段校验已落盘的数据，从第一个损坏的块重新下载
+                for seg in journal['segments']:
+                    valid_pos = verifier.valid_prefix(temp_file, seg['start'], seg['pos'])
+                    if valid_pos < seg['pos']:
+                        logging.warning(f"分段 {seg['start']} 从 {valid_pos} 字节处开始无效，重新下载")
+                        seg['pos'] = valid_pos
+        if journal is None:
+            # 新建下载：预分配文件并按分段数切分区间（有块哈希清单时按块对齐）
+            segment_count = min(self.download_segments, total_size // self.min_segment_size)
+            segment_size = -(-total_size // segment_count)
+            if verifier is not None:
+                segment_size = -(-segment_size // verifier.block_size) * verifier.block_size
+            journal = {
+                'url': url,
+                'etag': etag,
+                'size': total_size,
+                'segments': [
+                    {'start': start, 'end': min(start + segment_size, total_size) - 1, 'pos': start}
+                    for start in range(0, total_size, segment_size)
+                ]
+            }
+            with open(temp_file, 'wb') as f:
+                f.truncate(total_size)
+            self.save_download_journal(journal_file, journal)
+        return temp_file, journal_file, journal, verifier
+
+    def segment_headers(self, segment, etag):
+        """分段请求的请求头：从该段已落盘的位置请求到段尾"""
+        headers = {'Range': f"bytes={segment['pos']}-{segment['end']}"}
+        if etag:
+            headers['If-Range'] = etag
+        return headers
+
+    def load_download_journal(self, journal_file, url, etag, total_size, temp_file):
+        """加载分段下载日志，文件已变化或临时文件不匹配时返回 None"""
+        if not os.path.exists(journal_file):
+            return None
+        try:
+            with open(journal_file, 'r') as f:
+                journal = json.load(f)
+            if (journal['url'] == url and journal['etag'] == etag and journal['size'] == total_size
+                    and os.path.exists(temp_file) and os.path.getsize(temp_file) == total_size):
+                self.print_log("从上次中断的位置继续分段下载")
+                return journal
+        except Exception as e:
+            logging.warning(f"读取分段下载日志失败: {str(e)}")
+        os.remove(journal_file)
+        return None
+
+    def save_download_journal(self, journal_file, journal):
+        """原子写入分段下载日志"""
+        with open(journal_file + '.tmp', 'w') as f:
+            json.dump(journal, f)
+        os.replace(journal_file + '.tmp', journal_file)
+
     def check_app_running(self):
         """检查应用是否在运行"""
         if SYSTEM_TYPE == 'Darwin':  # Mac系统
@@ -268,8 +1654,75 @@ class UpdateClient:
             logging.error(f"关闭应用失败: {str(e)}")
             return False
 
+    def fetch_update_plan(self, target_version):
+        """向服务器请求从当前版本到目标版本的更新路径规划"""
+        try:
+            with self.phase('plan', "规划更新路径") as phase:
+                response = self.session.get(
+                    f"{self.server_url}/update_plan", params=self.plan_params(target_version), timeout=10
+                )
+                if response.status_code != 200:
+                    logging.warning(f"获取更新路径失败: HTTP {response.status_code}")
+                    phase.fail(f"HTTP {response.status_code}")
+                    return None
+                plan = response.json()
+                phase.details.update(method=plan['method'], steps=len(plan['steps']), total_size=plan['total_size'])
+                return plan
+        except Exception as e:
+            logging.warning(f"获取更新路径失败: {str(e)}")
+            return None
+
+    def plan_params(self, target_version):
+        """更新路径规划的请求参数：附带本地持有的其他版本，服务器从中选择最省流量的基准"""
+        params = {'current_version': self.current_version, 'target_version': target_version}
+        held = [version for version in self.local_version_sources() if version != self.current_version]
+        if held:
+            params['held_versions'] = ','.join(held)
+        return params
+
+    def wait_for_patch_plan(self, target_version):
+        """等待服务器按需生成差异文件，生成完成后重新请求更新路径；超时或生成失败时返回 None"""
+        with self.phase('plan_wait', "等待服务器生成差异文件") as phase:
+            url = f"{self.get_download_url()}/download_patch/{self.current_version}/{target_version}"
+            deadline = time.monotonic() + self.patch_wait_seconds
+            self.print_log("服务器正在生成从当前版本出发的差异文件，等待生成完成...")
+            while time.monotonic() < deadline:
+                try:
+                    response = self.session.head(url, allow_redirects=True, timeout=10)
+                except Exception as e:
+                    logging.warning(f"查询差异文件生成状态失败: {str(e)}")
+                    phase.fail(str(e))
+                    return None
+                if response.status_code == 200:
+                    plan = self.fetch_update_plan(target_version)
+                    if plan is None or plan['method'] == 'patch' or not plan.get('on_demand'):
+                        return plan
+                    # 差异文件已生成但服务器的版本配置快照尚未更新
+                    retry_after = 1
+                elif response.status_code == 202:
+                    retry_after = float(response.headers.get('Retry-After', 5))
+                else:
+                    logging.warning(f"差异文件生成失败: HTTP {response.status_code}")
+                    phase.fail(f"HTTP {response.status_code}")
+                    return None
+                time.sleep(max(min(retry_after, deadline - time.monotonic()), 0))
+            self.print_log("等待差异文件生成超时")
+            phase.fail("等待超时")
+            return None
+
     def download_update(self, version_info):
-        """下载并应用更新"""
+        """下载并应用更新，整个过程记录为一次更新尝试的追踪（结束后导出到 logs/traces/）"""
+        trace = self.begin_trace()
+        trace.to_version = version_info['latest_version']
+        success = False
+        try:
+            success = self._download_update(version_info)
+            return success
+        finally:
+            self.finish_trace(success)
+
+    def _download_update(self, version_info):
+        """选择更新方式（目录、增量、块同步或完整更新）并执行"""
         try:
             latest_version = version_info['latest_version']
             version_data = version_info['versions'][latest_version]
@@ -277,6 +1730,37 @@ class UpdateClient:
             self.print_log(f"正在更新到版本 {latest_version}")
             self.print_log(f"更新说明: {version_data.get('description', '无')}")
             
+            # 目录版本按文件清单逐个更新
+            if version_data.get('type') == 'tree':
+                return self._tree_update(version_info)
+            
+            # 本地缓存或备份中已有目标版本时直接安装，不需要下载
+            if self.install_held_target(version_info):
+                return True
+            
+            # 优先使用服务器规划的更新路径（检查更新时已随响应返回则直接使用；本地还持有其他版本时重新规划）
+            plan = version_info.get('plan')
+            if plan is None or plan.get('target_version') != latest_version or len(self.local_version_sources()) > 1:
+                plan = self.fetch_update_plan(latest_version) or plan
+            if plan is not None and plan['method'] == 'full' and plan.get('on_demand') and self.patch_wait_seconds > 0:
+                plan = self.wait_for_patch_plan(latest_version) or plan
+            if plan is not None:
+                if plan['method'] == 'patch':
+                    base_version = plan.get('base_version', self.current_version)
+                    self.print_log(
+                        f"使用增量更新从版本 {base_version} 更新到版本 {latest_version}，"
+                        f"共 {len(plan['steps'])} 个差异文件，"
+                        f"{plan['total_size']/1024/1024:.2f} MB"
+                    )
+                    return self._patch_update(version_info, plan['steps'], base_version)
+                if 'chunk_index' in version_data:
+                    self.print_log(f"使用块同步从版本 {self.current_version} 更新到版本 {latest_version}")
+                    if self._chunk_update(version_info):
+                        return True
+                self.print_log(f"使用完整更新从版本 {self.current_version} 更新到版本 {latest_version}")
+                self.print_log("（完整更新原因：没有可用的差异文件链或差异文件链比完整文件更大）")
+                return self._full_update(version_info)
+            
             # 检查是否可以使用增量更新
             if 'patch' in version_data and version_data['patch']['from_version'] == self.current_version:
                 self.print_log(f"使用增量更新从版本 {self.current_version} 更新到版本 {latest_version}")
@@ -295,44 +1779,618 @@ class UpdateClient:
             return False
 
     def _incremental_update(self, version_info):
-        """增量更新"""
+        """增量更新：下载差异文件并在本地合成新版本"""
+        return self._patch_update(version_info, self.legacy_patch_steps(version_info))
+
+    def legacy_patch_steps(self, version_info):
+        """由旧版服务器版本信息中的 patch 字段构造只有一步的差异文件链"""
+        latest_version = version_info['latest_version']
+        version_data = version_info['versions'][latest_version]
+        patch_info = version_data['patch']
+        steps = [{
+            'from_version': patch_info['from_version'],
+            'to_version': latest_version,
+            'patch_file': patch_info['patch_file'],
+            'md5': patch_info['md5'],
+            'target_md5': version_data['md5']
+        }]
+        for key in ('digest', 'size', 'blocks', 'codec'):
+            if key in patch_info:
+                steps[0][key] = patch_info[key]
+        if 'digest' in version_data:
+            steps[0]['target_digest'] = version_data['digest']
+        return steps
+
+    def _patch_update(self, version_info, steps, base_version=None):
+        """按顺序下载并应用差异文件链（base_version 为链的起点，默认当前版本）"""
         try:
             latest_version = version_info['latest_version']
-            version_data = version_info['versions'][latest_version]
             
-            # 备份当前版本
-            backup_path = self.backup_current_version()
+            # 差异文件使用了本地不支持的编码（如未安装 zstandard）时直接完整更新
+            unsupported = {step.get('codec', 'bsdiff') for step in steps} - set(DELTA_DECODERS)
+            if unsupported:
+                self.print_log(f"客户端不支持差异编码 {', '.join(sorted(unsupported))}，改用完整更新")
+                return self._full_update(version_info)
             
-            # 下载更新文件
-            file_url = f"{self.server_url}/download/{latest_version}/{APP_NAME}"
-            final_path = os.path.join(self.current_dir, APP_NAME)
+            self.note_method('patch')
+            # 下载并校验全部差异文件
+            patch_paths = []
+            for index, step in enumerate(steps, 1):
+                cached = self.cached_patch(step)
+                if cached:
+                    patch_paths.append((cached, self.expected_digest(step, 'target_')))
+                    continue
+                patch_url = f"{self.get_download_url()}/download_patch/{step['from_version']}/{step['to_version']}"
+                patch_path = os.path.join(self.temp_dir, step['patch_file'])
+                desc = f"下载差异文件 {index}/{len(steps)}"
+                
+                algorithm, expected = self.expected_digest(step)
+                hasher = hashlib.new(algorithm)
+                verifier = self.fetch_block_verifier(step.get('blocks'), step.get('size'))
+                if not self.download_with_resume(patch_url, patch_path, desc, hasher, verifier):
+                    logging.error(f"下载差异文件失败: {step['patch_file']}")
+                    self.print_log("下载差异文件失败，改用完整更新")
+                    return self._full_update(version_info)
+                
+                if not self.check_digest(f"校验差异文件 {index}/{len(steps)}", hasher, algorithm, expected):
+                    logging.error(f"差异文件{algorithm}校验失败: {step['patch_file']}")
+                    self.print_log(f"差异文件{algorithm}校验失败，改用完整更新")
+                    os.remove(patch_path)
+                    return self._full_update(version_info)
+                
+                patch_paths.append((patch_path, self.expected_digest(step, 'target_')))
+            
+            if not self.install_patch_chain(latest_version, patch_paths, base_version):
+                self.print_log("应用差异文件失败，改用完整更新")
+                return self._full_update(version_info)
+            self.cache_patches(steps, patch_paths)
+            return True
+            
+        except Exception as e:
+            logging.error(f"增量更新失败: {str(e)}")
+            self.print_log(f"增量更新失败: {str(e)}")
+            return False
+
+    def check_digest(self, label, hasher, algorithm, expected):
+        """比较下载时同时计算的摘要，结果记为一个校验阶段"""
+        with self.phase('verify', label, algorithm=algorithm) as phase:
+            if hasher.hexdigest() != expected:
+                phase.fail(f"{algorithm} 不一致")
+        return phase.ok
+
+    def install_patch_chain(self, version, patch_paths, base_version=None):
+        """在暂存目录中应用已下载并校验的差异文件链，成功后切换为当前版本并记录新版本号
+
+        base_version 为链的起点（当前版本、备份或缓存中的版本，默认当前版本）。差异文件由调用方移入缓存。
+        应用失败时丢弃暂存目录（当前版本未被改动）并返回 False，由调用方改用完整更新。
+        """
+        base_file, base_dir = self.materialize_version(base_version or self.current_version)
+        try:
+            stage = self.stage_current_version(exclude=[APP_NAME])
+            
+            # 应用差异文件链（中间结果写入暂存文件，校验通过后放入暂存目录）
+            if not self.apply_patch_chain(patch_paths, os.path.join(stage, APP_NAME), base_file):
+                self.discard_stage()
+                return False
+        finally:
+            if base_dir:
+                shutil.rmtree(base_dir, ignore_errors=True)
+        
+        self.commit_stage(version)
+        
+        self.print_log("增量更新完成！")
+        self.print_log("更新完成，建议重启应用以确保所有更改生效")
+        return True
+
+    def install_full_file(self, version, staged_file):
+        """把已下载并校验的完整文件（保留原文件权限）放入暂存目录后切换为当前版本，并记录新版本号"""
+        stage = self.stage_current_version(exclude=[APP_NAME])
+        current_file = os.path.join(self.current_dir, APP_NAME)
+        try:
+            if os.path.exists(current_file):
+                shutil.copymode(current_file, staged_file)
+            os.replace(staged_file, os.path.join(stage, APP_NAME))
+        except Exception:
+            self.discard_stage()
+            raise
+        self.commit_stage(version)
+
+    def apply_patch_chain(self, patch_paths, dest_file, src_file=None):
+        """从 src_file（默认当前版本文件）依次应用差异文件，每一步都校验中间结果，全部通过后把结果放入 dest_file
+
+        patch_paths 为 [(差异文件, (算法, 期望摘要))]。普通差异文件按文件头识别编码，直接在内存中合成并计算摘要
+        （bsdiff4.file_patch 本身也会把文件整体读入内存）；分窗口差异文件逐个窗口合成并写入暂存文件，
+        内存占用只与窗口大小有关。
+        """
+        src_file = src_file or os.path.join(self.current_dir, APP_NAME)
+        staging_files = []
+        try:
+            if not os.path.exists(src_file):
+                logging.error(f"当前版本文件不存在: {src_file}")
+                return False
+            
+            # 上一步的结果：内存中的数据或暂存文件
+            data = None
+            base_file = src_file
+            with self.phase('apply', "应用差异文件", len(patch_paths), unit='step') as phase:
+                for index, (patch_path, (algorithm, expected)) in enumerate(patch_paths, 1):
+                    self.print_log(f"正在应用差异文件 {index}/{len(patch_paths)}...")
+                    hasher = hashlib.new(algorithm)
+                    if self.is_windowed_patch(patch_path):
+                        if data is not None:
+                            base_file = self.write_staging(data, staging_files)
+                            data = None
+                        output_file = os.path.join(self.temp_dir, f"{APP_NAME}.staging{len(staging_files)}")
+                        staging_files.append(output_file)
+                        self.apply_windowed_patch(base_file, output_file, patch_path, hasher)
+                        base_file = output_file
+                    else:
+                        if data is None:
+                            with open(base_file, 'rb') as f:
+                                data = f.read()
+                        with open(patch_path, 'rb') as f:
+                            data = decode_detected(data, f.read())
+                        hasher.update(data)
+                    
+                    # 校验合成结果
+                    actual = hasher.hexdigest()
+                    if actual != expected:
+                        logging.error(f"合成文件{algorithm}校验失败: 期望 {expected}, 实际 {actual}")
+                        phase.fail(f"第 {index} 步合成结果{algorithm}不一致")
+                        return False
+                    phase.advance(1)
             
-            if not self.download_with_resume(file_url, final_path, f"下载 {APP_NAME}"):
-                logging.error(f"下载文件失败")
-                self.restore_from_backup(backup_path)
+            # 保留原文件权限后放入暂存目录
+            if data is not None:
+                base_file = self.write_staging(data, staging_files)
+            shutil.copymode(src_file, base_file)
+            os.replace(base_file, dest_file)
+            return True
+            
+        except Exception as e:
+            logging.error(f"应用差异文件失败: {str(e)}")
+            return False
+        finally:
+            for staging_file in staging_files:
+                if os.path.exists(staging_file):
+                    os.remove(staging_file)
+
+    def write_staging(self, data, staging_files):
+        """把内存中的中间结果写入新的暂存文件"""
+        staging_file = os.path.join(self.temp_dir, f"{APP_NAME}.staging{len(staging_files)}")
+        staging_files.append(staging_file)
+        with open(staging_file, 'wb') as f:
+            f.write(data)
+        return staging_file
+
+    def is_windowed_patch(self, patch_path):
+        """判断是否为分窗口格式的差异文件"""
+        with open(patch_path, 'rb') as f:
+            return f.read(len(WINDOWED_MAGIC)) == WINDOWED_MAGIC
+
+    def apply_windowed_patch(self, old_file, new_file, patch_path, hasher):
+        """逐个窗口应用分窗口差异文件，写入时同时计算摘要"""
+        with open(patch_path, 'rb') as fpatch, open(old_file, 'rb') as fold, open(new_file, 'wb') as fnew:
+            header = read_windowed_header(fpatch)
+            if os.path.getsize(old_file) != header['old_size']:
+                raise ValueError(f"基准文件大小不符: {os.path.getsize(old_file)} != {header['old_size']}")
+
+            def write(data):
+                fnew.write(data)
+                hasher.update(data)
+
+            apply_windowed(fold, fpatch, header, write)
+
+    def fetch_tree_manifest(self, version):
+        """下载目录版本的文件清单"""
+        try:
+            response = self.session.get(f"{self.server_url}/tree_manifest/{version}", timeout=30)
+            if response.status_code != 200:
+                return None
+            return response.json()
+        except Exception as e:
+            logging.warning(f"获取版本 {version} 的文件清单失败: {str(e)}")
+            return None
+
+    def load_tree_state(self):
+        """读取本地目录状态缓存：受管理文件的 相对路径 -> 大小/修改时间/MD5"""
+        try:
+            with open(self.tree_state_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {'files': {}}
+
+    def save_tree_state(self, state):
+        with open(self.tree_state_file + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(self.tree_state_file + '.tmp', self.tree_state_file)
+
+    def scan_local_links(self):
+        """扫描当前版本目录中的符号链接（包括指向目录的），返回 相对路径 -> 链接目标"""
+        links = {}
+        for dirpath, dirnames, filenames in os.walk(self.current_dir):
+            for name in dirnames + filenames:
+                link_path = os.path.join(dirpath, name)
+                if os.path.islink(link_path):
+                    links[os.path.relpath(link_path, self.current_dir).replace(os.sep, '/')] = os.readlink(link_path)
+        return links
+
+    def scan_local_tree(self, state):
+        """扫描当前版本目录，返回 相对路径 -> MD5；大小和修改时间未变的文件直接使用缓存的 MD5"""
+        local_files = {}
+        for dirpath, _, filenames in os.walk(self.current_dir):
+            for filename in filenames:
+                file_path = os.path.join(dirpath, filename)
+                if os.path.islink(file_path):
+                    continue
+                rel_path = os.path.relpath(file_path, self.current_dir).replace(os.sep, '/')
+                stat_result = os.stat(file_path)
+                cached = state['files'].get(rel_path)
+                if cached and cached['size'] == stat_result.st_size and cached['mtime_ns'] == stat_result.st_mtime_ns:
+                    local_files[rel_path] = cached['md5']
+                else:
+                    local_files[rel_path] = self.calculate_md5_quiet(file_path)
+        return local_files
+
+    def calculate_md5_quiet(self, file_path):
+        """计算文件MD5（不打印日志，用于大量小文件）"""
+        md5_hash = hashlib.md5()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                md5_hash.update(chunk)
+        return md5_hash.hexdigest()
+
+    def download_to(self, url, dest_file, hasher):
+        """直接下载到指定文件并同时计算摘要（用于目录版本中的小文件），返回字节数"""
+        size = 0
+        with self.session.get(url, stream=True, timeout=60) as response:
+            response.raise_for_status()
+            with open(dest_file, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=READ_CHUNK_SIZE):
+                    if chunk:
+                        f.write(chunk)
+                        hasher.update(chunk)
+                        size += len(chunk)
+        return size
+
+    def _tree_update(self, version_info):
+        """目录版本更新：只下载变化的文件，能用差异文件的文件使用差异文件，并行下载后统一替换"""
+        latest_version = version_info['latest_version']
+        staging_dir = os.path.join(self.temp_dir, 'tree_staging')
+        try:
+            manifest = self.fetch_tree_manifest(latest_version)
+            if manifest is None:
+                self.print_log("获取文件清单失败")
                 return False
+            self.note_method('tree')
+            state, local_files, changed, managed = self.scan_tree_changes(manifest)
+            if not managed:
+                managed = self.fetch_tree_manifest(self.current_version) or {}
+            patches, removed = self.plan_tree_update(manifest, local_files, changed, managed, staging_dir)
+            target_files = manifest['files']
             
-            # 验证MD5
-            if self.get_file_md5(final_path) != version_data['md5']:
-                logging.error("文件MD5校验失败")
-                self.restore_from_backup(backup_path)
+            def fetch_entry(rel_path):
+                staged_file = self.tree_staging_path(staging_dir, rel_path)
+                quoted = urllib.parse.quote(rel_path)
+                if self.tree_patch_usable(rel_path, local_files, patches):
+                    patch_response = self.session.get(
+                        f"{self.server_url}/download_tree_patch/{self.current_version}/{latest_version}/{quoted}",
+                        timeout=60
+                    )
+                    if patch_response.status_code == 200 and self.apply_tree_patch(
+                            rel_path, target_files[rel_path], patches[rel_path], patch_response.content, staged_file):
+                        return len(patch_response.content)
+                    logging.warning(f"差异文件应用失败，改为下载完整文件: {rel_path}")
+                
+                algorithm, expected = self.expected_digest(target_files[rel_path])
+                hasher = hashlib.new(algorithm)
+                size = self.download_to(f"{self.get_download_url()}/download/{latest_version}/{quoted}", staged_file, hasher)
+                if hasher.hexdigest() != expected:
+                    raise IOError(f"文件{algorithm}校验失败: {rel_path}")
+                return size
+            
+            def fetch_counted(rel_path):
+                size = fetch_entry(rel_path)
+                self.advance_phase(1)
+                return size
+            
+            with self.phase('download', "下载变化的文件", len(changed), unit='file') as phase:
+                with ThreadPoolExecutor(max_workers=max(self.download_segments, 1) * 2) as executor:
+                    downloaded = sum(executor.map(fetch_counted, changed))
+                phase.details['bytes'] = downloaded
+            self.print_log(f"已下载 {downloaded/1024/1024:.2f} MB")
+            
+            self.install_tree(latest_version, target_files, changed, removed, staging_dir, manifest.get('links'))
+            self.print_log("目录版本更新完成！")
+            return True
+            
+        except Exception as e:
+            logging.error(f"目录版本更新失败: {str(e)}")
+            self.print_log(f"目录版本更新失败: {str(e)}")
+            return False
+        finally:
+            if os.path.exists(staging_dir):
+                shutil.rmtree(staging_dir)
+
+    def scan_tree_changes(self, manifest):
+        """扫描本地目录并与目标版本的文件清单比较，返回 (目录状态, 本地文件 MD5, 变化的文件, 受管理的文件)
+
+        只删除上一版本清单中受管理的文件和符号链接，不动用户自己放入的文件；受管理的部分为 {'files', 'links'}，
+        本地还没有状态记录时为空，由调用方改用服务器上当前版本的清单。
+        """
+        state = self.load_tree_state()
+        local_files = self.scan_local_tree(state)
+        changed = [p for p, info in manifest['files'].items() if local_files.get(p) != info['md5']]
+        managed = state if state.get('version') == self.current_version else {}
+        return state, local_files, changed, managed
+
+    def plan_tree_update(self, manifest, local_files, changed, managed, staging_dir):
+        """确定需删除的文件和符号链接并准备空的下载目录，返回 (当前版本可用的差异文件, 需删除的路径)"""
+        target_files = manifest['files']
+        target_links = manifest.get('links', {})
+        local_links = self.scan_local_links()
+        patches = manifest.get('patches', {}).get(self.current_version, {})
+        removed = [p for p in managed.get('files', {}) if p not in target_files and p in local_files]
+        removed += [p for p in managed.get('links', {}) if p not in target_links and p in local_links]
+        self.print_log(
+            f"共 {len(target_files)} 个文件，需更新 {len(changed)} 个"
+            f"（其中 {sum(1 for p in changed if p in patches)} 个可使用差异文件），删除 {len(removed)} 个"
+        )
+        if os.path.exists(staging_dir):
+            shutil.rmtree(staging_dir)
+        os.makedirs(staging_dir)
+        return patches, removed
+
+    def tree_staging_path(self, staging_dir, rel_path):
+        """目录版本中的文件在下载目录中的位置（创建所在目录）"""
+        staged_file = os.path.join(staging_dir, *rel_path.split('/'))
+        os.makedirs(os.path.dirname(staged_file), exist_ok=True)
+        return staged_file
+
+    def tree_patch_usable(self, rel_path, local_files, patches):
+        """本地文件正是差异文件的基准且支持其编码时可使用差异文件"""
+        patch_info = patches.get(rel_path)
+        return bool(patch_info and local_files.get(rel_path) == patch_info['base_md5']
+                    and patch_info.get('codec', 'bsdiff') in DELTA_DECODERS)
+
+    def apply_tree_patch(self, rel_path, info, patch_info, patch_data, staged_file):
+        """校验下载的差异文件，对当前版本中的文件合成新文件并校验后写入下载目录，返回是否成功"""
+        patch_algorithm, patch_expected = self.expected_digest(patch_info)
+        if hashlib.new(patch_algorithm, patch_data).hexdigest() != patch_expected:
+            return False
+        with open(os.path.join(self.current_dir, *rel_path.split('/')), 'rb') as f:
+            data = decode_detected(f.read(), patch_data)
+        algorithm, expected = self.expected_digest(info)
+        if hashlib.new(algorithm, data).hexdigest() != expected:
+            return False
+        with open(staged_file, 'wb') as f:
+            f.write(data)
+        return True
+
+    def install_tree(self, version, target_files, changed, removed, staging_dir, links=None):
+        """暂存目录中建立当前版本的副本（不含变化和已移除的文件），放入下载的文件、修正只有权限变化的文件、
+        重建符号链接后整体切换，并记录新的目录状态
+
+        links 为目标版本的 相对路径 -> 链接目标。
+        """
+        links = links or {}
+        stage = self.stage_current_version(exclude=changed + removed)
+        try:
+            with self.phase('stage', "放入变化的文件", len(changed), unit='file'):
+                for rel_path in changed:
+                    dest_file = os.path.join(stage, *rel_path.split('/'))
+                    os.makedirs(os.path.dirname(dest_file), exist_ok=True)
+                    os.replace(os.path.join(staging_dir, *rel_path.split('/')), dest_file)
+                    os.chmod(dest_file, target_files[rel_path]['mode'])
+                    self.advance_phase(1)
+            # Windows 上 chmod 只能修改只读属性，权限位不可比较
+            if SYSTEM_TYPE != 'Windows':
+                changed_paths = set(changed)
+                chmodded = 0
+                for rel_path, info in target_files.items():
+                    dest_file = os.path.join(stage, *rel_path.split('/'))
+                    if rel_path not in changed_paths and (os.stat(dest_file).st_mode & 0o7777) != info['mode']:
+                        os.chmod(dest_file, info['mode'])
+                        chmodded += 1
+                if chmodded:
+                    self.print_log(f"已修改 {chmodded} 个文件的权限")
+            for rel_path, target in links.items():
+                self.place_tree_link(stage, rel_path, target)
+        except Exception:
+            self.discard_stage()
+            raise
+        self.commit_stage(version)
+        
+        new_state = {'version': version, 'files': {}, 'links': dict(links)}
+        for rel_path, info in target_files.items():
+            stat_result = os.stat(os.path.join(self.current_dir, *rel_path.split('/')))
+            new_state['files'][rel_path] = {
+                'size': stat_result.st_size,
+                'mtime_ns': stat_result.st_mtime_ns,
+                'md5': info['md5']
+            }
+        self.save_tree_state(new_state)
+
+    def place_tree_link(self, root_dir, rel_path, target):
+        """在 root_dir 中建立（或改为）指向 target 的符号链接；只接受指向目录内部的相对链接"""
+        resolved = os.path.normpath(os.path.join(os.path.dirname(rel_path), target))
+        if os.path.isabs(target) or resolved.split(os.sep)[0] == '..':
+            raise ValueError(f"符号链接指向目录之外: {rel_path} -> {target}")
+        link_path = os.path.join(root_dir, *rel_path.split('/'))
+        if os.path.islink(link_path):
+            if os.readlink(link_path) == target:
+                return
+            os.remove(link_path)
+        elif os.path.isdir(link_path):
+            shutil.rmtree(link_path)
+        elif os.path.exists(link_path):
+            os.remove(link_path)
+        os.makedirs(os.path.dirname(link_path), exist_ok=True)
+        os.symlink(target, link_path)
+
+    def fetch_chunk_index(self, version):
+        """下载某个版本的块索引，服务器没有时返回 None"""
+        try:
+            response = self.session.get(f"{self.server_url}/chunk_index/{version}", timeout=30)
+            if response.status_code != 200:
+                return None
+            return response.json()
+        except Exception as e:
+            logging.warning(f"获取版本 {version} 的块索引失败: {str(e)}")
+            return None
+
+    def local_version_files(self):
+        """列出本地直接可读的各版本文件：当前版本、完整备份和缓存中的版本，返回 [(版本号, 文件路径)]"""
+        files = []
+        current_file = os.path.join(self.current_dir, APP_NAME)
+        if os.path.exists(current_file):
+            files.append((self.current_version, current_file))
+        for _, version, backup_path in self.list_backups():
+            backup_file = os.path.join(backup_path, APP_NAME)
+            if os.path.exists(backup_file):
+                files.append((version, backup_file))
+        files.extend(self.cache.versions().items())
+        return files
+
+    def _chunk_update(self, version_info):
+        """块同步：复用本地当前版本和备份中已有的块，只下载缺少的块"""
+        latest_version = version_info['latest_version']
+        staging_file = os.path.join(self.temp_dir, APP_NAME + '.chunksync')
+        try:
+            target_index = self.fetch_chunk_index(latest_version)
+            if target_index is None:
                 return False
+            self.note_method('chunk')
             
-            # 更新版本信息
-            self.current_version = latest_version
-            self.save_current_version(latest_version)
+            # 本地文件的块位置：借助服务器发布的对应版本块索引定位，读取时再按摘要校验
+            local_indexes = [
+                (file_path, target_index if version == latest_version else self.fetch_chunk_index(version))
+                for version, file_path in self.local_version_files()
+            ]
+            missing = self.reuse_local_chunks(target_index, local_indexes, staging_file)
+            missing_bytes = sum(size for _, size, _ in missing)
+            runs = self.chunk_runs(missing)
             
-            self.print_log("增量更新完成！")
-            self.print_log("更新完成，建议重启应用以确保所有更改生效")
+            file_url = f"{self.get_download_url()}/download/{latest_version}/{APP_NAME}"
+            with self.phase('download', "下载缺少的块", missing_bytes, url=file_url, runs=len(runs)), \
+                    tqdm(total=missing_bytes, unit='B', unit_scale=True, desc=f"下载缺少的块") as pbar:
+                lock = threading.Lock()
+                
+                def fetch_run(run):
+                    start = run[0][0]
+                    end = run[-1][0] + run[-1][1] - 1
+                    response = self.session.get(file_url, headers={'Range': f'bytes={start}-{end}'}, timeout=60)
+                    if response.status_code != 206:
+                        raise IOError(f"块下载失败: HTTP {response.status_code}")
+                    self.write_chunk_run(staging_file, run, response.content)
+                    self.advance_phase(end - start + 1)
+                    with lock:
+                        pbar.update(end - start + 1)
+                
+                with ThreadPoolExecutor(max_workers=max(self.download_segments, 1)) as executor:
+                    for future in [executor.submit(fetch_run, run) for run in runs]:
+                        future.result()
+            
+            if not self.verify_chunk_result(version_info, staging_file):
+                return False
+            # 放入暂存目录后整体切换，原版本保留为备份
+            self.install_full_file(latest_version, staging_file)
+            self.print_log("块同步更新完成！")
             return True
             
         except Exception as e:
-            logging.error(f"增量更新失败: {str(e)}")
-            self.print_log(f"增量更新失败: {str(e)}")
+            logging.error(f"块同步失败: {str(e)}")
+            self.print_log(f"块同步失败: {str(e)}")
             return False
+        finally:
+            if os.path.exists(staging_file):
+                os.remove(staging_file)
+
+    def reuse_local_chunks(self, target_index, local_indexes, staging_file):
+        """把本地文件中已有的块写入预分配的合成文件，返回缺少的块 [(偏移, 大小, 摘要)]
+
+        local_indexes 为 [(本地文件, 该文件所属版本的块索引)]，块索引为 None 或与文件大小不符的文件不参与复用。
+        """
+        local_chunks = {}
+        for file_path, index in local_indexes:
+            if index is None or os.path.getsize(file_path) != index['size']:
+                continue
+            offset = 0
+            for digest, size in index['chunks']:
+                local_chunks.setdefault(digest, (file_path, offset, size))
+                offset += size
+        
+        missing = []
+        reused_bytes = 0
+        with self.phase('chunk_reuse', "复用本地已有的块", target_index['size']) as phase, \
+                open(staging_file, 'wb') as f:
+            f.truncate(target_index['size'])
+            offset = 0
+            for digest, size in target_index['chunks']:
+                data = None
+                if digest in local_chunks:
+                    path, local_offset, _ = local_chunks[digest]
+                    with open(path, 'rb') as src:
+                        src.seek(local_offset)
+                        data = src.read(size)
+                    if self.chunk_digest(data) != digest:
+                        data = None
+                if data is None:
+                    missing.append((offset, size, digest))
+                else:
+                    f.seek(offset)
+                    f.write(data)
+                    reused_bytes += size
+                phase.advance(size)
+                offset += size
+        
+        self.print_log(
+            f"本地复用 {reused_bytes/1024/1024:.2f} MB，"
+            f"需下载 {len(missing)} 个块共 {sum(size for _, size, _ in missing)/1024/1024:.2f} MB"
+        )
+        return missing
+
+    def chunk_runs(self, missing):
+        """相邻的缺失块合并为一组（不超过 8MB），每组用一个 Range 请求下载"""
+        runs = []
+        for chunk in missing:
+            if runs and runs[-1][-1][0] + runs[-1][-1][1] == chunk[0] \
+                    and sum(c[1] for c in runs[-1]) < 8 * 1024 * 1024:
+                runs[-1].append(chunk)
+            else:
+                runs.append([chunk])
+        return runs
+
+    def write_chunk_run(self, staging_file, run, content):
+        """逐块校验一组缺失块的下载数据并写入合成文件"""
+        start = run[0][0]
+        if len(content) != run[-1][0] + run[-1][1] - start:
+            raise IOError(f"块下载不完整: {len(content)} 字节")
+        with open(staging_file, 'r+b') as f:
+            for offset, size, digest in run:
+                data = content[offset - start:offset - start + size]
+                if self.chunk_digest(data) != digest:
+                    raise IOError(f"块摘要校验失败: {digest}")
+                f.seek(offset)
+                f.write(data)
+
+    def verify_chunk_result(self, version_info, staging_file):
+        """校验块同步合成的文件（块乱序写入，整体摘要只能在合成后读取一次计算）"""
+        version_data = version_info['versions'][version_info['latest_version']]
+        algorithm, expected = self.expected_digest(version_data)
+        with self.phase('verify', "校验块同步结果", os.path.getsize(staging_file), algorithm=algorithm) as phase:
+            if self.get_file_digest(staging_file, algorithm) != expected:
+                phase.fail(f"{algorithm} 不一致")
+        if not phase.ok:
+            logging.error(f"块同步结果{algorithm}校验失败")
+        return phase.ok
+
+    def chunk_digest(self, data):
+        """计算块内容摘要（与服务器块存储一致）"""
+        return hashlib.blake2b(data, digest_size=20).hexdigest()
 
     def _full_update(self, version_info):
-        """完整文件更新"""
+        """完整文件更新：下载并校验完整文件后再切换，下载或校验失败时当前版本不受影响"""
         try:
             latest_version = version_info['latest_version']
             version_data = version_info['versions'][latest_version]
@@ -340,42 +2398,40 @@ class UpdateClient:
             self.print_log(f"正在更新到版本 {latest_version}")
             self.print_log(f"更新说明: {version_data.get('description', '无')}")
             self.print_log("使用完整更新")
-            
-            # 备份当前版本
-            backup_path = self.backup_current_version()
-            self.print_log(f"已备份当前版本到: {backup_path}")
+            self.note_method('full')
             
             # 下载更新文件
-            file_url = f"{self.server_url}/download/{latest_version}/{APP_NAME}"
-            final_path = os.path.join(self.current_dir, APP_NAME)
+            file_url = f"{self.get_download_url()}/download/{latest_version}/{APP_NAME}"
+            staged_file = os.path.join(self.temp_dir, f"{APP_NAME}.full")
             
-            if not self.download_with_resume(file_url, final_path, f"下载 {APP_NAME}"):
+            algorithm, expected = self.expected_digest(version_data)
+            hasher = hashlib.new(algorithm)
+            # 有本地可解压的预压缩版本时下载压缩数据，块哈希清单对应压缩后的数据
+            encoding, encoding_info = self.choose_encoding(version_data)
+            if encoding:
+                self.print_log(f"使用预压缩版本: {encoding} ({encoding_info['size']/1024/1024:.2f} MB)")
+                verifier = self.fetch_block_verifier(encoding_info.get('blocks'), encoding_info['size'])
+            else:
+                verifier = self.fetch_block_verifier(version_data.get('blocks'), version_data.get('size'))
+            if not self.download_with_resume(file_url, staged_file, f"下载 {APP_NAME}", hasher, verifier, encoding):
                 error_msg = "下载文件失败"
                 logging.error(error_msg)
                 self.print_log(f"更新失败: {error_msg}")
-                self.print_log("正在回滚到备份版本...")
-                self.restore_from_backup(backup_path)
-                self.print_log("已恢复到之前版本")
                 return False
             
-            # 验证MD5
-            expected_md5 = version_data['md5']
-            actual_md5 = self.get_file_md5(final_path)
-            self.print_log(f"期望的MD5值: {expected_md5}")
-            self.print_log(f"实际的MD5值: {actual_md5}")
+            # 验证摘要（下载时已同时计算）
+            self.print_log(f"期望的{algorithm}值: {expected}")
+            self.print_log(f"实际的{algorithm}值: {hasher.hexdigest()}")
             
-            if actual_md5 != expected_md5:
-                error_msg = f"文件MD5校验失败，文件可能已损坏"
+            if not self.check_digest("校验下载的文件", hasher, algorithm, expected):
+                error_msg = f"文件{algorithm}校验失败，文件可能已损坏"
                 logging.error(error_msg)
                 self.print_log(f"更新失败: {error_msg}")
-                self.print_log("正在回滚到备份版本...")
-                self.restore_from_backup(backup_path)
-                self.print_log("已恢复到之前版本")
+                os.remove(staged_file)
                 return False
             
-            # 更新版本信息
-            self.current_version = latest_version
-            self.save_current_version(latest_version)
+            # 放入暂存目录后整体切换，原版本保留为备份
+            self.install_full_file(latest_version, staged_file)
             
             self.print_log("更新成功！")
             self.print_log(f"已更新到版本: {latest_version}")
@@ -385,10 +2441,6 @@ class UpdateClient:
             error_msg = f"更新过程出错: {str(e)}"
             logging.error(error_msg)
             self.print_log(f"更新失败: {error_msg}")
-            if 'backup_path' in locals():
-                self.print_log("正在回滚到备份版本...")
-                self.restore_from_backup(backup_path)
-                self.print_log("已恢复到之前版本")
             return False
 
     def print_log(self, message):
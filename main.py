@@ -5,7 +5,7 @@ from PySide6.QtWidgets import (
     QApplication, QMainWindow, QMessageBox, QPushButton, 
     QVBoxLayout, QWidget, QProgressBar, QLabel
 )
-from PySide6.QtCore import QThread, Signal, QTimer
+from PySide6.QtCore import QTimer
 from update_manager import UpdateManager
 import atexit
 import multiprocessing
@@ -21,26 +21,6 @@ with open(os.path.join(os.path.dirname(__file__), 'client', 'client_config.json'
 # 动态获取系统类型
 SYSTEM_TYPE = platform.system()
 
-class UpdateWorker(QThread):
-    progress = Signal(str, int)  # 进度信号
-    
-    def __init__(self, update_manager, update_info):
-        super().__init__()
-        self.manager = update_manager
-        self.update_info = update_info
-    
-    def run(self):
-        try:
-            success = self.manager.do_update(self.update_info)
-            if success:
-                self.manager.update_finished.emit(True, "更新完成")
-            else:
-                self.manager.update_finished.emit(False, "更新失败")
-        except Exception as e:
-            self.manager.update_finished.emit(False, f"更新出错: {str(e)}")
-        finally:
-            self.quit()  # 确保线程结束
-
 class MainWindow(QMainWindow):
     def __init__(self):
         super().__init__()
@@ -97,14 +77,18 @@ class MainWindow(QMainWindow):
         self.update_manager.update_available.connect(self.on_update_available)
         self.update_manager.update_progress.connect(self.on_update_progress)
         self.update_manager.update_finished.connect(self.on_update_finished)
+        self.update_manager.no_update.connect(self.on_no_update)
         
     def check_for_updates(self):
         """检查更新"""
         self.status_label.setText("正在检查更新...")
-        update_info = self.update_manager.check_update()
-        if not update_info:
-            self.status_label.setText("当前已是最新版本")
-            QMessageBox.information(self, "检查更新", "当前已是最新版本")
+        # 后台检查，结果通过 update_available 或 no_update 信号返回，界面不会卡住
+        self.update_manager.check_update_async()
+    
+    def on_no_update(self):
+        """已是最新版本"""
+        self.status_label.setText("当前已是最新版本")
+        QMessageBox.information(self, "检查更新", "当前已是最新版本")
     
     def on_update_available(self, version, desc):
         """有更新可用"""
@@ -128,12 +112,8 @@ class MainWindow(QMainWindow):
             self.progress_bar.show()
             self.progress_bar.setValue(0)
             
-            # 在新线程中执行更新
-            self.update_thread = UpdateWorker(
-                self.update_manager,
-                self.update_manager.check_update()
-            )
-            self.update_thread.start()
+            # 在后台执行更新，直接使用刚才检查得到的版本信息
+            self.update_manager.start_update()
     
     def on_update_progress(self, desc, progress):
         """更新进度"""
@@ -144,14 +124,7 @@ class MainWindow(QMainWindow):
         """更新完成"""
         try:
             self.progress_bar.hide()
-            if success and not self.updating:
-                self.updating = True
-                
-                # 先清理资源
-                if hasattr(self, 'update_thread'):
-                    self.update_thread.quit()
-                    self.update_thread.wait()
-                
+            if success:
                 # 显示更新完成息
                 QMessageBox.information(
                     self, 
@@ -214,10 +187,9 @@ class MainWindow(QMainWindow):
     def cleanup_resources(self):
         """清理资源"""
         try:
-            # 确保所有线程和进程都已结束
-            if hasattr(self, 'update_thread'):
-                self.update_thread.quit()
-                self.update_thread.wait()
+            # 取消进行中的检查或更新并停止后台事件循环
+            if hasattr(self, 'update_manager'):
+                self.update_manager.close()
             
             # 清理其他���源
             for p in multiprocessing.active_children():
@@ -230,9 +202,7 @@ class MainWindow(QMainWindow):
         """窗口关闭事件"""
         try:
             # 确保清理所有资源
-            if hasattr(self, 'update_thread'):
-                self.update_thread.quit()
-                self.update_thread.wait()
+            self.cleanup_resources()
             event.accept()
         except Exception as e:
             print(f"关闭窗口时出错: {str(e)}")
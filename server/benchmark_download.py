@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""下载吞吐基准：多个进程、每个进程多个长连接持续下载同一文件，统计吞吐、请求数和延迟
+
+示例：
+    python server/benchmark_download.py --target app=http://127.0.0.1:1218 \
+        --target sendfile=http://127.0.0.1:1219 --path /download/1.0.1/app --connections 64
+"""
+import os
+import json
+import time
+import socket
+import asyncio
+import argparse
+import multiprocessing
+import urllib.parse
+
+# 接收缓冲区大小
+RECV_BUFFER_SIZE = 1024 * 1024
+# 读取响应头时每次接收的大小
+HEADER_READ_SIZE = 64 * 1024
+
+
+async def read_response(loop, sock, view):
+    """读取一个响应（响应体接收到 view 后直接丢弃），返回 (状态码, 响应头, 响应体长度)
+
+    响应头单独接收，多个连接可以共用同一个 view 丢弃响应体。
+    """
+    head = b''
+    while b'\r\n\r\n' not in head:
+        received = await loop.sock_recv(sock, HEADER_READ_SIZE)
+        if not received:
+            raise ConnectionError("连接被关闭")
+        head += received
+    head, _, body = head.partition(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    status = int(lines[0].split(' ')[1])
+    fields = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        fields[name.strip().lower()] = value.strip()
+    length = int(fields.get('content-length', 0))
+    remaining = length - len(body)
+    while remaining > 0:
+        received = await loop.sock_recv_into(sock, view[:min(remaining, len(view))])
+        if not received:
+            raise ConnectionError("连接被关闭")
+        remaining -= received
+    return status, fields, length
+
+
+async def fetch_loop(host, port, path, deadline, range_size, results):
+    """在一个长连接上循环下载，直到截止时间"""
+    loop = asyncio.get_running_loop()
+    buffer = bytearray(RECV_BUFFER_SIZE)
+    view = memoryview(buffer)
+    sock = None
+    offset = 0
+    while time.monotonic() < deadline:
+        try:
+            if sock is None:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.setblocking(False)
+                await loop.sock_connect(sock, (host, port))
+            headers = f'GET {path} HTTP/1.1\r\nHost: {host}:{port}\r\nAccept-Encoding: identity\r\n'
+            if range_size:
+                headers += f'Range: bytes={offset}-{offset + range_size - 1}\r\n'
+            started = time.monotonic()
+            await loop.sock_sendall(sock, (headers + '\r\n').encode())
+            status, fields, length = await read_response(loop, sock, view)
+            results['latencies'].append(time.monotonic() - started)
+            results['bytes'] += length
+            if status in (200, 206):
+                results['requests'] += 1
+                if range_size and 'content-range' in fields:
+                    total = int(fields['content-range'].split('/')[-1])
+                    offset = (offset + range_size) % max(total - range_size, 1)
+            else:
+                results['errors'] += 1
+            if fields.get('connection', '').lower() == 'close':
+                sock.close()
+                sock = None
+        except (OSError, ValueError, IndexError):
+            results['errors'] += 1
+            if sock is not None:
+                sock.close()
+                sock = None
+    if sock is not None:
+        sock.close()
+
+
+def run_process(host, port, path, connections, duration, range_size, queue):
+    """在子进程中运行若干连接，结果放入队列"""
+    results = {'requests': 0, 'errors': 0, 'bytes': 0, 'latencies': []}
+    deadline = time.monotonic() + duration
+
+    async def main():
+        await asyncio.gather(*[
+            fetch_loop(host, port, path, deadline, range_size, results) for _ in range(connections)
+        ])
+
+    asyncio.run(main())
+    queue.put(results)
+
+
+def run_target(url, path, connections, processes, duration, range_size):
+    """对一个服务地址运行基准，返回汇总结果"""
+    parsed = urllib.parse.urlsplit(url)
+    queue = multiprocessing.Queue()
+    per_process = [connections // processes + (1 if i < connections % processes else 0) for i in range(processes)]
+    workers = [
+        multiprocessing.Process(
+            target=run_process,
+            args=(parsed.hostname, parsed.port or 80, path, count, duration, range_size, queue)
+        )
+        for count in per_process if count
+    ]
+    started = time.monotonic()
+    for worker in workers:
+        worker.start()
+    parts = [queue.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+    elapsed = time.monotonic() - started
+
+    latencies = sorted(latency for part in parts for latency in part['latencies'])
+    total_bytes = sum(part['bytes'] for part in parts)
+
+    def percentile(p):
+        return round(latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000, 2) if latencies else None
+
+    return {
+        'url': url,
+        'path': path,
+        'connections': connections,
+        'processes': len(workers),
+        'duration_seconds': round(elapsed, 2),
+        'requests': sum(part['requests'] for part in parts),
+        'errors': sum(part['errors'] for part in parts),
+        'bytes': total_bytes,
+        'gb_per_second': round(total_bytes / elapsed / 1e9, 3),
+        'requests_per_second': round(len(latencies) / elapsed, 1),
+        'latency_ms': {'p50': percentile(0.5), 'p95': percentile(0.95), 'p99': percentile(0.99)}
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="下载吞吐基准")
+    parser.add_argument('--target', action='append', required=True, help="名称=服务地址，可重复指定以对比")
+    parser.add_argument('--path', required=True, help="下载路径，如 /download/1.0.1/app")
+    parser.add_argument('--connections', type=int, default=64, help="并发连接数")
+    parser.add_argument('--processes', type=int, default=min(os.cpu_count() or 1, 8), help="客户端进程数")
+    parser.add_argument('--duration', type=float, default=10, help="每个服务地址的测试时长（秒）")
+    parser.add_argument('--range-kb', type=int, default=0, help="每次请求的区间大小（KB），0 表示下载完整文件")
+    parser.add_argument('--output', help="结果 JSON 文件")
+    args = parser.parse_args()
+
+    report = {}
+    for target in args.target:
+        name, _, url = target.partition('=')
+        result = run_target(
+            url, args.path, args.connections, min(args.processes, args.connections),
+            args.duration, args.range_kb * 1024
+        )
+        report[name] = result
+        print(
+            f"{name}: {result['gb_per_second']:.3f} GB/s, {result['requests_per_second']} 请求/秒, "
+            f"{result['connections']} 连接, 错误 {result['errors']}, "
+            f"延迟 p50 {result['latency_ms']['p50']} ms / p99 {result['latency_ms']['p99']} ms"
+        )
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
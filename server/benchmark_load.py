@@ -0,0 +1,434 @@
+#!/usr/bin/env python3
+"""更新服务器负载测试：模拟大量客户端，按比例混合检查更新、完整下载、差异文件下载和断点续传请求
+
+默认在临时目录中用合成的版本文件启动本地服务器（run_server.py），统计各类请求的吞吐、延迟分位数、
+错误率以及服务器进程的 CPU 和内存，结果可输出为 JSON 以便在提交之间对比。
+
+示例：
+    python server/benchmark_load.py --clients 2000 --duration 30 --mix check=90,full=2,patch=6,resume=2 \\
+        --output load.json
+    python server/benchmark_load.py --url http://127.0.0.1:1218 --download-url http://127.0.0.1:1219 \\
+        --server-pid 12345
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import asyncio
+import argparse
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+import urllib.parse
+import urllib.request
+
+from benchmark_download import read_response
+from tools.bench_env import (
+    free_port, copy_server_tree, add_version_in_tree, write_synthetic_binary, write_edited_copy
+)
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# 每个进程共用的接收缓冲区大小（响应体直接丢弃）
+RECV_BUFFER_SIZE = 256 * 1024
+# 请求类型
+OPERATIONS = ('check', 'full', 'patch', 'resume')
+# 服务器资源的采样间隔（秒）
+SAMPLE_INTERVAL = 0.5
+
+
+def parse_mix(text):
+    """解析请求比例，如 check=90,full=2,patch=6,resume=2"""
+    mix = {}
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError(f"未知的请求类型: {name}")
+        mix[name] = float(weight)
+    return mix
+
+
+def prepare_server(work_dir, args):
+    """在隔离目录中生成合成版本并启动服务器，返回 (服务器进程, 主服务地址, 下载服务地址)"""
+    port = free_port()
+    download_port = free_port() if args.download_workers else 0
+    copy_server_tree(work_dir, {
+        'SERVER_CONFIG': {
+            'host': '127.0.0.1', 'port': port, 'workers': args.workers,
+            'download_port': download_port, 'download_workers': args.download_workers
+        },
+        # 负载测试只关心服务端处理能力，发布时只用一种差异编码以缩短准备时间
+        'PATCH_CONFIG': {'codecs': ['bsdiff']},
+        'PATCH_CACHE_CONFIG': {'pregenerate_top_k': 0}
+    })
+
+    print(f"正在准备 {args.versions} 个 {args.artifact_mb} MB 的合成版本...")
+    artifacts_dir = os.path.join(work_dir, 'artifacts')
+    os.makedirs(artifacts_dir)
+    previous = write_synthetic_binary(
+        os.path.join(artifacts_dir, 'app_0'), args.artifact_mb * 1024 * 1024, args.seed
+    )
+    add_version_in_tree(work_dir, '1.0.0', previous, 'v0')
+    for index in range(1, args.versions):
+        current = write_edited_copy(
+            previous, os.path.join(artifacts_dir, f'app_{index}'), args.seed + index, edits=32, edit_size=4096
+        )
+        add_version_in_tree(work_dir, f'1.0.{index}', current, f'v{index}')
+        previous = current
+
+    process = subprocess.Popen(
+        [sys.executable, 'run_server.py'], cwd=work_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 60
+    while True:
+        try:
+            urllib.request.urlopen(f'{url}/check_update', timeout=2).read()
+            break
+        except OSError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.terminate()
+                raise RuntimeError("服务器启动失败")
+            time.sleep(0.5)
+    download_url = f'http://127.0.0.1:{download_port}' if download_port else url
+    return process, url, download_url
+
+
+def discover_targets(url):
+    """从完整版本配置中找出最新版本、可检查更新的旧版本和已发布的差异文件"""
+    with urllib.request.urlopen(f'{url}/check_update', timeout=10) as response:
+        version_info = json.load(response)
+    latest_version = version_info['latest_version']
+    latest_info = version_info['versions'][latest_version]
+    patches = [patch['from_version'] for patch in latest_info.get('patches', [])]
+    if not patches and 'patch' in latest_info:
+        patches = [latest_info['patch']['from_version']]
+    return {
+        'latest_version': latest_version,
+        'versions': [version for version in version_info['versions'] if version != latest_version] or [latest_version],
+        'patch_bases': patches,
+        'full_size': latest_info.get('size', 0)
+    }
+
+
+class ResourceSampler(threading.Thread):
+    """定期采样服务器进程（及其所有子进程）的 CPU 占用和常驻内存"""
+
+    def __init__(self, pid):
+        super().__init__(daemon=True)
+        self.root = psutil.Process(pid)
+        self.processes = {}
+        self.cpu = []
+        self.rss = []
+        self.stop_event = threading.Event()
+
+    def sample(self):
+        cpu = rss = 0
+        try:
+            current = [self.root] + self.root.children(recursive=True)
+        except psutil.NoSuchProcess:
+            return
+        for process in current:
+            try:
+                # 首次见到的进程先建立 CPU 计数基准
+                tracked = self.processes.setdefault(process.pid, process)
+                cpu += tracked.cpu_percent(None)
+                rss += tracked.memory_info().rss
+            except psutil.NoSuchProcess:
+                self.processes.pop(process.pid, None)
+        self.cpu.append(cpu)
+        self.rss.append(rss)
+
+    def run(self):
+        self.sample()
+        while not self.stop_event.wait(SAMPLE_INTERVAL):
+            self.sample()
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+
+    def summary(self):
+        # 第一次采样只建立基准
+        cpu = self.cpu[1:] or [0]
+        return {
+            'cpu_percent_avg': round(sum(cpu) / len(cpu), 1),
+            'cpu_percent_max': round(max(cpu), 1),
+            'rss_mb_max': round(max(self.rss or [0]) / 1024 / 1024, 1),
+            'processes': len(self.processes)
+        }
+
+
+def build_request(operation, targets, rng, etag):
+    """构造一次请求的 (目标类别, 路径, 额外请求头)，目标类别为 api（主服务）或 download（下载服务）"""
+    latest_version = targets['latest_version']
+    if operation == 'check':
+        current_version = rng.choice(targets['versions'])
+        path = f'/check_update?current_version={urllib.parse.quote(current_version)}'
+        extra = 'Accept-Encoding: gzip\r\n' + (f'If-None-Match: {etag}\r\n' if etag else '')
+        return 'api', path, extra
+    if operation == 'patch' and targets['patch_bases']:
+        base = rng.choice(targets['patch_bases'])
+        return 'download', f'/download_patch/{base}/{latest_version}', 'Accept-Encoding: identity\r\n'
+    extra = 'Accept-Encoding: identity\r\n'
+    if operation == 'resume' and targets['full_size']:
+        extra += f'Range: bytes={rng.randrange(targets["full_size"])}-\r\n'
+    return 'download', f'/download/{latest_version}/app', extra
+
+
+async def virtual_client(endpoints, targets, mix, think, deadline, view, seed, results):
+    """一个模拟客户端：按比例选择请求类型，每类目标各用一个长连接，请求之间按指数分布等待"""
+    loop = asyncio.get_running_loop()
+    rng = random.Random(seed)
+    names, weights = list(mix), list(mix.values())
+    sockets = {}
+    etag = None
+    # 客户端启动时间错开，避免所有连接同时建立
+    await asyncio.sleep(rng.random() * min(think, 1.0))
+    while time.monotonic() < deadline:
+        operation = rng.choices(names, weights)[0]
+        target, path, extra = build_request(operation, targets, rng, etag)
+        host, port, netloc = endpoints[target]
+        request = f'GET {path} HTTP/1.1\r\nHost: {netloc}\r\n{extra}\r\n'
+        stats = results[operation]
+        try:
+            for attempt in range(2):
+                sock = sockets.get(target)
+                reused = sock is not None
+                if sock is None:
+                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    sock.setblocking(False)
+                    sockets[target] = sock
+                    await loop.sock_connect(sock, (host, port))
+                started = time.monotonic()
+                try:
+                    await loop.sock_sendall(sock, request.encode('latin-1'))
+                    status, fields, length = await read_response(loop, sock, view)
+                    break
+                except OSError:
+                    # 空闲长连接可能已被服务器关闭，与普通 HTTP 客户端一样换新连接重试一次
+                    sockets.pop(target).close()
+                    if not reused:
+                        raise
+            stats['latencies'].append(time.monotonic() - started)
+            stats['bytes'] += length
+            stats['status'][status] = stats['status'].get(status, 0) + 1
+            if status >= 400:
+                stats['errors'] += 1
+            else:
+                stats['requests'] += 1
+            if operation == 'check' and 'etag' in fields:
+                etag = fields['etag']
+            if fields.get('connection', '').lower() == 'close':
+                sockets.pop(target).close()
+        except (OSError, ValueError, IndexError):
+            stats['errors'] += 1
+            stats['status']['connection'] = stats['status'].get('connection', 0) + 1
+            sock = sockets.pop(target, None)
+            if sock is not None:
+                sock.close()
+        if think:
+            await asyncio.sleep(rng.expovariate(1 / think))
+    for sock in sockets.values():
+        sock.close()
+
+
+def run_process(endpoints, targets, mix, clients, think, duration, seed, queue):
+    """在子进程中运行若干模拟客户端，结果放入队列"""
+    results = {
+        operation: {'requests': 0, 'errors': 0, 'bytes': 0, 'latencies': [], 'status': {}}
+        for operation in OPERATIONS
+    }
+    deadline = time.monotonic() + duration
+    view = memoryview(bytearray(RECV_BUFFER_SIZE))
+
+    async def main():
+        await asyncio.gather(*[
+            virtual_client(endpoints, targets, mix, think, deadline, view, seed * 100003 + index, results)
+            for index in range(clients)
+        ])
+
+    asyncio.run(main())
+    queue.put(results)
+
+
+def percentile(latencies, p):
+    return round(latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000, 2) if latencies else None
+
+
+def summarize(parts, elapsed):
+    """合并各进程的统计结果"""
+    operations = {}
+    total_requests = total_errors = total_bytes = 0
+    for operation in OPERATIONS:
+        latencies = sorted(latency for part in parts for latency in part[operation]['latencies'])
+        requests = sum(part[operation]['requests'] for part in parts)
+        errors = sum(part[operation]['errors'] for part in parts)
+        size = sum(part[operation]['bytes'] for part in parts)
+        if not requests and not errors:
+            continue
+        status = {}
+        for part in parts:
+            for code, count in part[operation]['status'].items():
+                status[str(code)] = status.get(str(code), 0) + count
+        operations[operation] = {
+            'requests': requests,
+            'errors': errors,
+            'error_rate': round(errors / (requests + errors), 4),
+            'requests_per_second': round(requests / elapsed, 1),
+            'mb_per_second': round(size / elapsed / 1024 / 1024, 2),
+            'latency_ms': {
+                'p50': percentile(latencies, 0.5), 'p95': percentile(latencies, 0.95), 'p99': percentile(latencies, 0.99)
+            },
+            'status': status
+        }
+        total_requests += requests
+        total_errors += errors
+        total_bytes += size
+    return {
+        'requests': total_requests,
+        'errors': total_errors,
+        'error_rate': round(total_errors / max(total_requests + total_errors, 1), 4),
+        'requests_per_second': round(total_requests / elapsed, 1),
+        'mb_per_second': round(total_bytes / elapsed / 1024 / 1024, 2)
+    }, operations
+
+
+def run_load(url, download_url, targets, args, server_pid):
+    """运行负载并返回报告"""
+    mix = parse_mix(args.mix)
+    endpoints = {}
+    for name, address in (('api', url), ('download', download_url)):
+        parsed = urllib.parse.urlsplit(address)
+        endpoints[name] = (parsed.hostname, parsed.port or 80, parsed.netloc)
+
+    sampler = None
+    if server_pid and psutil is not None:
+        sampler = ResourceSampler(server_pid)
+        sampler.start()
+
+    processes = max(min(args.processes, args.clients), 1)
+    per_process = [args.clients // processes + (1 if i < args.clients % processes else 0) for i in range(processes)]
+    queue = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(
+            target=run_process,
+            args=(endpoints, targets, mix, count, args.think_ms / 1000, args.duration, args.seed + index, queue)
+        )
+        for index, count in enumerate(per_process) if count
+    ]
+    started = time.monotonic()
+    for worker in workers:
+        worker.start()
+    parts = [queue.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+    elapsed = time.monotonic() - started
+    if sampler is not None:
+        sampler.stop()
+
+    totals, operations = summarize(parts, elapsed)
+    return {
+        'config': {
+            'url': url,
+            'download_url': download_url,
+            'clients': args.clients,
+            'processes': len(workers),
+            'duration_seconds': args.duration,
+            'think_ms': args.think_ms,
+            'mix': mix,
+            'seed': args.seed,
+            'workers': args.workers if not args.url else None,
+            'download_workers': args.download_workers if not args.url else None,
+            'artifact_mb': args.artifact_mb if not args.url else None,
+            'latest_version': targets['latest_version']
+        },
+        'elapsed_seconds': round(elapsed, 2),
+        'totals': totals,
+        'operations': operations,
+        'server': sampler.summary() if sampler is not None else None
+    }
+
+
+def print_report(report):
+    totals = report['totals']
+    print(
+        f"总计: {totals['requests_per_second']} 请求/秒, {totals['mb_per_second']} MB/s, "
+        f"错误率 {totals['error_rate'] * 100:.2f}%"
+    )
+    for operation, stats in report['operations'].items():
+        latency = stats['latency_ms']
+        print(
+            f"  {operation}: {stats['requests_per_second']} 请求/秒, {stats['mb_per_second']} MB/s, "
+            f"错误率 {stats['error_rate'] * 100:.2f}%, "
+            f"延迟 p50 {latency['p50']} / p95 {latency['p95']} / p99 {latency['p99']} ms"
+        )
+    if report['server']:
+        server = report['server']
+        print(
+            f"服务器: CPU 平均 {server['cpu_percent_avg']}% / 峰值 {server['cpu_percent_max']}%, "
+            f"内存峰值 {server['rss_mb_max']} MB（{server['processes']} 个进程）"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="更新服务器负载测试")
+    parser.add_argument('--url', help="已运行的服务器地址，不指定时在临时目录中启动本地服务器")
+    parser.add_argument('--download-url', help="下载服务地址（默认与 --url 相同）")
+    parser.add_argument('--server-pid', type=int, help="已运行服务器的进程号，用于采样 CPU 和内存")
+    parser.add_argument('--clients', type=int, default=1000, help="模拟客户端数")
+    parser.add_argument('--processes', type=int, default=min(os.cpu_count() or 1, 8), help="负载生成进程数")
+    parser.add_argument('--duration', type=float, default=30, help="测试时长（秒）")
+    parser.add_argument('--think-ms', type=float, default=1000, help="每个客户端两次请求之间的平均间隔（毫秒），0 表示不等待")
+    parser.add_argument('--mix', default='check=90,full=2,patch=6,resume=2', help="请求比例")
+    parser.add_argument('--seed', type=int, default=1, help="随机种子")
+    parser.add_argument('--workers', type=int, default=1, help="本地服务器的 uvicorn 进程数")
+    parser.add_argument('--download-workers', type=int, default=1, help="本地服务器的零拷贝下载进程数，0 表示不启动")
+    parser.add_argument('--artifact-mb', type=int, default=16, help="合成版本文件大小（MB）")
+    parser.add_argument('--versions', type=int, default=3, help="合成版本数")
+    parser.add_argument('--keep', action='store_true', help="保留本地服务器的临时目录")
+    parser.add_argument('--output', help="结果 JSON 文件")
+    args = parser.parse_args()
+
+    server_process = None
+    work_dir = None
+    try:
+        if args.url:
+            url = args.url.rstrip('/')
+            download_url = (args.download_url or url).rstrip('/')
+            server_pid = args.server_pid
+        else:
+            work_dir = os.path.join(tempfile.mkdtemp(prefix='update_load_'), 'server')
+            server_process, url, download_url = prepare_server(work_dir, args)
+            server_pid = server_process.pid
+        if server_pid and psutil is None:
+            print("未安装 psutil，不采样服务器 CPU 和内存")
+        targets = discover_targets(url)
+        print(f"开始负载测试: {args.clients} 个客户端, {args.duration} 秒, 请求比例 {args.mix}")
+        report = run_load(url, download_url, targets, args, server_pid)
+    finally:
+        if server_process is not None:
+            server_process.terminate()
+            server_process.wait()
+        if work_dir is not None:
+            if args.keep:
+                print(f"临时目录: {work_dir}")
+            else:
+                shutil.rmtree(os.path.dirname(work_dir), ignore_errors=True)
+
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
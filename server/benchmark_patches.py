@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+"""差异文件生成与应用基准：按差异编码和生成方式测量耗时、峰值内存、差异文件大小和应用吞吐
+
+测试数据由随机种子确定（小改动、大改动、类似 PyInstaller 的打包程序），也可以用 --pair 指定真实的新旧版本文件。
+生成在隔离的服务器目录中调用 VersionManager.generate_patches（add_version 中生成差异文件的步骤），
+应用在隔离的客户端目录中调用 UpdateClient.apply_patch_chain，每次测量都在单独的子进程中运行，
+峰值内存取子进程及其进程池的最大常驻内存。
+
+示例：
+    python server/benchmark_patches.py --sizes 1,16,64 --output patches.json
+    python server/benchmark_patches.py --sizes 1024,4096 --kinds bundle --modes windowed --data-dir /data/bench
+    python server/benchmark_patches.py --pair app=old/app:new/app --compare patches.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+
+SCRIPT_PATH = os.path.abspath(__file__)
+SERVER_DIR = os.path.dirname(SCRIPT_PATH)
+CLIENT_DIR = os.path.join(os.path.dirname(SERVER_DIR), 'client')
+# 复制客户端目录时跳过的运行时数据
+CLIENT_RUNTIME_ENTRIES = ('current_version', 'backup', 'temp', 'logs', '__pycache__', '*.pyc')
+# 测试数据的种类
+KINDS = ('small-edit', 'heavy-edit', 'bundle')
+# 差异文件的生成方式：整体计算或按窗口分别计算
+MODES = ('whole', 'windowed')
+# 对比上次结果时视为明显变化的比例
+CHANGE_THRESHOLD = 0.1
+# 短于该时间（秒）的耗时受计时噪声影响大，不参与对比
+MIN_COMPARE_SECONDS = 0.05
+
+
+def worker_generate(base_version, new_version, new_file, mode, result_path):
+    """（子进程，在隔离的服务器目录中运行）生成一个差异文件并记录耗时"""
+    from tools.version_manager import VersionManager, CHUNK_CONFIG
+    from tools.hashing import hash_file
+
+    manager = VersionManager()
+    if mode == 'windowed':
+        # 与发布时一致，按块索引匹配新旧文件中的对应窗口（建立块索引不计入耗时）
+        base_file = os.path.join(manager.versions_dir, f'v{base_version}', 'app')
+        for version, path in ((base_version, base_file), (new_version, new_file)):
+            if not manager.chunk_store.has_index(version):
+                manager.chunk_store.add_file(
+                    version, path, hash_file(path, ['md5'])['md5'],
+                    CHUNK_CONFIG.get('min_size_kb', 16) * 1024,
+                    CHUNK_CONFIG.get('avg_size_kb', 64) * 1024,
+                    CHUNK_CONFIG.get('max_size_kb', 256) * 1024
+                )
+    started = time.perf_counter()
+    info = manager.generate_patches(new_version, new_file, [base_version], verbose=False)[0]
+    seconds = time.perf_counter() - started
+    with open(result_path, 'w') as f:
+        json.dump({'seconds': seconds, 'patch': info}, f)
+
+
+def worker_apply(client_dir, old_file, patch_file, expected_md5, result_path):
+    """（子进程）在隔离的客户端目录中应用差异文件并记录耗时"""
+    sys.path.insert(0, client_dir)
+    from client import UpdateClient, APP_NAME
+
+    client = UpdateClient()
+    app_file = os.path.join(client.current_dir, APP_NAME)
+    shutil.copyfile(old_file, app_file)
+    dest_file = os.path.join(client.temp_dir, f'{APP_NAME}.applied')
+    started = time.perf_counter()
+    ok = client.apply_patch_chain([(patch_file, ('md5', expected_md5))], dest_file)
+    seconds = time.perf_counter() - started
+    if os.path.exists(dest_file):
+        os.remove(dest_file)
+    with open(result_path, 'w') as f:
+        json.dump({'seconds': seconds, 'ok': ok}, f)
+
+
+def run_measured(script, arguments, cwd, result_path):
+    """在子进程中运行一次测量，返回 (结果, 峰值内存 MB)；wait4 的内存统计包含子进程已回收的进程池"""
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(
+            [sys.executable, script] + arguments, cwd=cwd, stdout=subprocess.DEVNULL, stderr=stderr
+        )
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        if process.returncode != 0:
+            stderr.seek(0)
+            raise RuntimeError(f"测量进程失败: {stderr.read().decode(errors='replace').strip()[-2000:]}")
+    with open(result_path, 'r') as f:
+        result = json.load(f)
+    # Linux 上 ru_maxrss 的单位是 KB，macOS 上是字节
+    peak = usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+    return result, round(peak / 1024 / 1024, 1)
+
+
+def file_md5(path):
+    md5_hash = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            md5_hash.update(chunk)
+    return md5_hash.hexdigest()
+
+
+def prepare_cases(args, data_dir):
+    """生成（或复用 data_dir 中已有的）测试数据，返回 [{name, kind, old, new}]"""
+    from tools.bench_env import write_synthetic_binary, write_edited_copy, write_bundle
+
+    cases = []
+    for size_mb in [int(size) for size in args.sizes.split(',') if size]:
+        size = size_mb * 1024 * 1024
+        for kind in args.kinds.split(','):
+            name = f'{kind}-{size_mb}MB'
+            old_file = os.path.join(data_dir, f'{name}-{args.seed}.old')
+            new_file = os.path.join(data_dir, f'{name}-{args.seed}.new')
+            if not (os.path.exists(old_file) and os.path.exists(new_file)):
+                print(f"正在生成测试数据 {name}...")
+                if kind == 'bundle':
+                    write_bundle(old_file + '.tmp', size, args.seed)
+                    write_bundle(new_file + '.tmp', size, args.seed, edit_seed=args.seed + 1)
+                else:
+                    write_synthetic_binary(old_file + '.tmp', size, args.seed)
+                    if kind == 'small-edit':
+                        # 少量零散修改：约 16 处 4 KB
+                        edits, edit_size = 16, 4096
+                    else:
+                        # 大量修改：约 6% 的内容被替换、插入或删除
+                        edits, edit_size = max(size // (128 * 1024), 16), 8192
+                    write_edited_copy(old_file + '.tmp', new_file + '.tmp', args.seed + 1, edits, edit_size)
+                os.replace(old_file + '.tmp', old_file)
+                os.replace(new_file + '.tmp', new_file)
+            cases.append({'name': name, 'kind': kind, 'old': old_file, 'new': new_file})
+    for pair in args.pair or []:
+        name, _, files = pair.partition('=')
+        old_file, _, new_file = files.partition(':')
+        cases.append({'name': name, 'kind': 'pair', 'old': os.path.abspath(old_file), 'new': os.path.abspath(new_file)})
+    return cases
+
+
+def memory_limit(args):
+    """整体计算差异文件允许的内存估算上限（默认为物理内存的 80%）"""
+    if args.memory_limit_mb:
+        return args.memory_limit_mb * 1024 * 1024
+    try:
+        return int(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') * 0.8)
+    except (ValueError, OSError, AttributeError):
+        return 8 * 1024 * 1024 * 1024
+
+
+def run_case(case, codecs, modes, args, work_dir):
+    """对一组新旧文件按各差异编码和生成方式测量，返回结果列表"""
+    from tools.bench_env import copy_server_tree, update_tree_config
+    from tools.version_manager import estimate_diff_memory
+
+    old_size = os.path.getsize(case['old'])
+    new_size = os.path.getsize(case['new'])
+    expected_md5 = file_md5(case['new'])
+
+    case_dir = os.path.join(work_dir, case['name'])
+    server_tree = copy_server_tree(os.path.join(case_dir, 'server'), {
+        'PATCH_CONFIG': {
+            'max_workers': args.workers, 'window_size_mb': args.window_mb,
+            'compare_whole_file': False, 'memory_budget_mb': memory_limit(args) // 1024 // 1024
+        }
+    })
+    base_dir = os.path.join(server_tree, 'versions', 'v1.0.0')
+    os.makedirs(base_dir)
+    shutil.copyfile(case['old'], os.path.join(base_dir, 'app'))
+    client_tree = os.path.join(case_dir, 'client')
+    shutil.copytree(CLIENT_DIR, client_tree, ignore=shutil.ignore_patterns(*CLIENT_RUNTIME_ENTRIES))
+    patch_file = os.path.join(server_tree, 'patches', 'patch_1.0.0_to_1.0.1.diff')
+    result_path = os.path.join(case_dir, 'result.json')
+
+    results = []
+    for mode in modes:
+        for codec in codecs:
+            entry = {
+                'case': case['name'], 'kind': case['kind'], 'codec': codec, 'mode': mode,
+                'old_size': old_size, 'new_size': new_size
+            }
+            results.append(entry)
+            if mode == 'whole' and estimate_diff_memory(old_size, new_size) > memory_limit(args):
+                entry['skipped'] = "整体计算的内存估算超出上限"
+                continue
+            if mode == 'whole':
+                update_tree_config(server_tree, {'PATCH_CONFIG': {'codecs': [codec], 'windowed_threshold_mb': 1 << 30}})
+            else:
+                update_tree_config(server_tree, {'PATCH_CONFIG': {'window_codec': codec, 'windowed_threshold_mb': 0}})
+
+            generate_seconds, apply_seconds, generate_peaks, apply_peaks = [], [], [], []
+            for _ in range(args.repeat):
+                if os.path.exists(patch_file):
+                    os.remove(patch_file)
+                generated, peak = run_measured(
+                    os.path.join(server_tree, 'benchmark_patches.py'),
+                    ['_generate', '1.0.0', '1.0.1', case['new'], mode, result_path], server_tree, result_path
+                )
+                generate_seconds.append(generated['seconds'])
+                generate_peaks.append(peak)
+                applied, peak = run_measured(
+                    SCRIPT_PATH, ['_apply', client_tree, case['old'], patch_file, expected_md5, result_path],
+                    client_tree, result_path
+                )
+                if not applied['ok']:
+                    raise RuntimeError(f"{case['name']} {codec} {mode}: 应用差异文件后校验失败")
+                apply_seconds.append(applied['seconds'])
+                apply_peaks.append(peak)
+
+            patch_size = os.path.getsize(patch_file)
+            apply_median = statistics.median(apply_seconds)
+            entry.update({
+                'selected_codec': generated['patch'].get('codec', codec),
+                'patch_size': patch_size,
+                'patch_ratio': round(patch_size / max(new_size, 1), 6),
+                'generate': {
+                    'seconds': round(statistics.median(generate_seconds), 3),
+                    'peak_rss_mb': max(generate_peaks)
+                },
+                'apply': {
+                    'seconds': round(apply_median, 3),
+                    'mb_per_second': round(new_size / 1024 / 1024 / max(apply_median, 1e-9), 1),
+                    'peak_rss_mb': max(apply_peaks)
+                }
+            })
+            print(
+                f"{case['name']:<22} {codec:<12} {mode:<9} 差异 {patch_size / 1024:10.1f} KB "
+                f"({entry['patch_ratio'] * 100:6.2f}%)  生成 {entry['generate']['seconds']:8.2f} s "
+                f"{entry['generate']['peak_rss_mb']:8.1f} MB  应用 {entry['apply']['seconds']:7.2f} s "
+                f"{entry['apply']['mb_per_second']:8.1f} MB/s {entry['apply']['peak_rss_mb']:8.1f} MB"
+            )
+    shutil.rmtree(case_dir, ignore_errors=True)
+    return results
+
+
+def environment():
+    """记录影响结果的环境信息，便于对比不同机器或提交的结果"""
+    import bsdiff4
+    try:
+        import zstandard
+        zstandard_version = zstandard.__version__
+    except ImportError:
+        zstandard_version = None
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=SERVER_DIR, capture_output=True, text=True, timeout=10
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'bsdiff4': bsdiff4.__version__,
+        'zstandard': zstandard_version,
+        'commit': commit
+    }
+
+
+def compare_reports(previous, current):
+    """与上次结果逐项对比耗时和差异文件大小，输出变化超过阈值的项"""
+    old_entries = {(entry['case'], entry['codec'], entry['mode']): entry for entry in previous['results']}
+    print(f"\n与上次结果对比（提交 {previous['environment'].get('commit')} -> {current['environment'].get('commit')}）:")
+    changed = 0
+    for entry in current['results']:
+        old = old_entries.get((entry['case'], entry['codec'], entry['mode']))
+        if old is None or 'skipped' in entry or 'skipped' in old:
+            continue
+        metrics = (
+            ('生成耗时', old['generate']['seconds'], entry['generate']['seconds'], True),
+            ('应用耗时', old['apply']['seconds'], entry['apply']['seconds'], True),
+            ('差异大小', old['patch_size'], entry['patch_size'], False),
+            ('生成内存', old['generate']['peak_rss_mb'], entry['generate']['peak_rss_mb'], False)
+        )
+        for label, before, after, is_time in metrics:
+            if is_time and max(before, after) < MIN_COMPARE_SECONDS:
+                continue
+            if before and abs(after - before) / before > CHANGE_THRESHOLD:
+                changed += 1
+                print(
+                    f"  {entry['case']} {entry['codec']} {entry['mode']} {label}: "
+                    f"{before} -> {after} ({(after - before) / before * 100:+.1f}%)"
+                )
+    if not changed:
+        print(f"  没有超过 {CHANGE_THRESHOLD * 100:.0f}% 的变化")
+
+
+def main():
+    from tools.update_formats import available_codecs
+
+    parser = argparse.ArgumentParser(description="差异文件生成与应用基准")
+    parser.add_argument('--sizes', default='1,16,64', help="合成测试数据的大小（MB），逗号分隔，为空表示只测 --pair")
+    parser.add_argument('--kinds', default=','.join(KINDS), help="合成测试数据的种类：small-edit、heavy-edit、bundle")
+    parser.add_argument('--pair', action='append', help="名称=旧文件:新文件，可重复指定")
+    parser.add_argument('--codecs', default='bsdiff,bsdiff-lzma,bsdiff-zstd,zstd-dict', help="差异编码（不可用的自动跳过）")
+    parser.add_argument('--modes', default=','.join(MODES), help="生成方式：whole（整体）、windowed（分窗口）")
+    parser.add_argument('--window-mb', type=int, default=64, help="分窗口方式的窗口大小（MB）")
+    parser.add_argument('--workers', type=int, default=0, help="生成差异文件的进程数，0 表示全部 CPU 核心")
+    parser.add_argument('--memory-limit-mb', type=int, default=0, help="整体方式允许的内存估算上限，0 表示物理内存的 80%%")
+    parser.add_argument('--repeat', type=int, default=1, help="每项测量的重复次数（耗时取中位数，内存取最大值）")
+    parser.add_argument('--seed', type=int, default=1, help="合成测试数据的随机种子")
+    parser.add_argument('--data-dir', help="保存合成测试数据的目录，已存在的数据直接复用（默认使用临时目录）")
+    parser.add_argument('--compare', help="上次结果的 JSON 文件，输出明显变化的项")
+    parser.add_argument('--output', help="结果 JSON 文件")
+    args = parser.parse_args()
+
+    codecs = available_codecs(args.codecs.split(','))
+    modes = [mode for mode in args.modes.split(',') if mode in MODES]
+    work_dir = tempfile.mkdtemp(prefix='update_patch_bench_')
+    data_dir = args.data_dir or os.path.join(work_dir, 'data')
+    os.makedirs(data_dir, exist_ok=True)
+    try:
+        cases = prepare_cases(args, data_dir)
+        results = []
+        for case in cases:
+            results.extend(run_case(case, codecs, modes, args, work_dir))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        'environment': environment(),
+        'config': {
+            'sizes_mb': args.sizes, 'kinds': args.kinds, 'codecs': codecs, 'modes': modes,
+            'window_mb': args.window_mb, 'workers': args.workers, 'repeat': args.repeat, 'seed': args.seed
+        },
+        'results': results
+    }
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare_reports(json.load(f), report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '_generate':
+        worker_generate(*sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == '_apply':
+        worker_apply(*sys.argv[2:])
+    else:
+        main()
@@ -15,8 +15,12 @@ def reload_server_config():
     """通知服务器重新加载配置"""
     try:
         # 添加超时设置
-        response = requests.get(
+        headers = {}
+        if SERVER_CONFIG.get('admin_token'):
+            headers['X-Admin-Token'] = SERVER_CONFIG['admin_token']
+        response = requests.post(
             f"http://localhost:{SERVER_CONFIG['port']}/reload_config",
+            headers=headers,
             timeout=5  # 5秒超时
         )
         if response.status_code == 200:
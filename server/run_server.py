@@ -2,25 +2,51 @@
 import os
 import sys
 import json
+import signal
+import subprocess
 
 def main():
     """运行服务器"""
     # 获取脚本所在目录
     server_dir = os.path.dirname(os.path.abspath(__file__))
-    
+
     # 切换到服务器目录
     os.chdir(server_dir)
-    
+
     # 加载配置
     with open('server_config.json', 'r') as f:
         config = json.load(f)
         server_config = config['SERVER_CONFIG']
-    
+
+    # 启动零拷贝下载服务（多个进程共享同一端口）
+    download_processes = []
+    if server_config.get('download_port'):
+        from tools.sendfile_server import start_workers
+        download_workers = server_config.get('download_workers') or os.cpu_count()
+        download_processes = start_workers(
+            server_config['host'], server_config['download_port'], server_config['port'], download_workers
+        )
+        print(f"下载服务: 端口 {server_config['download_port']}, 进程数 {len(download_processes)}")
+
     # 运行服务器
-    cmd = f"python -m uvicorn server:app --host {server_config['host']} --port {server_config['port']}"
-    print(f"执行命令: {cmd}")
+    cmd = [
+        sys.executable, '-m', 'uvicorn', 'server:app',
+        '--host', server_config['host'],
+        '--port', str(server_config['port']),
+        '--workers', str(server_config.get('workers', 1))
+    ]
+    print(f"执行命令: {' '.join(cmd)}")
     print(f"工作目录: {os.getcwd()}")
-    os.system(cmd)
+    # 收到 SIGTERM 时同样停止 uvicorn 和下载服务进程
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        subprocess.run(cmd)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in download_processes:
+            process.terminate()
+            process.join()
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
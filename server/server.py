@@ -1,12 +1,23 @@
-from fastapi import FastAPI, HTTPException, Response, Header
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi import FastAPI, HTTPException, Request, Response, Header, Query
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse
 from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor
 from typing import Optional
 import os
 import json
-import hashlib
+import time
+import asyncio
+import multiprocessing
 import logging
 from datetime import datetime
+from tools.manifest_snapshot import load_manifest_snapshot, snapshot_stat_key, client_response
+from tools.file_serving import build_file_response, build_range_response, negotiate_encoding, safe_join
+from tools.zero_copy import OpenFileCache, build_cached_file_response
+from tools.chunk_store import ChunkStore
+from tools.patch_cache import PatchCache, is_initial_request
+from tools.version_population import VersionPopulation
+from tools.version_manager import generate_patch_on_demand, init_on_demand_worker
+from tools.metrics import Metrics, MetricsMiddleware, define_download_metrics
 
 # 获取服务器脚本所在的目录路径
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -17,10 +28,12 @@ with open(os.path.join(BASE_DIR, 'server_config.json'), 'r') as f:
     SERVER_CONFIG = config['SERVER_CONFIG']
     APP_CONFIG = config['APP_CONFIG']
     DIR_CONFIG = config['DIR_CONFIG']
+    PATCH_CACHE_CONFIG = config.get('PATCH_CACHE_CONFIG', {})
 
 # 设置目录路径
 VERSIONS_DIR = os.path.join(BASE_DIR, DIR_CONFIG['versions_dir'])
 PATCHES_DIR = os.path.join(BASE_DIR, DIR_CONFIG['patches_dir'])
+CHUNKS_DIR = os.path.join(BASE_DIR, DIR_CONFIG.get('chunks_dir', 'chunks'))
 LOG_DIR = os.path.join(BASE_DIR, DIR_CONFIG['logs_dir'])
 LOG_LEVEL = DIR_CONFIG['log_level']
 
@@ -32,75 +45,443 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
-app = FastAPI(title="软件增量更新系统")
+CHUNK_STORE = ChunkStore(CHUNKS_DIR)
+# 下载文件的文件描述符和 stat 缓存
+FILE_CACHE = OpenFileCache(SERVER_CONFIG.get('file_cache_size', 256), SERVER_CONFIG.get('file_cache_ttl', 1.0))
 
-def load_version_info():
-    """加载版本配置"""
-    config_path = os.path.join(BASE_DIR, 'config', 'versions.json')
-    with open(config_path, 'r', encoding='utf-8') as f:
-        return json.load(f)
+MANIFEST_PATH = os.path.join(BASE_DIR, 'config', 'versions.json')
+TREES_DIR = os.path.join(BASE_DIR, 'config', 'trees')
+BLOCKS_DIR = os.path.join(BASE_DIR, 'config', 'blocks')
+# 版本配置文件变化的轮询间隔（秒）
+MANIFEST_POLL_INTERVAL = SERVER_CONFIG.get('manifest_poll_interval', 2)
+# 重新加载配置接口的管理令牌，未配置时只允许本机调用
+ADMIN_TOKEN = SERVER_CONFIG.get('admin_token')
+# 规划更新路径时最多考虑的客户端本地版本数
+MAX_HELD_VERSIONS = 32
 
-VERSION_INFO = load_version_info()
+# 差异文件缓存：记录下载命中，登记按需生成的差异文件并按预算淘汰
+PATCH_CACHE = PatchCache(PATCHES_DIR, BLOCKS_DIR, os.path.join(BASE_DIR, 'config'), PATCH_CACHE_CONFIG)
+PATCH_ON_DEMAND = PATCH_CACHE_CONFIG.get('on_demand', True)
+# 差异文件生成中时建议客户端的重试间隔（秒）
+PATCH_RETRY_AFTER = PATCH_CACHE_CONFIG.get('retry_after', 5)
+# 生成锁超过该时间（秒）视为残留（生成进程已退出）
+PATCH_LOCK_TIMEOUT = 3600
+# 生成失败后在该时间（秒）内不再重试同一差异文件
+PATCH_FAILURE_COOLDOWN = 300
+# 本进程内进行中的生成任务（差异文件路径 -> 任务）和最近的失败时间
+PATCH_JOBS = {}
+PATCH_FAILURES = {}
+# 生成差异文件的进程池，首次需要时创建
+PATCH_EXECUTOR = None
+# 客户端版本分布的滚动计数（来自检查更新请求上报的当前版本）
+POPULATION = VersionPopulation(
+    os.path.join(BASE_DIR, 'config', 'version_population.json'), PATCH_CACHE_CONFIG.get('population_window_hours', 168)
+)
+# 发布新版本后为客户端最多的 K 个版本预先生成差异文件，0 表示不预先生成
+PREGENERATE_TOP_K = PATCH_CACHE_CONFIG.get('pregenerate_top_k', 5)
+# 最新版本不变时重新检查预先生成的间隔（秒），客户端版本分布可能已经变化
+PREGENERATE_INTERVAL = 3600
+
+# 运行指标：每个进程在内存中累计并定期写入日志目录，/metrics 合并后输出
+METRICS_ENABLED = SERVER_CONFIG.get('metrics', True)
+METRICS = Metrics(os.path.join(LOG_DIR, 'metrics'))
+define_download_metrics(METRICS)
+METRICS.define('update_check_requests_total', 'counter', '检查更新请求数，按状态码（200 或 304）')
+METRICS.define('update_check_not_modified_ratio', 'gauge', '检查更新请求中 304 的比例')
+METRICS.define('update_plans_total', 'counter', '下发的更新方案数，按版本对和方式（patch 或 full）')
+METRICS.define('update_plan_patch_ratio', 'gauge', '各版本对的更新方案中差异更新的比例')
+METRICS.define('update_manifest_reloads_total', 'counter', '版本配置重新加载次数（各 worker 进程分别计数）')
+METRICS.define('update_manifest_generation', 'gauge', '当前版本配置快照的代次', aggregate='max')
+METRICS.define('update_patch_generations_total', 'counter', '按需生成差异文件的次数，按结果（success 或 failure）')
+METRICS.define('update_patch_cache_evictions_total', 'counter', '差异文件缓存淘汰的文件数')
+
+# 当前版本配置快照，只在重建完成后整体替换引用
+SNAPSHOT = load_manifest_snapshot(MANIFEST_PATH, 0, VERSIONS_DIR, PATCHES_DIR, PATCH_CACHE, PATCH_ON_DEMAND)
+METRICS.set('update_manifest_generation', SNAPSHOT.generation)
+
+def rebuild_snapshot():
+    """重新读取版本配置和按需生成差异文件索引并原子替换快照；解析失败时保留旧快照"""
+    global SNAPSHOT
+    snapshot = load_manifest_snapshot(
+        MANIFEST_PATH, SNAPSHOT.generation + 1, VERSIONS_DIR, PATCHES_DIR, PATCH_CACHE, PATCH_ON_DEMAND
+    )
+    SNAPSHOT = snapshot
+    # 旧快照的响应不会再命中，清空以释放旧快照
+    client_response.cache_clear()
+    METRICS.inc('update_manifest_reloads_total')
+    METRICS.set('update_manifest_generation', snapshot.generation)
+    logging.info(f"版本配置已重新加载: 代次 {snapshot.generation}, 最新版本 {snapshot.latest_version}")
+    return snapshot
+
+async def watch_manifest():
+    """后台轮询版本配置文件和按需生成差异文件索引，变化时重建快照
+
+    同时写入累计的差异文件命中、版本分布计数和运行指标，最新版本变化后预先生成热门版本的差异文件。
+    """
+    pregenerated_version, pregenerated_at = None, 0
+    while True:
+        await asyncio.sleep(MANIFEST_POLL_INTERVAL)
+        try:
+            if snapshot_stat_key(MANIFEST_PATH, PATCH_CACHE) != SNAPSHOT.stat_key:
+                await asyncio.to_thread(rebuild_snapshot)
+        except Exception as e:
+            logging.error(f"重新加载版本配置失败，继续使用旧配置: {str(e)}")
+        try:
+            await asyncio.to_thread(PATCH_CACHE.flush_hits)
+            await asyncio.to_thread(POPULATION.flush)
+        except Exception as e:
+            logging.error(f"写入差异文件命中和版本分布记录失败: {str(e)}")
+        if METRICS_ENABLED:
+            try:
+                await asyncio.to_thread(METRICS.dump)
+            except Exception as e:
+                logging.error(f"写入运行指标失败: {str(e)}")
+        snapshot = SNAPSHOT
+        if PATCH_ON_DEMAND and PREGENERATE_TOP_K and (
+            snapshot.latest_version != pregenerated_version or time.monotonic() - pregenerated_at > PREGENERATE_INTERVAL
+        ):
+            pregenerated_version, pregenerated_at = snapshot.latest_version, time.monotonic()
+            try:
+                await pregenerate_patches(snapshot)
+            except Exception as e:
+                logging.error(f"预先生成差异文件失败: {str(e)}")
+
+async def pregenerate_patches(snapshot):
+    """为客户端最多的 K 个版本预先生成到最新版本的差异文件（已有差异文件的跳过）"""
+    latest_version = snapshot.latest_version
+    ranked = await asyncio.to_thread(POPULATION.top_versions, PREGENERATE_TOP_K, {latest_version})
+    started = []
+    for version, count in ranked:
+        patch_file = os.path.join(PATCHES_DIR, f'patch_{version}_to_{latest_version}.diff')
+        if os.path.exists(patch_file) or not snapshot.can_generate_patch(version, latest_version):
+            continue
+        if start_patch_job(version, latest_version, patch_file):
+            started.append(f"{version}（{count} 次检查）")
+    if started:
+        logging.info(f"预先生成到版本 {latest_version} 的差异文件: {', '.join(started)}")
+
+def lock_owner_alive(lock_path):
+    """生成锁的持有进程是否仍在运行（锁文件内容为持有进程的 pid）"""
+    try:
+        with open(lock_path, 'r') as f:
+            content = f.read()
+        if not content:
+            # 刚创建、尚未写入 pid
+            return True
+        os.kill(int(content), 0)
+        return True
+    except PermissionError:
+        return True
+    except (OSError, ValueError):
+        return False
+
+def claim_patch_lock(lock_path):
+    """取得跨 worker 进程的差异文件生成锁，已被其他进程持有时返回 False
+
+    持有进程已退出或锁超过 PATCH_LOCK_TIMEOUT 时视为残留锁，删除后重新获取。
+    """
+    for _ in range(2):
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) < PATCH_LOCK_TIMEOUT and lock_owner_alive(lock_path):
+                    return False
+                os.remove(lock_path)
+            except FileNotFoundError:
+                pass
+            continue
+        with os.fdopen(fd, 'w') as f:
+            f.write(str(os.getpid()))
+        return True
+    return False
+
+async def run_patch_job(from_version, to_version, patch_file, lock_path):
+    """在进程池中生成差异文件，完成后登记到差异文件缓存并重建快照"""
+    global PATCH_EXECUTOR
+    try:
+        if PATCH_EXECUTOR is None:
+            # 服务器进程有多个线程，用 spawn 启动生成进程，避免 fork 继承锁和连接
+            PATCH_EXECUTOR = ProcessPoolExecutor(
+                max_workers=PATCH_CACHE_CONFIG.get('workers', 1), mp_context=multiprocessing.get_context('spawn'),
+                initializer=init_on_demand_worker
+            )
+        started = time.monotonic()
+        patch_info = await asyncio.get_running_loop().run_in_executor(
+            PATCH_EXECUTOR, generate_patch_on_demand, from_version, to_version
+        )
+        removed = await asyncio.to_thread(PATCH_CACHE.add, patch_info)
+        METRICS.inc('update_patch_generations_total', (('result', 'success'),))
+        if removed:
+            METRICS.inc('update_patch_cache_evictions_total', amount=len(removed))
+        await asyncio.to_thread(rebuild_snapshot)
+        logging.info(
+            f"已按需生成差异文件 {patch_info['patch_file']}: {patch_info['size']} 字节, "
+            f"用时 {time.monotonic() - started:.1f} 秒" + (f", 淘汰 {', '.join(removed)}" if removed else "")
+        )
+    except Exception as e:
+        PATCH_FAILURES[patch_file] = time.monotonic()
+        METRICS.inc('update_patch_generations_total', (('result', 'failure'),))
+        logging.error(f"按需生成差异文件失败 {from_version} -> {to_version}: {str(e)}")
+    finally:
+        PATCH_JOBS.pop(patch_file, None)
+        try:
+            os.remove(lock_path)
+        except FileNotFoundError:
+            pass
+
+def start_patch_job(from_version, to_version, patch_file):
+    """开始按需生成差异文件（已在生成中时不重复开始），最近生成失败时返回 False"""
+    if patch_file in PATCH_JOBS:
+        return True
+    failed_at = PATCH_FAILURES.get(patch_file)
+    if failed_at is not None and time.monotonic() - failed_at < PATCH_FAILURE_COOLDOWN:
+        return False
+    lock_path = patch_file + '.lock'
+    if claim_patch_lock(lock_path):
+        PATCH_JOBS[patch_file] = asyncio.create_task(run_patch_job(from_version, to_version, patch_file, lock_path))
+    # 未取得锁说明其他 worker 进程正在生成
+    return True
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """服务器生命周期管理"""
-    # 启动时的操作
-    global VERSION_INFO
-    
     # 确保必要的目录存在
     os.makedirs(VERSIONS_DIR, exist_ok=True)
     os.makedirs(PATCHES_DIR, exist_ok=True)
     
-    # 确保版本目录存在并创建测试文件
-    for version, info in VERSION_INFO['versions'].items():
-        version_dir = os.path.join(VERSIONS_DIR, f'v{version}')
-        os.makedirs(version_dir, exist_ok=True)
-        
-        file_path = os.path.join(version_dir, 'app.txt')
-        if os.path.exists(file_path):
-            # 如果文件已存在，只更新MD5
-            info['md5'] = calculate_file_md5(file_path)
-            logging.info(f"更新版本 {version} 的文件 MD5: {info['md5']}")
+    # 启动版本配置监视任务
+    watcher = asyncio.create_task(watch_manifest())
     
     yield
     
     # 关闭时的操作
-    pass
+    watcher.cancel()
+    PATCH_CACHE.flush_hits()
+    POPULATION.flush()
+    METRICS.remove_dump()
+    if PATCH_EXECUTOR is not None:
+        PATCH_EXECUTOR.shutdown(wait=False, cancel_futures=True)
 
-def calculate_file_md5(file_path):
-    """计算文件MD5"""
-    md5_hash = hashlib.md5()
-    with open(file_path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            md5_hash.update(chunk)
-    return md5_hash.hexdigest()
+app = FastAPI(title="软件增量更新系统", lifespan=lifespan)
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware, metrics=METRICS)
+
+def is_admin_request(request, x_admin_token, authorization=None):
+    """管理接口的访问控制：配置了管理令牌时校验令牌（X-Admin-Token 或 Bearer），否则只允许本机调用"""
+    if ADMIN_TOKEN:
+        return x_admin_token == ADMIN_TOKEN or authorization == f'Bearer {ADMIN_TOKEN}'
+    return request.client is not None and request.client.host in ('127.0.0.1', '::1')
+
+def record_plan(current_version, target_version, method):
+    """按版本对统计下发的更新方案（服务器不认识的客户端版本记为 unknown）"""
+    if method == 'none':
+        return
+    if not SNAPSHOT.has_version(current_version):
+        current_version = 'unknown'
+    METRICS.inc(
+        'update_plans_total', (('from_version', current_version), ('to_version', target_version), ('method', method))
+    )
+
+def etag_matches(if_none_match, etag):
+    """判断 If-None-Match 是否命中（忽略弱校验前缀和编码后缀）"""
+    if if_none_match.strip() == '*':
+        return True
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == etag or candidate == etag[:-1] + '-gzip"':
+            return True
+    return False
 
 @app.get("/check_update")
-async def check_update():
-    """检查更新接口"""
-    return VERSION_INFO
+async def check_update(
+    request: Request,
+    current_version: Optional[str] = Query(default=None),
+    if_none_match: Optional[str] = Header(default=None),
+    accept_encoding: Optional[str] = Header(default=None)
+):
+    """检查更新接口：按客户端版本返回精简信息，支持 ETag 条件请求
+
+    客户端上报的当前版本计入版本分布（只统计已发布的版本，按客户端 IP 去重），用于预先生成差异文件。
+    """
+    snapshot = SNAPSHOT
+    if current_version and snapshot.has_version(current_version):
+        POPULATION.record(current_version, request.client.host if request.client else '')
+    etag, body, gzip_body = snapshot.check_update_response(current_version)
+    use_gzip = accept_encoding is not None and 'gzip' in accept_encoding.lower()
+    headers = {
+        'ETag': etag[:-1] + '-gzip"' if use_gzip else etag,
+        'Vary': 'Accept-Encoding',
+        'Cache-Control': 'no-cache'
+    }
+    
+    if if_none_match and etag_matches(if_none_match, etag):
+        METRICS.inc('update_check_requests_total', (('status', '304'),))
+        return Response(status_code=304, headers=headers)
+    METRICS.inc('update_check_requests_total', (('status', '200'),))
+    if current_version:
+        record_plan(current_version, snapshot.latest_version, snapshot.client_plan_method(current_version))
+    
+    if use_gzip:
+        headers['Content-Encoding'] = 'gzip'
+        return Response(content=gzip_body, media_type='application/json', headers=headers)
+    return Response(content=body, media_type='application/json', headers=headers)
+
+@app.get("/update_plan")
+async def update_plan(
+    current_version: str,
+    target_version: Optional[str] = Query(default=None),
+    held_versions: Optional[str] = Query(default=None)
+):
+    """更新路径规划接口：返回最省流量的差异文件链或完整下载
+
+    held_versions 为客户端本地持有的其他版本（逗号分隔），差异文件链可从其中最省流量的版本出发。
+    """
+    snapshot = SNAPSHOT
+    target_version = target_version or snapshot.latest_version
+    if not snapshot.has_version(target_version):
+        raise HTTPException(status_code=404, detail="Version not found")
+    held = [version for version in (held_versions or '').split(',') if snapshot.has_version(version)]
+    plan = snapshot.plan(current_version, target_version, held[:MAX_HELD_VERSIONS])
+    record_plan(current_version, target_version, plan['method'])
+    logging.info(
+        f"更新路径规划: {current_version} -> {target_version}, "
+        f"方式: {plan['method']}, 基准: {plan.get('base_version', current_version)}, "
+        f"步数: {len(plan['steps'])}, 大小: {plan['total_size']}"
+    )
+    return plan
 
-@app.get("/download/{version}/{filename}")
+@app.api_route("/download/{version}/{filename:path}", methods=["GET", "HEAD"])
 async def download_file(
     version: str, 
     filename: str, 
-    range: Optional[str] = Header(default=None)
+    range: Optional[str] = Header(default=None),
+    if_range: Optional[str] = Header(default=None),
+    accept_encoding: Optional[str] = Header(default=None)
 ):
-    """文件下载接口"""
-    file_path = os.path.join(VERSIONS_DIR, f'v{version}', filename)
-    if not os.path.exists(file_path):
+    """文件下载接口（支持 Range 断点续传和预压缩版本协商，目录版本可使用相对路径）"""
+    file_path = safe_join(os.path.join(VERSIONS_DIR, f'v{version}'), filename)
+    if file_path is None:
+        raise HTTPException(status_code=400, detail="Invalid file path")
+    # 有预压缩版本时按 Accept-Encoding 选择最小的一个，Range 和 ETag 均针对压缩后的数据
+    encoding, send_path, has_variants = negotiate_encoding(
+        accept_encoding, file_path, range, if_range, FILE_CACHE.stat
+    )
+    extra_headers = {'Vary': 'Accept-Encoding'} if has_variants else None
+    if encoding:
+        extra_headers['Content-Encoding'] = encoding
+    try:
+        return build_cached_file_response(
+            FILE_CACHE, send_path, range, if_range, filename=os.path.basename(filename), extra_headers=extra_headers
+        )
+    except FileNotFoundError:
+        # 完整副本已清理时由块存储提供
+        if filename == 'app' and CHUNK_STORE.has_index(version):
+            return build_chunked_response(version, range, if_range)
         logging.error(f"文件未找到: {file_path}")
         raise HTTPException(status_code=404, detail="File not found")
-    return FileResponse(file_path, filename=filename)
 
-@app.get("/download_patch/{from_version}/{to_version}")
-async def download_patch(from_version: str, to_version: str):
-    """下载差异文件"""
-    patch_file = os.path.join(PATCHES_DIR, f'patch_{from_version}_to_{to_version}.diff')
-    if not os.path.exists(patch_file):
+def build_chunked_response(version, range_header, if_range):
+    """由块存储按区间拼接出版本文件的响应"""
+    index = CHUNK_STORE.load_index(version)
+    return build_range_response(
+        lambda start, end: CHUNK_STORE.iter_range(index, start, end),
+        index['size'],
+        f'"{index["md5"]}"',
+        os.path.getmtime(CHUNK_STORE.index_path(version)),
+        range_header,
+        if_range,
+        filename='app'
+    )
+
+@app.get("/tree_manifest/{version}")
+async def download_tree_manifest(version: str):
+    """下载目录版本的文件清单"""
+    manifest_path = os.path.join(TREES_DIR, f'v{version}.json')
+    if not os.path.exists(manifest_path):
+        raise HTTPException(status_code=404, detail="Tree manifest not found")
+    return build_file_response(manifest_path, media_type='application/json')
+
+@app.get("/block_hashes/{name}")
+async def download_block_hashes(name: str):
+    """下载完整文件或差异文件的块哈希清单"""
+    blocks_path = safe_join(BLOCKS_DIR, name)
+    if blocks_path is None or not os.path.isfile(blocks_path):
+        raise HTTPException(status_code=404, detail="Block hashes not found")
+    return build_file_response(blocks_path, media_type='application/json')
+
+@app.api_route("/download_tree_patch/{from_version}/{to_version}/{file_path:path}", methods=["GET", "HEAD"])
+async def download_tree_patch(
+    from_version: str,
+    to_version: str,
+    file_path: str,
+    range: Optional[str] = Header(default=None),
+    if_range: Optional[str] = Header(default=None)
+):
+    """下载目录版本中单个文件的差异文件"""
+    patch_file = safe_join(os.path.join(PATCHES_DIR, f'tree_{from_version}_to_{to_version}'), file_path + '.diff')
+    if patch_file is None:
+        raise HTTPException(status_code=400, detail="Invalid file path")
+    if not os.path.isfile(patch_file):
         raise HTTPException(status_code=404, detail="Patch file not found")
-    return FileResponse(patch_file)
+    return build_file_response(patch_file, range, if_range)
+
+@app.get("/chunk_index/{version}")
+async def download_chunk_index(version: str):
+    """下载某个版本的块索引"""
+    if not CHUNK_STORE.has_index(version):
+        raise HTTPException(status_code=404, detail="Chunk index not found")
+    return build_file_response(CHUNK_STORE.index_path(version), media_type='application/json')
+
+@app.get("/chunk/{digest}")
+async def download_chunk(
+    digest: str,
+    range: Optional[str] = Header(default=None),
+    if_range: Optional[str] = Header(default=None)
+):
+    """按摘要下载单个块"""
+    if len(digest) != 40 or any(c not in '0123456789abcdef' for c in digest):
+        raise HTTPException(status_code=400, detail="Invalid chunk digest")
+    object_path = CHUNK_STORE.object_path(digest)
+    if not os.path.exists(object_path):
+        raise HTTPException(status_code=404, detail="Chunk not found")
+    return build_file_response(object_path, range, if_range)
+
+@app.api_route("/download_patch/{from_version}/{to_version}", methods=["GET", "HEAD"])
+async def download_patch(
+    request: Request,
+    from_version: str,
+    to_version: str,
+    range: Optional[str] = Header(default=None),
+    if_range: Optional[str] = Header(default=None)
+):
+    """下载差异文件（支持 Range 断点续传）
+
+    差异文件不存在但两个版本都可用时在后台按需生成，返回 202 和 Retry-After，客户端稍后重试。
+    """
+    patch_file = safe_join(PATCHES_DIR, f'patch_{from_version}_to_{to_version}.diff')
+    if patch_file is None:
+        raise HTTPException(status_code=400, detail="Invalid version")
+    try:
+        response = build_cached_file_response(FILE_CACHE, patch_file, range, if_range)
+    except FileNotFoundError:
+        if request.method == 'GET' and is_initial_request(range):
+            METRICS.inc('update_patch_cache_requests_total', (('result', 'miss'),))
+        if not SNAPSHOT.can_generate_patch(from_version, to_version):
+            raise HTTPException(status_code=404, detail="Patch file not found")
+        if not start_patch_job(from_version, to_version, patch_file):
+            raise HTTPException(status_code=404, detail="Patch generation failed")
+        return JSONResponse(
+            {"status": "generating", "retry_after": PATCH_RETRY_AFTER},
+            status_code=202,
+            headers={'Retry-After': str(PATCH_RETRY_AFTER)}
+        )
+    if request.method == 'GET' and is_initial_request(range):
+        PATCH_CACHE.record_hit(os.path.basename(patch_file))
+        METRICS.inc('update_patch_cache_requests_total', (('result', 'hit'),))
+    return response
 
 @app.get("/", response_class=HTMLResponse)
 async def root():
@@ -115,26 +496,63 @@ async def root():
             <p>可用的API端点：</p>
             <ul>
                 <li><a href="/docs">/docs</a> - API文档</li>
-                <li><a href="/check_update">/check_update</a> - 检查更新</li>
+                <li><a href="/check_update">/check_update</a> - 检查更新（可附带 ?current_version={version}）</li>
+                <li>/update_plan?current_version={version}&held_versions={versions} - 更新路径规划（可附带本地持有的其他版本）</li>
                 <li>/download/{version}/{filename} - 下载文件</li>
                 <li>/download_patch/{from_version}/{to_version} - 下载差异文件</li>
+                <li>/tree_manifest/{version} - 下载目录版本的文件清单</li>
+                <li>/download_tree_patch/{from_version}/{to_version}/{path} - 下载单个文件的差异文件</li>
+                <li>/block_hashes/{name} - 下载文件的块哈希清单</li>
+                <li>/chunk_index/{version} - 下载块索引</li>
+                <li>/chunk/{digest} - 下载单个块</li>
+                <li>/metrics - 运行指标（Prometheus 文本格式，仅本机或管理令牌）</li>
             </ul>
         </body>
     </html>
     """
 
-@app.get("/reload_config")
-async def reload_config():
-    """重新加载配置接口"""
-    global VERSION_INFO
+@app.post("/reload_config")
+async def reload_config(request: Request, x_admin_token: Optional[str] = Header(default=None)):
+    """立即重新加载版本配置（配置文件变化时也会被后台任务自动加载）"""
+    if not is_admin_request(request, x_admin_token):
+        raise HTTPException(status_code=403, detail="Forbidden")
     try:
-        VERSION_INFO = load_version_info()
-        logging.info("配置重新加载成功")
-        return {"status": "success", "message": "配置已重新加载"}
+        snapshot = await asyncio.to_thread(rebuild_snapshot)
+        return {"status": "success", "message": "配置已重新加载", "generation": snapshot.generation}
     except Exception as e:
         logging.error(f"重新加载配置失败: {str(e)}")
         raise HTTPException(status_code=500, detail="重新加载配置失败")
 
+@app.get("/metrics")
+async def metrics(
+    request: Request,
+    x_admin_token: Optional[str] = Header(default=None),
+    authorization: Optional[str] = Header(default=None)
+):
+    """运行指标（Prometheus 文本格式），合并所有 worker 进程和下载服务进程的数值"""
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics disabled")
+    if not is_admin_request(request, x_admin_token, authorization):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    values = await asyncio.to_thread(METRICS.collect)
+    add_ratio_metrics(values)
+    return PlainTextResponse(METRICS.render(values), media_type='text/plain; version=0.0.4')
+
+def add_ratio_metrics(values):
+    """由合并后的计数计算 304 比例和各版本对的差异更新比例"""
+    checks = {dict(labels)['status']: count for labels, count in values['update_check_requests_total'].items()}
+    total = sum(checks.values())
+    if total:
+        values['update_check_not_modified_ratio'][()] = checks.get('304', 0) / total
+    pairs = {}
+    for labels, count in values['update_plans_total'].items():
+        label_map = dict(labels)
+        counts = pairs.setdefault((('from_version', label_map['from_version']), ('to_version', label_map['to_version'])), [0, 0])
+        counts[0] += count if label_map['method'] == 'patch' else 0
+        counts[1] += count
+    for pair, (patch_count, pair_total) in pairs.items():
+        values['update_plan_patch_ratio'][pair] = patch_count / pair_total
+
 if __name__ == '__main__':
     import uvicorn
     uvicorn.run(
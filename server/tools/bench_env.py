@@ -0,0 +1,192 @@
+import os
+import sys
+import json
+import zlib
+import random
+import shutil
+import socket
+import struct
+import subprocess
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# 复制服务器目录时跳过的运行时数据
+RUNTIME_ENTRIES = ('versions', 'patches', 'chunks', 'config', 'logs', '__pycache__', '*.pyc')
+# 合成文件的生成粒度
+SEGMENT_SIZE = 64 * 1024
+# 合成打包程序中每个模块压缩前的平均大小
+BUNDLE_MEMBER_SIZE = 192 * 1024
+# 合成打包程序末尾的标记（与 PyInstaller 的 CArchive 相同）
+BUNDLE_COOKIE_MAGIC = b'MEI\014\013\012\013\016'
+
+
+def free_port():
+    """取得一个本机空闲端口"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def copy_server_tree(work_dir, overrides=None):
+    """把服务器代码复制到隔离目录（不含版本、差异文件等运行时数据），按 overrides 覆盖配置的各个段"""
+    shutil.copytree(SERVER_DIR, work_dir, ignore=shutil.ignore_patterns(*RUNTIME_ENTRIES))
+    update_tree_config(work_dir, overrides or {})
+    return work_dir
+
+
+def update_tree_config(work_dir, overrides):
+    """覆盖隔离目录中服务器配置的各个段（按键合并）"""
+    config_path = os.path.join(work_dir, 'server_config.json')
+    with open(config_path, 'r') as f:
+        config = json.load(f)
+    for section, values in overrides.items():
+        config.setdefault(section, {}).update(values)
+    with open(config_path, 'w') as f:
+        json.dump(config, f, indent=4, ensure_ascii=False)
+
+
+def add_version_in_tree(work_dir, version, file_path, description='', quiet=True):
+    """在隔离目录中发布一个版本
+
+    VersionManager 的数据目录由模块所在位置决定，因此在隔离目录中启动子进程运行。
+    """
+    code = (
+        "import sys; from tools.version_manager import VersionManager; "
+        "VersionManager().add_version(sys.argv[1], sys.argv[2], sys.argv[3])"
+    )
+    subprocess.run(
+        [sys.executable, '-c', code, version, os.path.abspath(file_path), description],
+        cwd=work_dir, check=True,
+        stdout=subprocess.DEVNULL if quiet else None, stderr=subprocess.DEVNULL if quiet else None
+    )
+
+
+def synthetic_segment(rng, size):
+    """生成一段接近可执行文件的内容：代码、已压缩数据、字符串表和填充按比例混合"""
+    kind = rng.random()
+    if kind < 0.4:
+        # 指令序列：从有限的指令字中随机选取，可压缩但不重复
+        words = [rng.randbytes(4) for _ in range(256)]
+        return b''.join(map(words.__getitem__, rng.randbytes(size // 4))).ljust(size, b'\0')
+    if kind < 0.75:
+        # 已压缩的资源，几乎不可压缩
+        return rng.randbytes(size)
+    if kind < 0.9:
+        # 字符串表
+        words = [rng.randbytes(rng.randrange(4, 12)).hex().encode() for _ in range(256)]
+        return b'\0'.join(map(words.__getitem__, rng.randbytes(size // 8 + 1)))[:size].ljust(size, b'\0')
+    return bytes(size)
+
+
+def write_synthetic_binary(path, size, seed):
+    """按块写入 size 字节的合成二进制文件（内容只由 seed 决定）"""
+    rng = random.Random(seed)
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            segment = synthetic_segment(rng, min(SEGMENT_SIZE, remaining))
+            f.write(segment)
+            remaining -= len(segment)
+    return path
+
+
+def write_edited_copy(src, dst, seed, edits, edit_size):
+    """流式复制 src 到 dst，并在随机位置做 edits 处替换、插入或删除（每处约 edit_size 字节）"""
+    rng = random.Random(seed)
+    size = os.path.getsize(src)
+    positions = sorted(rng.randrange(size) for _ in range(edits))
+    with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+        offset = 0
+        for position in positions:
+            if position < offset:
+                continue
+            shutil.copyfileobj(_LimitedReader(fin, position - offset), fout)
+            offset = position
+            action = rng.random()
+            if action < 0.6:
+                # 替换
+                length = min(edit_size, size - offset)
+                fin.seek(length, os.SEEK_CUR)
+                offset += length
+                fout.write(rng.randbytes(length))
+            elif action < 0.85:
+                # 插入
+                fout.write(rng.randbytes(edit_size))
+            else:
+                # 删除
+                length = min(edit_size, size - offset)
+                fin.seek(length, os.SEEK_CUR)
+                offset += length
+        shutil.copyfileobj(fin, fout)
+    return dst
+
+
+def edit_member(data, rng, edits):
+    """在模块内容中做若干处小修改（模拟源码改动后重新编译的模块）"""
+    data = bytearray(data)
+    for _ in range(edits):
+        position = rng.randrange(len(data))
+        length = rng.randrange(8, 256)
+        data[position:position + length] = rng.randbytes(rng.randrange(8, 256))
+    return bytes(data)
+
+
+def write_bundle(path, size, seed, edit_seed=None, edit_fraction=0.05):
+    """写入类似 PyInstaller 单文件程序的合成文件：引导程序 + 逐个 zlib 压缩的模块 + 目录 + 结尾标记
+
+    模块的数量和内容只由 seed 和 size 决定；给定 edit_seed 时修改入口模块（第一个）并按 edit_fraction 修改其余模块，
+    修改后的模块重新压缩，之后所有模块的偏移和目录都随之变化，与真实的重新打包一致。
+    """
+    rng = random.Random(seed)
+    edit_rng = random.Random(edit_seed) if edit_seed is not None else None
+    bootloader_size = min(max(size // 16, 64 * 1024), 2 * 1024 * 1024)
+    with open(path, 'wb') as f:
+        bootloader_rng = random.Random(seed ^ 0x5eed)
+        remaining = bootloader_size
+        while remaining > 0:
+            segment = synthetic_segment(bootloader_rng, min(SEGMENT_SIZE, remaining))
+            f.write(segment)
+            remaining -= len(segment)
+        archive_start = f.tell()
+
+        toc = []
+        index = 0
+        # 模块按压缩前大小累计，新旧版本的模块数量一致
+        while f.tell() < size * 0.97:
+            member_rng = random.Random(f'{seed}:{index}')
+            length = member_rng.randrange(BUNDLE_MEMBER_SIZE // 4, BUNDLE_MEMBER_SIZE * 7 // 4)
+            content = b''.join(
+                synthetic_segment(member_rng, min(SEGMENT_SIZE, length - offset))
+                for offset in range(0, length, SEGMENT_SIZE)
+            )
+            if edit_rng is not None and (edit_rng.random() < edit_fraction or index == 0):
+                content = edit_member(content, edit_rng, edits=edit_rng.randrange(1, 8))
+            compressed = zlib.compress(content, 6)
+            toc.append((f.tell() - archive_start, len(compressed), len(content), f'module_{index:05d}.pyc'))
+            f.write(compressed)
+            index += 1
+
+        toc_start = f.tell() - archive_start
+        for offset, length, raw_length, name in toc:
+            encoded = name.encode('utf-8') + b'\0'
+            f.write(struct.pack('!iiiiBc', 18 + len(encoded), offset, length, raw_length, 1, b'm') + encoded)
+        toc_length = f.tell() - archive_start - toc_start
+        archive_length = f.tell() - archive_start + 88
+        f.write(struct.pack('!8sIIii64s', BUNDLE_COOKIE_MAGIC, archive_length, toc_start, toc_length, 311, b'libpython3.11.so'))
+    return path
+
+
+class _LimitedReader:
+    """只读取底层文件接下来 limit 字节的文件对象（供 copyfileobj 使用）"""
+
+    def __init__(self, file, limit):
+        self.file = file
+        self.remaining = limit
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return b''
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
@@ -0,0 +1,173 @@
+import os
+import json
+import hashlib
+from functools import lru_cache
+
+# 64 位 Gear 滚动哈希表，由固定种子生成，保证每次切分结果一致
+GEAR = [
+    int.from_bytes(hashlib.blake2b(b'gear' + bytes([i]), digest_size=8).digest(), 'little')
+    for i in range(256)
+]
+MASK_64 = (1 << 64) - 1
+# 块内容摘要长度（字节）
+DIGEST_SIZE = 20
+
+
+def chunk_digest(data):
+    """计算块内容摘要"""
+    return hashlib.blake2b(data, digest_size=DIGEST_SIZE).hexdigest()
+
+
+def find_cut_point(data, min_size, max_size, mask):
+    """在 data 中寻找下一个内容定义的切分点，返回块长度"""
+    end = min(len(data), max_size)
+    if end <= min_size:
+        return end
+    gear = GEAR
+    h = 0
+    # 前 min_size 个字节不可能切分，直接跳过
+    for i, byte in enumerate(data[min_size:end], min_size):
+        h = ((h << 1) + gear[byte]) & MASK_64
+        if not h & mask:
+            return i + 1
+    return end
+
+
+def iter_chunks(file_path, min_size, avg_size, max_size):
+    """按内容定义切分文件，依次返回每个块的字节"""
+    # 判断条件使用哈希的高位，平均块大小取 2 的幂
+    bits = avg_size.bit_length() - 1
+    mask = ((1 << bits) - 1) << (64 - bits)
+
+    buffer = bytearray()
+    eof = False
+    with open(file_path, 'rb') as f:
+        while True:
+            while not eof and len(buffer) < max_size:
+                data = f.read(max_size)
+                if data:
+                    buffer += data
+                else:
+                    eof = True
+            if not buffer:
+                break
+            length = find_cut_point(buffer, min_size, max_size, mask)
+            yield bytes(buffer[:length])
+            del buffer[:length]
+
+
+class ChunkStore:
+    """内容寻址的块存储：每个块按摘要只保存一份，每个版本发布一个块索引"""
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        self.objects_dir = os.path.join(root_dir, 'objects')
+        self.index_dir = os.path.join(root_dir, 'index')
+
+    def object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest)
+
+    def index_path(self, version):
+        return os.path.join(self.index_dir, f'v{version}.json')
+
+    def has_index(self, version):
+        return os.path.exists(self.index_path(version))
+
+    def add_file(self, version, file_path, md5, min_size, avg_size, max_size):
+        """切分文件并写入块存储，生成该版本的块索引，返回统计信息"""
+        os.makedirs(self.index_dir, exist_ok=True)
+        chunks = []
+        new_chunks = 0
+        new_bytes = 0
+        size = 0
+        for data in iter_chunks(file_path, min_size, avg_size, max_size):
+            digest = chunk_digest(data)
+            chunks.append([digest, len(data)])
+            size += len(data)
+            object_path = self.object_path(digest)
+            if not os.path.exists(object_path):
+                os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                temp_path = object_path + '.tmp'
+                with open(temp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(temp_path, object_path)
+                new_chunks += 1
+                new_bytes += len(data)
+
+        index = {
+            'version': version,
+            'size': size,
+            'md5': md5,
+            'chunking': {
+                'algorithm': 'gear',
+                'digest': f'blake2b-{DIGEST_SIZE * 8}',
+                'min_size': min_size,
+                'avg_size': avg_size,
+                'max_size': max_size
+            },
+            'chunks': chunks
+        }
+        temp_path = self.index_path(version) + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f, separators=(',', ':'))
+        os.replace(temp_path, self.index_path(version))
+
+        return {
+            'file': os.path.basename(self.index_path(version)),
+            'chunks': len(chunks),
+            'new_chunks': new_chunks,
+            'new_bytes': new_bytes
+        }
+
+    def load_index(self, version):
+        """读取块索引（按文件修改时间缓存解析结果）"""
+        index_path = self.index_path(version)
+        return _load_index_cached(index_path, os.stat(index_path).st_mtime_ns)
+
+    def iter_range(self, index, start, end):
+        """按块读取版本文件的 [start, end] 字节区间"""
+        offset = 0
+        for digest, size in index['chunks']:
+            if offset > end:
+                break
+            chunk_end = offset + size - 1
+            if chunk_end >= start:
+                with open(self.object_path(digest), 'rb') as f:
+                    f.seek(max(start - offset, 0))
+                    yield f.read(min(end, chunk_end) - max(start, offset) + 1)
+            offset += size
+
+    def materialize(self, version, dest_file):
+        """由块存储重建某个版本的完整文件"""
+        index = self.load_index(version)
+        temp_path = dest_file + '.tmp'
+        with open(temp_path, 'wb') as f:
+            for data in self.iter_range(index, 0, index['size'] - 1):
+                f.write(data)
+        os.replace(temp_path, dest_file)
+        return dest_file
+
+    def remove_unreferenced(self):
+        """删除没有被任何块索引引用的块，返回删除数量"""
+        if not os.path.exists(self.objects_dir):
+            return 0
+        referenced = set()
+        if os.path.exists(self.index_dir):
+            for name in os.listdir(self.index_dir):
+                if name.endswith('.json'):
+                    with open(os.path.join(self.index_dir, name), 'r', encoding='utf-8') as f:
+                        referenced.update(digest for digest, _ in json.load(f)['chunks'])
+        removed = 0
+        for prefix in os.listdir(self.objects_dir):
+            prefix_dir = os.path.join(self.objects_dir, prefix)
+            for digest in os.listdir(prefix_dir):
+                if digest not in referenced:
+                    os.remove(os.path.join(prefix_dir, digest))
+                    removed += 1
+        return removed
+
+
+@lru_cache(maxsize=32)
+def _load_index_cached(index_path, mtime_ns):
+    with open(index_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
@@ -0,0 +1,25 @@
+import os
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Windows 没有 fcntl，只能依赖单进程部署
+    fcntl = None
+
+
+@contextmanager
+def locked(lock_path):
+    """持有跨进程的排他文件锁（flock），用于多个 worker 进程共用的 JSON 记录的 读取→合并→写入
+
+    锁加在独立的锁文件上，数据文件仍通过 os.replace 整体替换。同一进程内不能嵌套获取同一把锁。
+    """
+    if fcntl is None:
+        yield
+        return
+    fd = os.open(lock_path, os.O_CREAT | os.O_RDWR, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
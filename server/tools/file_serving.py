@@ -0,0 +1,266 @@
+import os
+import uuid
+from email.utils import formatdate, parsedate_to_datetime
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from tools.precompress import ENCODING_SUFFIXES
+
+# 读取文件片段时的块大小
+CHUNK_SIZE = 64 * 1024
+# 单个请求允许的最大区间数，超出时按完整文件返回
+MAX_RANGES = 16
+
+
+class RangeNotSatisfiable(Exception):
+    """请求的区间全部超出文件范围"""
+
+
+def make_etag(stat_result):
+    """根据文件大小和修改时间生成强 ETag"""
+    return f'"{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"'
+
+
+def safe_join(base_dir, rel_path):
+    """拼接相对路径，结果不在 base_dir 内时返回 None（防止路径穿越）"""
+    base_dir = os.path.realpath(base_dir)
+    full_path = os.path.realpath(os.path.join(base_dir, rel_path))
+    if os.path.commonpath([base_dir, full_path]) != base_dir:
+        return None
+    return full_path
+
+
+def parse_accept_encoding(accept_encoding):
+    """解析 Accept-Encoding 请求头，返回 编码 -> q 值"""
+    accepted = {}
+    for part in (accept_encoding or '').split(','):
+        token, _, params = part.strip().partition(';')
+        token = token.strip().lower()
+        if not token:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[token] = q
+    return accepted
+
+
+def negotiate_encoding(accept_encoding, file_path, range_header=None, if_range=None, stat_file=os.stat):
+    """在客户端接受的预压缩版本中选择最小的一个
+
+    Range 请求只有在 If-Range 指向该预压缩版本的 ETag 时才返回压缩数据（续传同一个压缩版本），
+    否则返回原文件的区间，兼容自动解压后按解压大小续传的客户端。
+    返回 (编码, 实际发送的文件, 是否存在预压缩版本)，没有可用的预压缩版本时编码为 None。
+    stat_file 可替换为带缓存的 stat。
+    """
+    variants = []
+    has_variants = False
+    for encoding, suffix in ENCODING_SUFFIXES.items():
+        try:
+            stat_result = stat_file(file_path + suffix)
+        except FileNotFoundError:
+            continue
+        has_variants = True
+        if range_header and if_range != make_etag(stat_result):
+            continue
+        variants.append((stat_result.st_size, encoding, file_path + suffix))
+    if not variants:
+        return None, file_path, has_variants
+    accepted = parse_accept_encoding(accept_encoding)
+    candidates = [
+        variant for variant in variants
+        if accepted.get(variant[1], accepted.get('*', 0)) > 0
+    ]
+    if not candidates:
+        return None, file_path, True
+    _, encoding, variant_path = min(candidates)
+    return encoding, variant_path, True
+
+
+def parse_range_header(range_header, file_size):
+    """解析 Range 请求头，返回排序并合并后的 [(start, end)] 闭区间列表
+
+    格式不合法或不是 bytes 单位时返回 None（按完整文件处理），
+    所有区间都无法满足时抛出 RangeNotSatisfiable。
+    """
+    unit, _, spec = range_header.partition('=')
+    if unit.strip().lower() != 'bytes' or not spec.strip():
+        return None
+
+    ranges = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        start, sep, end = part.partition('-')
+        if not sep:
+            return None
+        start, end = start.strip(), end.strip()
+        try:
+            if start == '':
+                # 后缀区间：最后 N 个字节
+                length = int(end)
+                if length == 0:
+                    continue
+                ranges.append((max(file_size - length, 0), file_size - 1))
+                continue
+            start = int(start)
+            end = int(end) if end else file_size - 1
+        except ValueError:
+            return None
+        if start >= file_size:
+            continue
+        if start > end:
+            return None
+        ranges.append((start, min(end, file_size - 1)))
+
+    if not ranges:
+        raise RangeNotSatisfiable()
+    if len(ranges) > MAX_RANGES:
+        return None
+
+    # 合并重叠或相邻的区间
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        last_start, last_end = merged[-1]
+        if start <= last_end + 1:
+            merged[-1] = (last_start, max(last_end, end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def if_range_matches(if_range, etag, mtime):
+    """判断 If-Range 条件是否成立（ETag 需强匹配，日期需与最后修改时间一致）"""
+    if if_range.startswith('"'):
+        return if_range == etag
+    try:
+        return int(parsedate_to_datetime(if_range).timestamp()) == int(mtime)
+    except (TypeError, ValueError):
+        return False
+
+
+def iter_file_range(file_path, start, end):
+    """按块读取文件的 [start, end] 区间"""
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def iter_multipart_ranges(read_range, ranges, file_size, boundary, media_type):
+    """生成 multipart/byteranges 响应体"""
+    for start, end in ranges:
+        yield (
+            f"--{boundary}\r\n"
+            f"Content-Type: {media_type}\r\n"
+            f"Content-Range: bytes {start}-{end}/{file_size}\r\n\r\n"
+        ).encode()
+        yield from read_range(start, end)
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode()
+
+
+def multipart_length(ranges, file_size, boundary, media_type):
+    """预先计算 multipart/byteranges 响应体长度"""
+    length = 0
+    for start, end in ranges:
+        length += len((
+            f"--{boundary}\r\n"
+            f"Content-Type: {media_type}\r\n"
+            f"Content-Range: bytes {start}-{end}/{file_size}\r\n\r\n"
+        ).encode())
+        length += end - start + 1 + 2
+    return length + len(f"--{boundary}--\r\n".encode())
+
+
+def build_range_response(read_range, file_size, etag, mtime, range_header=None, if_range=None,
+                         filename=None, media_type='application/octet-stream', full_response=None,
+                         extra_headers=None, partial_response=None):
+    """构造支持 Range 的响应：200 完整内容、206 单区间/多区间或 416
+
+    read_range(start, end) 按块返回 [start, end] 区间的字节；full_response(headers) 用于生成 200 响应，
+    partial_response(headers, start, end) 用于生成单区间的 206 响应，未提供时以流式方式返回。
+    extra_headers 会加到所有响应上（如 Content-Encoding）。
+    """
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'ETag': etag,
+        'Last-Modified': formatdate(mtime, usegmt=True)
+    }
+    if extra_headers:
+        headers.update(extra_headers)
+
+    ranges = None
+    if range_header and (if_range is None or if_range_matches(if_range, etag, mtime)):
+        try:
+            ranges = parse_range_header(range_header, file_size)
+        except RangeNotSatisfiable:
+            headers['Content-Range'] = f'bytes */{file_size}'
+            return Response(status_code=416, headers=headers)
+
+    if not ranges:
+        if full_response is not None:
+            return full_response(headers)
+        if filename is not None:
+            headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+        headers['Content-Length'] = str(file_size)
+        return StreamingResponse(
+            read_range(0, file_size - 1) if file_size else iter(()),
+            media_type=media_type,
+            headers=headers
+        )
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers['Content-Range'] = f'bytes {start}-{end}/{file_size}'
+        headers['Content-Length'] = str(end - start + 1)
+        if partial_response is not None:
+            return partial_response(headers, start, end)
+        return StreamingResponse(
+            read_range(start, end),
+            status_code=206,
+            media_type=media_type,
+            headers=headers
+        )
+
+    boundary = uuid.uuid4().hex
+    headers['Content-Length'] = str(multipart_length(ranges, file_size, boundary, media_type))
+    return StreamingResponse(
+        iter_multipart_ranges(read_range, ranges, file_size, boundary, media_type),
+        status_code=206,
+        media_type=f'multipart/byteranges; boundary={boundary}',
+        headers=headers
+    )
+
+
+def build_file_response(file_path, range_header=None, if_range=None, filename=None,
+                        media_type='application/octet-stream', extra_headers=None):
+    """构造支持 Range 的文件响应"""
+    stat_result = os.stat(file_path)
+    return build_range_response(
+        lambda start, end: iter_file_range(file_path, start, end),
+        stat_result.st_size,
+        make_etag(stat_result),
+        stat_result.st_mtime,
+        range_header,
+        if_range,
+        filename=filename,
+        media_type=media_type,
+        extra_headers=extra_headers,
+        full_response=lambda headers: FileResponse(
+            file_path,
+            filename=filename,
+            media_type=media_type,
+            headers=headers,
+            stat_result=stat_result
+        )
+    )
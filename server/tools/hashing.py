@@ -0,0 +1,103 @@
+import hashlib
+from tools.update_formats import BLOCK_DIGEST_SIZE, block_digest, merkle_root
+
+# 复制和计算摘要时的读写块大小
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class BlockHasher:
+    """按固定大小切块，依次计算每块的摘要"""
+
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self.buffer = bytearray()
+        self.leaves = []
+
+    def update(self, data):
+        self.buffer += data
+        if len(self.buffer) < self.block_size:
+            return
+        view = memoryview(self.buffer)
+        offset = 0
+        while len(self.buffer) - offset >= self.block_size:
+            self.leaves.append(block_digest(view[offset:offset + self.block_size]))
+            offset += self.block_size
+        view.release()
+        del self.buffer[:offset]
+
+    def finish(self):
+        """处理最后不足一块的数据，返回全部块摘要"""
+        if self.buffer:
+            self.leaves.append(block_digest(bytes(self.buffer)))
+            self.buffer.clear()
+        return self.leaves
+
+
+class MultiHasher:
+    """同时计算多种摘要（以及可选的块摘要），数据只需经过一次"""
+
+    def __init__(self, algorithms, block_size=None):
+        self.hashers = {algorithm: hashlib.new(algorithm) for algorithm in algorithms}
+        self.block_hasher = BlockHasher(block_size) if block_size else None
+
+    def update(self, data):
+        for hasher in self.hashers.values():
+            hasher.update(data)
+        if self.block_hasher is not None:
+            self.block_hasher.update(data)
+
+    def hexdigests(self):
+        """返回 算法 -> 十六进制摘要；计算块摘要时另含 blocks 列表"""
+        digests = {algorithm: hasher.hexdigest() for algorithm, hasher in self.hashers.items()}
+        if self.block_hasher is not None:
+            digests['blocks'] = self.block_hasher.finish()
+        return digests
+
+
+def digest_algorithms(hash_config):
+    """需要计算的摘要算法：MD5 始终保留以兼容旧客户端，另加配置的校验算法"""
+    algorithm = hash_config.get('algorithm', 'blake2b')
+    return ['md5'] if algorithm == 'md5' else ['md5', algorithm]
+
+
+def format_digest(hash_config, digests):
+    """生成写入版本配置的 digest 字段（"算法:十六进制值"），只使用 MD5 时返回 None"""
+    algorithm = hash_config.get('algorithm', 'blake2b')
+    if algorithm == 'md5':
+        return None
+    return f"{algorithm}:{digests[algorithm]}"
+
+
+def hash_bytes(data, algorithms, block_size=None):
+    """计算内存数据的摘要"""
+    hasher = MultiHasher(algorithms, block_size)
+    hasher.update(data)
+    return hasher.hexdigests()
+
+
+def hash_file(file_path, algorithms, block_size=None):
+    """读取一次文件，计算多种摘要"""
+    hasher = MultiHasher(algorithms, block_size)
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b""):
+            hasher.update(chunk)
+    return hasher.hexdigests()
+
+
+def copy_and_hash(src_file, dest_file, algorithms, progress=None, block_size=None):
+    """复制文件的同时计算摘要，progress(已复制字节数) 用于显示进度"""
+    hasher = MultiHasher(algorithms, block_size)
+    with open(src_file, 'rb') as fsrc, open(dest_file, 'wb') as fdst:
+        for chunk in iter(lambda: fsrc.read(COPY_CHUNK_SIZE), b""):
+            fdst.write(chunk)
+            hasher.update(chunk)
+            if progress is not None:
+                progress(len(chunk))
+    return hasher.hexdigests()
+
+
+def write_and_hash(dest_file, data, algorithms, block_size=None):
+    """写入内存数据并返回其摘要"""
+    with open(dest_file, 'wb') as f:
+        f.write(data)
+    return hash_bytes(data, algorithms, block_size)
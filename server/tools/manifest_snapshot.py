@@ -0,0 +1,148 @@
+import os
+import copy
+import json
+import gzip
+import hashlib
+import functools
+from tools.update_planner import parse_version, build_patch_graph, plan_update
+
+# 按客户端版本缓存的检查更新响应条目上限（LRU）
+CLIENT_RESPONSE_CACHE_LIMIT = 1024
+
+
+def encode_json(data):
+    """紧凑编码 JSON"""
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def make_body_etag(body):
+    """根据响应体内容生成强 ETag"""
+    return f'"{hashlib.md5(body).hexdigest()}"'
+
+
+class ManifestSnapshot:
+    """版本配置的不可变快照
+
+    构建时一次性完成解析、补全文件大小、版本排序、差异文件图、可按需生成差异文件的版本和完整配置的预编码，
+    请求处理只读取快照，不再访问磁盘，快照本身构建后不再修改。按客户端版本生成的响应缓存在快照以外的
+    LRU（client_response）中，以快照和客户端版本为键，快照替换后旧条目不再命中。
+    extra_patches 为按需生成的差异文件，与发布时生成的差异文件一起参与规划。
+    """
+
+    def __init__(self, version_info, generation, stat_key, versions_dir, patches_dir,
+                 extra_patches=(), on_demand=False):
+        self.generation = generation
+        self.stat_key = stat_key
+        self.versions_dir = versions_dir
+        self.patches_dir = patches_dir
+        self.on_demand = on_demand
+
+        # 补全缺失的完整文件大小，之后的规划无需再读取磁盘
+        self.version_info = copy.deepcopy(version_info)
+        for version, info in self.version_info['versions'].items():
+            if 'size' not in info:
+                file_path = os.path.join(versions_dir, f'v{version}', 'app')
+                if os.path.exists(file_path):
+                    info['size'] = os.path.getsize(file_path)
+        # 按需生成的差异文件并入目标版本的差异文件列表（同名时替换发布时的记录）
+        for patch_info in extra_patches:
+            target_info = self.version_info['versions'].get(patch_info['to_version'])
+            if target_info is None or patch_info['from_version'] not in self.version_info['versions']:
+                continue
+            patches = [p for p in target_info.get('patches', []) if p['patch_file'] != patch_info['patch_file']]
+            patches.append({key: value for key, value in patch_info.items() if key != 'to_version'})
+            target_info['patches'] = patches
+            if target_info.get('patch', {}).get('patch_file') == patch_info['patch_file']:
+                del target_info['patch']
+
+        self.latest_version = self.version_info['latest_version']
+        self.ordered_versions = sorted(self.version_info['versions'], key=parse_version)
+        self.graph = build_patch_graph(self.version_info, patches_dir)
+        # 可以按需生成差异文件的版本：单文件版本，且完整文件或块索引仍在
+        self.generatable = frozenset(
+            version for version, info in self.version_info['versions'].items()
+            if on_demand and info.get('type') != 'tree'
+            and ('chunk_index' in info or os.path.exists(os.path.join(versions_dir, f'v{version}', 'app')))
+        )
+
+        # 完整配置（兼容旧客户端）预编码
+        self.body = encode_json(version_info)
+        self.gzip_body = gzip.compress(self.body, compresslevel=9)
+        self.etag = make_body_etag(self.body)
+
+    def has_version(self, version):
+        return version in self.version_info['versions']
+
+    def can_generate_patch(self, from_version, to_version):
+        """两个版本之间能否按需生成差异文件（按构建快照时的磁盘状态判断）"""
+        return from_version != to_version and from_version in self.generatable and to_version in self.generatable
+
+    def plan(self, current_version, target_version=None, held_versions=()):
+        """基于快照内的差异文件图规划更新路径，held_versions 为客户端本地持有的其他版本"""
+        return plan_update(
+            self.version_info, current_version, self.patches_dir, self.versions_dir,
+            target_version, graph=self.graph, can_generate=self.can_generate_patch, held_versions=held_versions
+        )
+
+    def check_update_response(self, current_version):
+        """获取某个客户端版本的 (ETag, JSON 字节, gzip 字节)，未提供版本时返回完整配置"""
+        if current_version is None:
+            return self.etag, self.body, self.gzip_body
+
+        return client_response(self, self.client_key(current_version))[:3]
+
+    def client_key(self, current_version):
+        """服务器不认识的版本只能完整下载，共用一个缓存条目"""
+        return current_version if self.has_version(current_version) else ''
+
+    def client_plan_method(self, current_version):
+        """check_update_response 为某个客户端版本给出的更新方式（patch 或 full）"""
+        return client_response(self, self.client_key(current_version))[3]
+
+
+@functools.lru_cache(maxsize=CLIENT_RESPONSE_CACHE_LIMIT)
+def client_response(snapshot, current_version):
+    """按快照和客户端版本生成检查更新响应，返回 (ETag, JSON 字节, gzip 字节, 更新方式)
+
+    快照按对象本身（即代次）参与缓存键；重建快照后调用 client_response.cache_clear() 释放旧快照。
+    """
+    latest_info = snapshot.version_info['versions'][snapshot.latest_version]
+    plan = snapshot.plan(current_version)
+    plan.pop('current_version')
+    body = encode_json({
+        'latest_version': snapshot.latest_version,
+        'versions': {
+            snapshot.latest_version: {
+                key: latest_info[key]
+                for key in (
+                    'type', 'files', 'md5', 'digest', 'size', 'blocks', 'description',
+                    'chunk_index', 'file_count', 'tree_manifest', 'encodings'
+                )
+                if key in latest_info
+            }
+        },
+        'plan': plan
+    })
+    return make_body_etag(body), body, gzip.compress(body, compresslevel=9), plan['method']
+
+
+def manifest_stat_key(config_path):
+    """用于判断版本配置文件是否变化的标识（修改时间、大小、inode）"""
+    stat_result = os.stat(config_path)
+    return (stat_result.st_mtime_ns, stat_result.st_size, stat_result.st_ino)
+
+
+def snapshot_stat_key(config_path, patch_cache=None):
+    """快照的变化标识：版本配置文件和按需生成差异文件索引任一变化都需要重建"""
+    return (manifest_stat_key(config_path), patch_cache.index_stat_key() if patch_cache else None)
+
+
+def load_manifest_snapshot(config_path, generation, versions_dir, patches_dir, patch_cache=None, on_demand=False):
+    """读取版本配置文件（以及按需生成的差异文件索引）并构建快照"""
+    stat_key = snapshot_stat_key(config_path, patch_cache)
+    with open(config_path, 'r', encoding='utf-8') as f:
+        version_info = json.load(f)
+    extra_patches = patch_cache.generated_patches() if patch_cache else ()
+    return ManifestSnapshot(
+        version_info, generation, stat_key, versions_dir, patches_dir, extra_patches, on_demand
+    )
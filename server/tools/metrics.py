@@ -0,0 +1,225 @@
+import os
+import json
+import time
+from bisect import bisect_left
+
+# 请求耗时直方图的桶上界（秒）
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+class Metrics:
+    """进程内的指标注册表：计数器、仪表和直方图，按标签组合累计数值
+
+    更新只是内存中的字典操作。主服务的多个 worker 和下载服务进程各自定期把数值写入
+    metrics_dir/{pid}.json，/metrics 合并所有仍在运行的进程的数值后输出 Prometheus 文本格式。
+    标签为 ((名称, 值), ...) 元组，由调用方保证顺序一致。
+    """
+
+    def __init__(self, metrics_dir):
+        self.metrics_dir = metrics_dir
+        self.definitions = {}
+        self.values = {}
+
+    def define(self, name, kind, help_text, buckets=None, aggregate='sum'):
+        """注册指标；kind 为 counter、gauge 或 histogram，仪表跨进程合并时按 aggregate（sum 或 max）"""
+        self.definitions[name] = (kind, help_text, buckets, aggregate)
+        self.values[name] = {}
+
+    def inc(self, name, labels=(), amount=1):
+        values = self.values[name]
+        values[labels] = values.get(labels, 0) + amount
+
+    def set(self, name, value, labels=()):
+        self.values[name][labels] = value
+
+    def observe(self, name, value, labels=()):
+        values = self.values[name]
+        state = values.get(labels)
+        if state is None:
+            # 各桶计数（最后一个为 +Inf）、总和、次数
+            state = values[labels] = [0] * (len(self.definitions[name][2]) + 1) + [0.0, 0]
+        buckets = self.definitions[name][2]
+        state[bisect_left(buckets, value)] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    def dump(self):
+        """把本进程的数值写入指标目录（先写临时文件再替换）"""
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        path = os.path.join(self.metrics_dir, f'{os.getpid()}.json')
+        data = {
+            name: [[list(labels), value] for labels, value in values.items()]
+            for name, values in self.values.items()
+        }
+        with open(path + '.tmp', 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(path + '.tmp', path)
+
+    def remove_dump(self):
+        try:
+            os.remove(os.path.join(self.metrics_dir, f'{os.getpid()}.json'))
+        except FileNotFoundError:
+            pass
+
+    def collect(self):
+        """合并本进程的实时数值和其他仍在运行的进程写入的数值，已退出进程的文件直接删除"""
+        merged = {name: dict(values) for name, values in self.values.items()}
+        try:
+            names = os.listdir(self.metrics_dir)
+        except FileNotFoundError:
+            names = []
+        for file_name in names:
+            if not file_name.endswith('.json'):
+                continue
+            path = os.path.join(self.metrics_dir, file_name)
+            try:
+                pid = int(file_name[:-len('.json')])
+            except ValueError:
+                continue
+            if pid == os.getpid():
+                continue
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                os.remove(path)
+                continue
+            except PermissionError:
+                pass
+            try:
+                with open(path, 'r') as f:
+                    data = json.load(f)
+            except (FileNotFoundError, ValueError):
+                continue
+            for name, items in data.items():
+                if name not in self.definitions:
+                    continue
+                kind, _, _, aggregate = self.definitions[name]
+                target = merged[name]
+                for labels, value in items:
+                    labels = tuple(tuple(pair) for pair in labels)
+                    current = target.get(labels)
+                    if current is None:
+                        target[labels] = value
+                    elif kind == 'histogram':
+                        target[labels] = [a + b for a, b in zip(current, value)]
+                    elif aggregate == 'max':
+                        target[labels] = max(current, value)
+                    else:
+                        target[labels] = current + value
+        return merged
+
+    def render(self, values=None):
+        """输出 Prometheus 文本格式"""
+        values = self.collect() if values is None else values
+        lines = []
+        for name, (kind, help_text, buckets, _) in self.definitions.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in sorted(values.get(name, {}).items()):
+                if kind != 'histogram':
+                    lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + (float('inf'),), value):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else format_value(bound)
+                    lines.append(f'{name}_bucket{format_labels(labels + (("le", le),))} {cumulative}')
+                lines.append(f'{name}_sum{format_labels(labels)} {format_value(value[-2])}')
+                lines.append(f'{name}_count{format_labels(labels)} {value[-1]}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{escape_label(value)}"' for key, value in labels) + '}'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(round(value, 6))
+    return str(value)
+
+
+def define_download_metrics(metrics):
+    """主服务和下载服务共用的下载指标"""
+    metrics.define(
+        'update_http_request_duration_seconds', 'histogram',
+        '请求耗时（从收到请求到响应体发送完毕），按接口和方法', LATENCY_BUCKETS
+    )
+    metrics.define('update_http_responses_total', 'counter', '响应数，按接口和状态码')
+    metrics.define('update_bytes_served_total', 'counter', '发送的响应体字节数，按类型（full、patch、range、chunk、other）')
+    metrics.define('update_active_downloads', 'gauge', '正在进行的下载请求数')
+    metrics.define('update_patch_cache_requests_total', 'counter', '差异文件请求（首个请求）按缓存命中（hit）和未命中（miss）')
+
+
+def bytes_kind(endpoint, status):
+    """响应体字节的分类：差异文件、完整文件、完整文件的区间、块存储和其他"""
+    if endpoint.startswith('/download_patch') or endpoint.startswith('/download_tree_patch'):
+        return 'patch'
+    if endpoint.startswith('/download/'):
+        return 'range' if status == 206 else 'full'
+    if endpoint.startswith('/chunk'):
+        return 'chunk'
+    return 'other'
+
+
+def is_download_endpoint(path):
+    return path.startswith(('/download', '/chunk/'))
+
+
+class MetricsMiddleware:
+    """记录请求耗时、状态码、发送字节数和进行中的下载数的 ASGI 中间件
+
+    只包装 send 做计数，不缓冲响应体；零拷贝发送按消息中的 count 计入字节数。
+    """
+
+    def __init__(self, app, metrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        metrics = self.metrics
+        started = time.perf_counter()
+        download = is_download_endpoint(scope['path'])
+        state = {'status': 0, 'bytes': 0}
+
+        async def counting_send(message):
+            message_type = message['type']
+            if message_type == 'http.response.body':
+                state['bytes'] += len(message.get('body', b''))
+            elif message_type == 'http.response.zerocopysend':
+                state['bytes'] += message.get('count') or 0
+            elif message_type == 'http.response.start':
+                state['status'] = message['status']
+            await send(message)
+
+        if download:
+            metrics.inc('update_active_downloads')
+        try:
+            await self.app(scope, receive, counting_send)
+        except Exception:
+            # 未处理的异常由外层中间件返回 500
+            state['status'] = state['status'] or 500
+            raise
+        finally:
+            if download:
+                metrics.inc('update_active_downloads', amount=-1)
+            route = scope.get('route')
+            endpoint = getattr(route, 'path', None) or 'unmatched'
+            metrics.observe(
+                'update_http_request_duration_seconds', time.perf_counter() - started,
+                (('endpoint', endpoint), ('method', scope['method']))
+            )
+            metrics.inc('update_http_responses_total', (('endpoint', endpoint), ('status', str(state['status']))))
+            if state['bytes']:
+                metrics.inc(
+                    'update_bytes_served_total', (('kind', bytes_kind(endpoint, state['status'])),), state['bytes']
+                )
@@ -0,0 +1,151 @@
+import os
+import json
+import time
+import threading
+from tools.file_lock import locked
+
+
+def is_initial_request(range_header):
+    """是否为一次下载的首个请求（无 Range 或从 0 开始），续传和分段请求不重复计入命中"""
+    if not range_header:
+        return True
+    return range_header.replace(' ', '').lower().startswith('bytes=0-')
+
+
+class PatchCache:
+    """差异文件的磁盘缓存：记录每个差异文件的命中情况，总大小超出字节预算时按命中情况淘汰
+
+    管理 patches/ 下全部单文件差异文件（发布时生成的和按需生成的）。按需生成的差异文件的信息
+    （大小、摘要、块哈希清单、编码）记录在 config/patch_cache.json，供更新路径规划使用；
+    命中计数按半衰期衰减（LFU），记录在 config/patch_hits.json，进程内先累计再定期合并写入。
+    两个记录文件由多个 worker 进程和下载服务共同读写，每次 读取→合并→写入 都持有 config/patch_cache.lock。
+    """
+
+    def __init__(self, patches_dir, blocks_dir, config_dir, cache_config):
+        self.patches_dir = patches_dir
+        self.blocks_dir = blocks_dir
+        self.index_path = os.path.join(config_dir, 'patch_cache.json')
+        self.hits_path = os.path.join(config_dir, 'patch_hits.json')
+        self.lock_path = os.path.join(config_dir, 'patch_cache.lock')
+        self.max_bytes = cache_config.get('max_size_mb', 10240) * 1024 * 1024
+        self.policy = cache_config.get('policy', 'lfu')
+        self.half_life = cache_config.get('half_life_hours', 168) * 3600
+        self.grace = cache_config.get('grace_hours', 24) * 3600
+        self.pending_hits = {}
+        self.lock = threading.Lock()
+
+    def load_json(self, path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def save_json(self, path, data):
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(temp_path, path)
+
+    def index_stat_key(self):
+        """按需生成差异文件索引的变化标识，索引变化时服务器重建版本配置快照"""
+        try:
+            stat_result = os.stat(self.index_path)
+        except FileNotFoundError:
+            return None
+        return (stat_result.st_mtime_ns, stat_result.st_size, stat_result.st_ino)
+
+    def generated_patches(self):
+        """按需生成且仍在磁盘上的差异文件信息列表"""
+        return [
+            info for name, info in self.load_json(self.index_path).items()
+            if os.path.exists(os.path.join(self.patches_dir, name))
+        ]
+
+    def record_hit(self, name):
+        """记录一次下载命中（只在内存中累计，由 flush_hits 写入）"""
+        with self.lock:
+            self.pending_hits[name] = self.pending_hits.get(name, 0) + 1
+
+    def decayed(self, entry, now):
+        """按半衰期衰减后的命中计数"""
+        return entry['score'] * 0.5 ** ((now - entry['last_hit']) / self.half_life)
+
+    def flush_hits(self):
+        """把进程内累计的命中合并写入命中记录"""
+        with self.lock:
+            pending, self.pending_hits = self.pending_hits, {}
+        if not pending:
+            return
+        with locked(self.lock_path):
+            self.save_json(self.hits_path, self.merge_hits(self.load_json(self.hits_path), pending))
+
+    def merge_hits(self, hits, pending):
+        """把新的命中计数合并到命中记录（调用方持有锁）"""
+        now = time.time()
+        for name, count in pending.items():
+            entry = hits.get(name)
+            score = self.decayed(entry, now) if entry else 0
+            hits[name] = {'score': score + count, 'last_hit': now}
+        return hits
+
+    def add(self, info):
+        """登记按需生成的差异文件，然后按预算淘汰，返回被淘汰的文件名"""
+        with locked(self.lock_path):
+            index = self.load_json(self.index_path)
+            index[info['patch_file']] = info
+            self.save_json(self.index_path, index)
+        return self.evict(keep={info['patch_file']})
+
+    def evict(self, keep=()):
+        """总大小超出预算时淘汰差异文件，返回被淘汰的文件名
+
+        lfu 按衰减后的命中计数、lru 按最近命中时间淘汰；宽限期内的新文件（尚未来得及被下载）最后才淘汰。
+        """
+        with self.lock:
+            pending, self.pending_hits = self.pending_hits, {}
+        with locked(self.lock_path):
+            hits = self.merge_hits(self.load_json(self.hits_path), pending)
+            return self.evict_locked(hits, keep)
+
+    def evict_locked(self, hits, keep):
+        """按合并后的命中记录淘汰差异文件并写回两个记录文件（调用方持有锁）"""
+        now = time.time()
+        candidates = []
+        total = 0
+        for name in os.listdir(self.patches_dir):
+            if not (name.startswith('patch_') and name.endswith('.diff')):
+                continue
+            stat_result = os.stat(os.path.join(self.patches_dir, name))
+            total += stat_result.st_size
+            if name in keep:
+                continue
+            entry = hits.get(name)
+            last_hit = entry['last_hit'] if entry else stat_result.st_mtime
+            in_grace = now - max(last_hit, stat_result.st_mtime) < self.grace
+            if self.policy == 'lru':
+                rank = (in_grace, last_hit)
+            else:
+                rank = (in_grace, self.decayed(entry, now) if entry else 0, last_hit)
+            candidates.append((rank, name, stat_result.st_size))
+        if total <= self.max_bytes:
+            self.save_json(self.hits_path, hits)
+            return []
+
+        candidates.sort()
+        removed = []
+        for _, name, size in candidates:
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.patches_dir, name))
+            blocks_path = os.path.join(self.blocks_dir, name + '.json')
+            if os.path.exists(blocks_path):
+                os.remove(blocks_path)
+            total -= size
+            removed.append(name)
+
+        index = self.load_json(self.index_path)
+        if any(name in index for name in removed):
+            self.save_json(self.index_path, {name: info for name, info in index.items() if name not in removed})
+        self.save_json(self.hits_path, {name: entry for name, entry in hits.items() if name not in removed})
+        return removed
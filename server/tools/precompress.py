@@ -0,0 +1,71 @@
+import os
+import zlib
+import lzma
+from tools.hashing import MultiHasher, COPY_CHUNK_SIZE
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 预压缩版本的 Content-Encoding -> 文件后缀
+ENCODING_SUFFIXES = {
+    'zstd': '.zst',
+    'xz': '.xz',
+    'gzip': '.gz'
+}
+# 压缩单个文件的峰值内存估算（字节），用于进程池的内存预算
+ENCODING_MEMORY = {
+    'zstd': 256 * 1024 * 1024,
+    'xz': 700 * 1024 * 1024,
+    'gzip': 16 * 1024 * 1024
+}
+
+
+def available_encodings(names):
+    """按配置顺序返回当前环境可用的压缩格式"""
+    return [name for name in names if name in ENCODING_SUFFIXES and (name != 'zstd' or zstandard is not None)]
+
+
+def make_compressor(encoding):
+    """创建流式压缩器，提供 compress(data) 和 flush() 两个方法"""
+    if encoding == 'gzip':
+        return zlib.compressobj(9, zlib.DEFLATED, 31)
+    if encoding == 'xz':
+        return lzma.LZMACompressor(preset=9)
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=19).compressobj()
+    raise ValueError(f"不支持的压缩格式: {encoding}")
+
+
+def precompress_file(key, src_file, encoding, block_size):
+    """流式生成文件的预压缩版本（在子进程中运行），写入时同时计算块摘要
+
+    先写入临时文件，完成后替换到位：服务器按文件是否存在选择预压缩版本，不能让客户端读到写了一半的文件。
+    """
+    dest_file = src_file + ENCODING_SUFFIXES[encoding]
+    temp_file = dest_file + '.tmp'
+    compressor = make_compressor(encoding)
+    hasher = MultiHasher([], block_size)
+    size = 0
+    try:
+        with open(src_file, 'rb') as fsrc, open(temp_file, 'wb') as fdst:
+            for chunk in iter(lambda: fsrc.read(COPY_CHUNK_SIZE), b""):
+                data = compressor.compress(chunk)
+                if data:
+                    fdst.write(data)
+                    hasher.update(data)
+                    size += len(data)
+            data = compressor.flush()
+            fdst.write(data)
+            hasher.update(data)
+            size += len(data)
+        os.replace(temp_file, dest_file)
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+    return key, {
+        'file': os.path.basename(dest_file),
+        'size': size,
+        'block_hashes': hasher.hexdigests()['blocks']
+    }
@@ -0,0 +1,344 @@
+import os
+import sys
+import json
+import socket
+import time
+import asyncio
+import logging
+import multiprocessing
+import urllib.parse
+from email.utils import formatdate
+
+# 添加父目录到系统路径以导入配置
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools.chunk_store import ChunkStore
+from tools.file_serving import (
+    negotiate_encoding, parse_range_header, if_range_matches, safe_join, RangeNotSatisfiable
+)
+from tools.metrics import Metrics, define_download_metrics, bytes_kind
+from tools.patch_cache import PatchCache, is_initial_request
+from tools.zero_copy import OpenFileCache, SEND_CHUNK_SIZE
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+with open(os.path.join(BASE_DIR, 'server_config.json'), 'r') as f:
+    config = json.load(f)
+    SERVER_CONFIG = config['SERVER_CONFIG']
+    DIR_CONFIG = config['DIR_CONFIG']
+    PATCH_CACHE_CONFIG = config.get('PATCH_CACHE_CONFIG', {})
+
+VERSIONS_DIR = os.path.join(BASE_DIR, DIR_CONFIG['versions_dir'])
+PATCHES_DIR = os.path.join(BASE_DIR, DIR_CONFIG['patches_dir'])
+CHUNKS_DIR = os.path.join(BASE_DIR, DIR_CONFIG.get('chunks_dir', 'chunks'))
+LOG_DIR = os.path.join(BASE_DIR, DIR_CONFIG['logs_dir'])
+CONFIG_DIR = os.path.join(BASE_DIR, 'config')
+BLOCKS_DIR = os.path.join(CONFIG_DIR, 'blocks')
+
+# 请求行和请求头的最大长度
+MAX_HEADER_SIZE = 16 * 1024
+# 空闲长连接的保持时间（秒）
+KEEPALIVE_TIMEOUT = 15
+# 差异文件命中记录和运行指标的写入间隔（秒）
+HIT_FLUSH_INTERVAL = 2
+# 运行指标中的接口名，与主服务的路由一致
+DOWNLOAD_ENDPOINT = '/download/{version}/{filename:path}'
+PATCH_ENDPOINT = '/download_patch/{from_version}/{to_version}'
+
+STATUS_PHRASES = {
+    200: 'OK',
+    206: 'Partial Content',
+    307: 'Temporary Redirect',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    416: 'Range Not Satisfiable',
+    431: 'Request Header Fields Too Large'
+}
+
+
+class DownloadServer:
+    """只处理 /download 和 /download_patch 的 HTTP/1.1 下载服务
+
+    响应头与主服务一致（Range、If-Range、预压缩版本协商），响应体用 os.sendfile 直接从缓存的文件描述符发送，
+    事件循环不支持时按块发送内存映射切片。需要由块存储重建的文件和尚未生成的差异文件重定向到主服务。
+    """
+
+    def __init__(self, app_port, cache, patch_cache=None, metrics=None):
+        self.app_port = app_port
+        self.cache = cache
+        self.patch_cache = patch_cache
+        self.metrics = metrics
+        self.chunk_store = ChunkStore(CHUNKS_DIR)
+
+    async def handle_connection(self, reader, writer):
+        """处理一个连接上的所有请求（支持长连接）"""
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), KEEPALIVE_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    break
+                except asyncio.LimitOverrunError:
+                    await self.send_error(writer, 431, keep_alive=False)
+                    break
+                keep_alive = await self.handle_request(head, writer)
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        except Exception as e:
+            logging.error(f"下载服务处理请求失败: {str(e)}")
+        finally:
+            writer.close()
+
+    async def handle_request(self, head, writer):
+        """处理单个请求并记录运行指标，返回连接是否保持"""
+        result = {'endpoint': 'unmatched', 'method': '', 'status': 0, 'bytes': 0}
+        metrics = self.metrics
+        if metrics is None:
+            return await self.process_request(head, writer, result)
+        started = time.perf_counter()
+        metrics.inc('update_active_downloads')
+        try:
+            return await self.process_request(head, writer, result)
+        finally:
+            metrics.inc('update_active_downloads', amount=-1)
+            endpoint, status = result['endpoint'], result['status']
+            metrics.observe(
+                'update_http_request_duration_seconds', time.perf_counter() - started,
+                (('endpoint', endpoint), ('method', result['method']))
+            )
+            metrics.inc('update_http_responses_total', (('endpoint', endpoint), ('status', str(status))))
+            if result['bytes']:
+                metrics.inc('update_bytes_served_total', (('kind', bytes_kind(endpoint, status)),), result['bytes'])
+            if result.get('patch_hit'):
+                metrics.inc('update_patch_cache_requests_total', (('result', 'hit'),))
+
+    async def process_request(self, head, writer, result):
+        """处理单个请求，返回连接是否保持；result 记录接口名、请求方法、状态码和响应体字节数"""
+        lines = head.decode('latin-1').split('\r\n')
+        parts = lines[0].split(' ')
+        if len(parts) != 3:
+            result['status'] = await self.send_error(writer, 400, keep_alive=False)
+            return False
+        method, target, http_version = parts
+        result['method'] = method
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+        connection = headers.get('connection', '').lower()
+        keep_alive = connection != 'close' if http_version == 'HTTP/1.1' else connection == 'keep-alive'
+        if headers.get('content-length', '0') != '0' or 'transfer-encoding' in headers:
+            # 下载请求不应带请求体，无法可靠跳过时直接关闭连接
+            keep_alive = False
+
+        path = urllib.parse.unquote(urllib.parse.urlsplit(target).path)
+        if path.startswith('/download/'):
+            result['endpoint'] = DOWNLOAD_ENDPOINT
+        elif path.startswith('/download_patch/'):
+            result['endpoint'] = PATCH_ENDPOINT
+        if method not in ('GET', 'HEAD'):
+            result['status'] = await self.send_error(writer, 405, keep_alive)
+            return keep_alive
+        status, file_path, extra_headers = self.resolve(path, headers)
+        if status == 307:
+            host = headers.get('host', '127.0.0.1').rsplit(':', 1)[0]
+            result['status'] = await self.send_error(
+                writer, 307, keep_alive, {'Location': f'http://{host}:{self.app_port}{target}'}
+            )
+            return keep_alive
+        if status != 200:
+            result['status'] = await self.send_error(writer, status, keep_alive)
+            return keep_alive
+
+        try:
+            entry = self.cache.acquire(file_path)
+        except FileNotFoundError:
+            result['status'] = await self.send_error(writer, 404, keep_alive)
+            return keep_alive
+        try:
+            result['status'], result['bytes'] = await self.send_file(
+                writer, method, entry, headers, extra_headers, keep_alive
+            )
+        finally:
+            self.cache.release(entry)
+        if (self.patch_cache is not None and method == 'GET' and path.startswith('/download_patch/')
+                and is_initial_request(headers.get('range'))):
+            self.patch_cache.record_hit(os.path.basename(file_path))
+            result['patch_hit'] = True
+        return keep_alive
+
+    def resolve(self, path, headers):
+        """把请求路径解析为 (状态码, 文件路径, 额外响应头)"""
+        if path.startswith('/download/'):
+            version, _, filename = path[len('/download/'):].partition('/')
+            if not version or not filename:
+                return 404, None, None
+            file_path = safe_join(os.path.join(VERSIONS_DIR, f'v{version}'), filename)
+            if file_path is None:
+                return 400, None, None
+            try:
+                self.cache.stat(file_path)
+            except FileNotFoundError:
+                # 完整副本已清理时由主服务从块存储提供
+                if filename == 'app' and self.chunk_store.has_index(version):
+                    return 307, None, None
+                return 404, None, None
+            encoding, send_path, has_variants = negotiate_encoding(
+                headers.get('accept-encoding'), file_path, headers.get('range'), headers.get('if-range'),
+                self.cache.stat
+            )
+            extra_headers = {
+                'Content-Disposition': f'attachment; filename="{os.path.basename(filename)}"'
+            }
+            if has_variants:
+                extra_headers['Vary'] = 'Accept-Encoding'
+            if encoding:
+                extra_headers['Content-Encoding'] = encoding
+            return 200, send_path, extra_headers
+        if path.startswith('/download_patch/'):
+            from_version, _, to_version = path[len('/download_patch/'):].partition('/')
+            if not from_version or not to_version:
+                return 404, None, None
+            patch_file = safe_join(PATCHES_DIR, f'patch_{from_version}_to_{to_version}.diff')
+            if patch_file is None:
+                return 400, None, None
+            try:
+                self.cache.stat(patch_file)
+            except FileNotFoundError:
+                # 尚未生成的差异文件由主服务按需生成
+                return 307, None, None
+            return 200, patch_file, {}
+        return 404, None, None
+
+    async def send_file(self, writer, method, entry, headers, extra_headers, keep_alive):
+        """按 Range 发送文件的完整内容或单个区间（多区间按完整内容返回），返回 (状态码, 响应体字节数)"""
+        file_size = entry.size
+        response_headers = {
+            'Accept-Ranges': 'bytes',
+            'ETag': entry.etag,
+            'Last-Modified': formatdate(entry.stat.st_mtime, usegmt=True),
+            'Content-Type': 'application/octet-stream',
+            **extra_headers
+        }
+        status, start, end = 200, 0, file_size
+        range_header = headers.get('range')
+        if_range = headers.get('if-range')
+        if range_header and (if_range is None or if_range_matches(if_range, entry.etag, entry.stat.st_mtime)):
+            try:
+                ranges = parse_range_header(range_header, file_size)
+            except RangeNotSatisfiable:
+                response_headers['Content-Range'] = f'bytes */{file_size}'
+                return await self.send_error(writer, 416, keep_alive, response_headers), 0
+            if ranges and len(ranges) == 1:
+                status, start, end = 206, ranges[0][0], ranges[0][1] + 1
+                response_headers['Content-Range'] = f'bytes {start}-{end - 1}/{file_size}'
+        response_headers['Content-Length'] = str(end - start)
+        self.write_head(writer, status, response_headers, keep_alive)
+        if method == 'HEAD' or end == start:
+            await writer.drain()
+            return status, 0
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.sendfile(writer.transport, entry.file, start, end - start, fallback=False)
+        except (asyncio.SendfileNotAvailableError, NotImplementedError):
+            view = memoryview(entry.mapping())
+            try:
+                for offset in range(start, end, SEND_CHUNK_SIZE):
+                    writer.write(view[offset:min(offset + SEND_CHUNK_SIZE, end)])
+                    await writer.drain()
+            finally:
+                view.release()
+        return status, end - start
+
+    def write_head(self, writer, status, headers, keep_alive):
+        lines = [f'HTTP/1.1 {status} {STATUS_PHRASES[status]}']
+        lines += [f'{name}: {value}' for name, value in headers.items()]
+        lines.append(f'Connection: {"keep-alive" if keep_alive else "close"}')
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+    async def send_error(self, writer, status, keep_alive, headers=None):
+        """发送不带响应体的状态响应，返回状态码"""
+        self.write_head(writer, status, {**(headers or {}), 'Content-Length': '0'}, keep_alive)
+        await writer.drain()
+        return status
+
+
+async def flush_periodically(patch_cache, metrics):
+    """定期把累计的差异文件命中写入命中记录，把运行指标写入指标目录"""
+    while True:
+        await asyncio.sleep(HIT_FLUSH_INTERVAL)
+        try:
+            await asyncio.to_thread(patch_cache.flush_hits)
+        except Exception as e:
+            logging.error(f"写入差异文件命中记录失败: {str(e)}")
+        if metrics is not None:
+            try:
+                await asyncio.to_thread(metrics.dump)
+            except Exception as e:
+                logging.error(f"写入运行指标失败: {str(e)}")
+
+
+async def serve(host, port, app_port):
+    """在当前进程中运行下载服务（多个进程通过 SO_REUSEPORT 共享端口）"""
+    cache = OpenFileCache(SERVER_CONFIG.get('file_cache_size', 256), SERVER_CONFIG.get('file_cache_ttl', 1.0))
+    patch_cache = PatchCache(PATCHES_DIR, BLOCKS_DIR, CONFIG_DIR, PATCH_CACHE_CONFIG)
+    metrics = None
+    if SERVER_CONFIG.get('metrics', True):
+        metrics = Metrics(os.path.join(LOG_DIR, 'metrics'))
+        define_download_metrics(metrics)
+    download_server = DownloadServer(app_port, cache, patch_cache, metrics)
+    server = await asyncio.start_server(
+        download_server.handle_connection, host, port,
+        limit=MAX_HEADER_SIZE, reuse_port=hasattr(socket, 'SO_REUSEPORT'), backlog=1024
+    )
+    flusher = asyncio.create_task(flush_periodically(patch_cache, metrics))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        flusher.cancel()
+        patch_cache.flush_hits()
+        if metrics is not None:
+            metrics.remove_dump()
+
+
+def run_worker(host, port, app_port):
+    os.makedirs(LOG_DIR, exist_ok=True)
+    logging.basicConfig(
+        filename=os.path.join(LOG_DIR, 'server.log'),
+        level=getattr(logging, DIR_CONFIG['log_level']),
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    try:
+        asyncio.run(serve(host, port, app_port))
+    except KeyboardInterrupt:
+        pass
+
+
+def start_workers(host, port, app_port, workers):
+    """启动多个下载服务进程，返回进程列表（不支持 SO_REUSEPORT 的平台只启动一个）"""
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        workers = 1
+    processes = []
+    for _ in range(max(workers, 1)):
+        process = multiprocessing.Process(target=run_worker, args=(host, port, app_port), daemon=True)
+        process.start()
+        processes.append(process)
+    return processes
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="零拷贝下载服务")
+    parser.add_argument('--host', default=SERVER_CONFIG['host'])
+    parser.add_argument('--port', type=int, default=SERVER_CONFIG.get('download_port') or SERVER_CONFIG['port'] + 1)
+    parser.add_argument('--workers', type=int, default=SERVER_CONFIG.get('download_workers') or os.cpu_count())
+    args = parser.parse_args()
+
+    for process in start_workers(args.host, args.port, SERVER_CONFIG['port'], args.workers):
+        process.join()
@@ -0,0 +1,277 @@
+"""客户端与服务器共用的文件格式：块哈希与 Merkle 根、差异编码、分窗口差异文件
+
+服务器生成、客户端校验和合成的数据格式只在这里定义，两端导入同一份实现，避免一端修改后另一端校验失败。
+"""
+import bz2
+import json
+import lzma
+import hashlib
+from collections import Counter
+import bsdiff4
+import bsdiff4.core as bsdiff_core
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 块哈希清单中每个块摘要的长度（字节）
+BLOCK_DIGEST_SIZE = 32
+# 分窗口差异文件格式：魔数 + 8 字节头长度 + JSON 头 + 依次拼接的各窗口差异数据（差异编码记录在头部）
+WINDOWED_MAGIC = b'WBSDIFF1'
+# zstd 窗口上限（64 位平台）
+ZSTD_MAX_WINDOW_LOG = 31
+
+
+def block_digest(data):
+    """计算单个数据块的摘要"""
+    return hashlib.blake2b(data, digest_size=BLOCK_DIGEST_SIZE).hexdigest()
+
+
+def merkle_root(leaves):
+    """由块摘要列表计算 Merkle 根：逐层两两拼接后求摘要，落单的节点直接进入上一层"""
+    level = [bytes.fromhex(leaf) for leaf in leaves]
+    if not level:
+        return block_digest(b'')
+    while len(level) > 1:
+        next_level = [
+            hashlib.blake2b(level[i] + level[i + 1], digest_size=BLOCK_DIGEST_SIZE).digest()
+            for i in range(0, len(level) - 1, 2)
+        ]
+        if len(level) % 2:
+            next_level.append(level[-1])
+        level = next_level
+    return level[0].hex()
+
+
+# 差异编码注册表：名称 -> (文件头魔数, 编码函数, 解码函数)
+CODECS = {}
+# 共用 bsdiff 数据流的编码：名称 -> (文件头魔数, 压缩函数)，同一对文件只需计算一次 bsdiff
+STREAM_CODECS = {}
+
+
+def register_codec(name, magic, encode, decode):
+    """注册差异编码，encode(旧数据, 新数据) 返回差异数据，decode(旧数据, 差异数据) 返回新数据"""
+    CODECS[name] = (magic, encode, decode)
+
+
+def available_codecs(names):
+    """按配置顺序返回当前环境可用的差异编码"""
+    return [name for name in names if name in CODECS]
+
+
+def encode_delta(name, old_data, new_data):
+    return CODECS[name][1](old_data, new_data)
+
+
+def decode_delta(name, old_data, patch_data):
+    return CODECS[name][2](old_data, patch_data)
+
+
+def codec_from_magic(patch_data):
+    """根据差异数据的文件头识别编码，无法识别时返回 None"""
+    for name, (magic, _, _) in CODECS.items():
+        if patch_data[:len(magic)] == magic:
+            return name
+    return None
+
+
+def decode_detected(old_data, patch_data):
+    """按文件头识别差异编码并合成新数据"""
+    name = codec_from_magic(patch_data)
+    if name is None:
+        raise ValueError(f"不支持的差异编码: {patch_data[:8]!r}")
+    return decode_delta(name, old_data, patch_data)
+
+
+def encode_deltas(names, old_data, new_data):
+    """用多个差异编码分别编码同一对数据，按 names 顺序逐个产出 (名称, 差异数据)
+
+    bsdiff 系列的编码只计算一次 bsdiff 数据流（后缀数组的耗时和内存只付一次），之后按各自的算法重新压缩。
+    逐个产出以便调用方写出后释放，同一时刻只保留一份候选差异数据。
+    """
+    streams = None
+    for name in names:
+        if name in STREAM_CODECS:
+            if streams is None:
+                streams = bsdiff_core.diff(old_data, new_data)
+            magic, compress = STREAM_CODECS[name]
+            yield name, pack_bsdiff_streams(magic, compress, len(new_data), *streams)
+        else:
+            yield name, encode_delta(name, old_data, new_data)
+
+
+def pack_bsdiff_streams(magic, compress, new_size, control, diff_data, extra_data):
+    """按 BSDIFF40 的布局写出 bsdiff 三个数据流，压缩算法可替换"""
+    control_data = compress(b''.join(
+        bsdiff_core.encode_int64(value) for entry in control for value in entry
+    ))
+    diff_data = compress(diff_data)
+    extra_data = compress(extra_data)
+    return b''.join([
+        magic,
+        bsdiff_core.encode_int64(len(control_data)),
+        bsdiff_core.encode_int64(len(diff_data)),
+        bsdiff_core.encode_int64(new_size),
+        control_data,
+        diff_data,
+        extra_data
+    ])
+
+
+def unpack_bsdiff_streams(patch_data, decompress):
+    """解析 pack_bsdiff_streams 写出的数据，返回 bsdiff4.core.patch 所需的参数"""
+    control_length = bsdiff_core.decode_int64(patch_data[8:16])
+    diff_length = bsdiff_core.decode_int64(patch_data[16:24])
+    new_size = bsdiff_core.decode_int64(patch_data[24:32])
+    offset = 32
+    control_data = decompress(patch_data[offset:offset + control_length])
+    offset += control_length
+    diff_data = decompress(patch_data[offset:offset + diff_length])
+    extra_data = decompress(patch_data[offset + diff_length:])
+    control = [
+        (
+            bsdiff_core.decode_int64(control_data[i:i + 8]),
+            bsdiff_core.decode_int64(control_data[i + 8:i + 16]),
+            bsdiff_core.decode_int64(control_data[i + 16:i + 24])
+        )
+        for i in range(0, len(control_data), 24)
+    ]
+    return new_size, control, diff_data, extra_data
+
+
+def recompressed_bsdiff(magic, compress, decompress):
+    """生成用其他压缩算法替换 bzip2 的 bsdiff 编码函数"""
+    def encode(old_data, new_data):
+        return pack_bsdiff_streams(magic, compress, len(new_data), *bsdiff_core.diff(old_data, new_data))
+
+    def decode(old_data, patch_data):
+        return bsdiff_core.patch(old_data, *unpack_bsdiff_streams(patch_data, decompress))
+
+    return encode, decode
+
+
+def register_stream_codec(name, magic, compress, decompress, decode=None):
+    """注册共用 bsdiff 数据流的编码（decode 为空时按 pack_bsdiff_streams 的布局解码）"""
+    encode, default_decode = recompressed_bsdiff(magic, compress, decompress)
+    register_codec(name, magic, encode, decode or default_decode)
+    STREAM_CODECS[name] = (magic, compress)
+
+
+# 与 bsdiff4.diff 的输出逐字节相同（BSDIFF40 即 bzip2 压缩的三个数据流）
+register_stream_codec('bsdiff', b'BSDIFF40', bz2.compress, bz2.decompress, decode=bsdiff4.patch)
+register_stream_codec(
+    'bsdiff-lzma', b'BSDIFFLZ', lambda data: lzma.compress(data, preset=9 | lzma.PRESET_EXTREME), lzma.decompress
+)
+
+if zstandard is not None:
+    def zstd_dict_params(old_size, new_size, level=19):
+        """以旧文件为字典压缩时，窗口需覆盖整个旧文件（启用长距离匹配）"""
+        window_log = min(max((old_size + new_size).bit_length(), 10), ZSTD_MAX_WINDOW_LOG)
+        return zstandard.ZstdCompressionParameters.from_level(
+            level, window_log=window_log, enable_ldm=True, write_content_size=True
+        )
+
+    def zstd_dict_encode(old_data, new_data, level=19):
+        dictionary = zstandard.ZstdCompressionDict(old_data, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+        compressor = zstandard.ZstdCompressor(
+            dict_data=dictionary, compression_params=zstd_dict_params(len(old_data), len(new_data), level)
+        )
+        return b'ZSTDDICT' + compressor.compress(new_data)
+
+    def zstd_dict_decode(old_data, patch_data):
+        dictionary = zstandard.ZstdCompressionDict(old_data, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+        decompressor = zstandard.ZstdDecompressor(
+            dict_data=dictionary, max_window_size=1 << ZSTD_MAX_WINDOW_LOG
+        )
+        return decompressor.decompress(patch_data[8:])
+
+    register_stream_codec(
+        'bsdiff-zstd', b'BSDIFFZS',
+        lambda data: zstandard.ZstdCompressor(level=19).compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data)
+    )
+    register_codec('zstd-dict', b'ZSTDDICT', zstd_dict_encode, zstd_dict_decode)
+
+
+def chunk_offsets(chunks):
+    """把块索引中的 [摘要, 大小] 列表转换为 [(起始位置, 摘要, 大小)]"""
+    offsets = []
+    offset = 0
+    for digest, size in chunks:
+        offsets.append((offset, digest, size))
+        offset += size
+    return offsets
+
+
+def plan_windows(old_size, new_size, window_size, old_chunks=None, new_chunks=None):
+    """把新文件按固定大小切成窗口，并为每个窗口确定旧文件中对应的区间
+
+    提供两个版本的块索引时按内容匹配：窗口内与旧文件相同的块按字节数投票，得票最多的位移作为对齐位置；
+    没有匹配的块时按文件大小比例对齐。旧文件区间在两侧各留出 1/4 窗口的余量，容纳局部的插入和删除。
+    返回 [(旧文件起始位置, 旧文件区间长度, 新文件起始位置, 新文件窗口长度)]。
+    """
+    old_positions = {}
+    new_offsets = []
+    if old_chunks and new_chunks:
+        for offset, digest, _ in chunk_offsets(old_chunks):
+            old_positions.setdefault(digest, offset)
+        new_offsets = chunk_offsets(new_chunks)
+
+    margin = window_size // 4
+    windows = []
+    chunk_index = 0
+    for new_offset in range(0, max(new_size, 1), window_size):
+        new_length = min(window_size, new_size - new_offset)
+        votes = Counter()
+        while chunk_index < len(new_offsets) and new_offsets[chunk_index][0] < new_offset + new_length:
+            offset, digest, size = new_offsets[chunk_index]
+            if digest in old_positions:
+                votes[old_positions[digest] - offset] += size
+            chunk_index += 1
+        if votes:
+            center = new_offset + votes.most_common(1)[0][0]
+        elif new_size:
+            center = new_offset * old_size // new_size
+        else:
+            center = 0
+        old_start = min(max(center - margin, 0), old_size)
+        old_end = min(max(center + new_length + margin, 0), old_size)
+        windows.append((old_start, old_end - old_start, new_offset, new_length))
+    return windows
+
+
+def windowed_prefix(codec, old_size, new_size, windows, parts):
+    """分窗口差异文件在各窗口差异数据之前的部分：魔数 + 头长度 + JSON 头（各窗口的区间和差异数据长度）"""
+    header = json.dumps({
+        'codec': codec,
+        'old_size': old_size,
+        'new_size': new_size,
+        'windows': [
+            [old_offset, old_length, new_length, len(part)]
+            for (old_offset, old_length, _, new_length), part in zip(windows, parts)
+        ]
+    }, separators=(',', ':')).encode('utf-8')
+    return WINDOWED_MAGIC + len(header).to_bytes(8, 'little') + header
+
+
+def read_windowed_header(f):
+    """从分窗口差异文件开头读取 JSON 头，读取后文件位置指向第一个窗口的差异数据"""
+    if f.read(len(WINDOWED_MAGIC)) != WINDOWED_MAGIC:
+        raise ValueError("不是分窗口格式的差异文件")
+    header_length = int.from_bytes(f.read(8), 'little')
+    return json.loads(f.read(header_length))
+
+
+def apply_windowed(fold, fpatch, header, write):
+    """逐个窗口从旧文件和差异文件合成新数据，每个窗口的结果交给 write；返回合成的总字节数"""
+    decode = CODECS[header.get('codec', 'bsdiff')][2]
+    total = 0
+    for old_offset, old_length, new_length, patch_length in header['windows']:
+        fold.seek(old_offset)
+        data = decode(fold.read(old_length), fpatch.read(patch_length))
+        if len(data) != new_length:
+            raise ValueError(f"窗口合成结果长度不符: {len(data)} != {new_length}")
+        write(data)
+        total += len(data)
+    return total
@@ -0,0 +1,154 @@
+import os
+import heapq
+
+
+def parse_version(version):
+    """将版本号转换为整数元组用于排序"""
+    return tuple(map(int, version.split('.')))
+
+
+def iter_version_patches(info):
+    """遍历某个版本记录的全部差异文件（兼容只有 patch 字段的旧配置）"""
+    seen = set()
+    for patch_info in info.get('patches', []) + ([info['patch']] if 'patch' in info else []):
+        if patch_info['patch_file'] in seen:
+            continue
+        seen.add(patch_info['patch_file'])
+        yield patch_info
+
+
+def get_full_size(version_info, version, versions_dir):
+    """获取完整文件大小，配置中没有记录时读取磁盘"""
+    info = version_info['versions'][version]
+    if 'size' in info:
+        return info['size']
+    file_path = os.path.join(versions_dir, f'v{version}', 'app')
+    if os.path.exists(file_path):
+        return os.path.getsize(file_path)
+    return None
+
+
+def build_patch_graph(version_info, patches_dir):
+    """把版本配置构造成图：版本为节点，差异文件为边，边权为差异文件字节数"""
+    graph = {}
+    for to_version, info in version_info['versions'].items():
+        for patch_info in iter_version_patches(info):
+            from_version = patch_info['from_version']
+            # 跳过自环和来源版本不存在的差异文件
+            if from_version == to_version or from_version not in version_info['versions']:
+                continue
+            # 跳过磁盘上已被清理的差异文件
+            patch_file = os.path.join(patches_dir, patch_info['patch_file'])
+            if not os.path.exists(patch_file):
+                continue
+            size = patch_info.get('size')
+            if size is None:
+                size = os.path.getsize(patch_file)
+            edge = {
+                'from_version': from_version,
+                'to_version': to_version,
+                'patch_file': patch_info['patch_file'],
+                'md5': patch_info['md5'],
+                'size': size,
+                'target_md5': info['md5']
+            }
+            # 配置了更快的校验摘要时一并下发
+            if 'digest' in patch_info:
+                edge['digest'] = patch_info['digest']
+            if 'digest' in info:
+                edge['target_digest'] = info['digest']
+            if 'blocks' in patch_info:
+                edge['blocks'] = patch_info['blocks']
+            if 'codec' in patch_info:
+                edge['codec'] = patch_info['codec']
+            graph.setdefault(from_version, []).append(edge)
+    return graph
+
+
+def find_cheapest_chain(graph, start, target, extra_starts=()):
+    """Dijkstra 求从 start 到 target 总字节数最小的差异文件链，不可达时返回 None
+
+    extra_starts 为客户端本地还持有的其他版本，也可以作为起点（总字节数相同时优先 start）；
+    链的第一步的来源版本即选中的基准版本。
+    """
+    starts = [start] + [version for version in extra_starts if version != start]
+    queue = [(0, order, version) for order, version in enumerate(starts)]
+    heapq.heapify(queue)
+    order = len(queue)
+    best = {version: 0 for version in starts}
+    previous = {}
+    while queue:
+        cost, _, version = heapq.heappop(queue)
+        if version == target:
+            break
+        if cost > best.get(version, float('inf')):
+            continue
+        for edge in graph.get(version, []):
+            new_cost = cost + edge['size']
+            if new_cost < best.get(edge['to_version'], float('inf')):
+                best[edge['to_version']] = new_cost
+                previous[edge['to_version']] = edge
+                heapq.heappush(queue, (new_cost, order, edge['to_version']))
+                order += 1
+
+    if target not in best:
+        return None
+
+    chain = []
+    version = target
+    while version in previous:
+        edge = previous[version]
+        chain.append(edge)
+        version = edge['from_version']
+    chain.reverse()
+    return chain
+
+
+def plan_update(version_info, current_version, patches_dir, versions_dir, target_version=None, graph=None,
+                can_generate=None, held_versions=()):
+    """计算从当前版本到目标版本的最省流量更新方案，可传入预先构建的差异文件图
+
+    held_versions 为客户端本地还持有的其他版本（备份、缓存），差异文件链可以从其中任一版本出发，
+    差异更新方案的 base_version 为选中的基准版本。
+    只能完整下载但服务器可以按需生成差异文件时（can_generate(来源版本, 目标版本) 为真），
+    方案带 on_demand 标记，客户端可请求生成后重新规划。
+    """
+    target_version = target_version or version_info['latest_version']
+    target_info = version_info['versions'][target_version]
+    full_size = get_full_size(version_info, target_version, versions_dir)
+
+    plan = {
+        'current_version': current_version,
+        'target_version': target_version,
+        'md5': target_info['md5'],
+        'full_size': full_size,
+        'steps': []
+    }
+
+    if current_version == target_version:
+        plan['method'] = 'none'
+        plan['total_size'] = 0
+        return plan
+
+    chain = None
+    held_versions = [
+        version for version in held_versions
+        if version in version_info['versions'] and version != target_version
+    ]
+    if current_version in version_info['versions'] or held_versions:
+        if graph is None:
+            graph = build_patch_graph(version_info, patches_dir)
+        chain = find_cheapest_chain(graph, current_version, target_version, held_versions)
+
+    # 差异文件链比完整下载更大时，直接完整下载
+    if chain and (full_size is None or sum(step['size'] for step in chain) < full_size):
+        plan['method'] = 'patch'
+        plan['base_version'] = chain[0]['from_version']
+        plan['steps'] = [dict(step) for step in chain]
+        plan['total_size'] = sum(step['size'] for step in chain)
+    else:
+        plan['method'] = 'full'
+        plan['total_size'] = full_size
+        if not chain and can_generate is not None and can_generate(current_version, target_version):
+            plan['on_demand'] = True
+    return plan
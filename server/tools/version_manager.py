@@ -1,16 +1,29 @@
 import os
 import json
 import hashlib
-import bsdiff4
 import sys
+import stat
+import shutil
 import time
+import signal
 import threading
 import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from tqdm import tqdm
 
 # 添加父目录到系统路径以导入配置
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+from tools.chunk_store import ChunkStore
+from tools.hashing import (
+    digest_algorithms, format_digest, hash_file, copy_and_hash, write_and_hash, merkle_root, BLOCK_DIGEST_SIZE,
+    MultiHasher
+)
+from tools.windowed_diff import diff_window, write_windowed_patch
+from tools.update_formats import available_codecs, encode_deltas, decode_delta, plan_windows
+from tools.precompress import available_encodings, precompress_file, ENCODING_MEMORY, ENCODING_SUFFIXES
+from tools.patch_cache import PatchCache
+
 # 获取配置文件路径
 config_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server_config.json')
 
@@ -19,6 +32,152 @@ with open(config_path, 'r') as f:
     config = json.load(f)
     SERVER_CONFIG = config['SERVER_CONFIG']
     APP_CONFIG = config['APP_CONFIG']
+    PATCH_CONFIG = config.get('PATCH_CONFIG', {})
+    CHUNK_CONFIG = config.get('CHUNK_CONFIG', {})
+    HASH_CONFIG = config.get('HASH_CONFIG', {})
+    COMPRESSION_CONFIG = config.get('COMPRESSION_CONFIG', {})
+    PATCH_CACHE_CONFIG = config.get('PATCH_CACHE_CONFIG', {})
+
+# 发布时计算的摘要算法（MD5 + 配置的校验算法）
+DIGEST_ALGORITHMS = digest_algorithms(HASH_CONFIG)
+# 块哈希清单的块大小
+BLOCK_SIZE = HASH_CONFIG.get('block_size_kb', 1024) * 1024
+# 生成差异文件时尝试的差异编码（未安装可选依赖的编码自动跳过）
+PATCH_CODECS = available_codecs(PATCH_CONFIG.get('codecs', ['bsdiff'])) or ['bsdiff']
+# 分窗口差异文件各窗口使用的差异编码
+WINDOW_CODEC = (available_codecs([PATCH_CONFIG.get('window_codec', 'bsdiff')]) or ['bsdiff'])[0]
+# 完整文件的预压缩格式（未安装可选依赖的格式自动跳过）
+PRECOMPRESS_ENCODINGS = available_encodings(COMPRESSION_CONFIG.get('encodings', []))
+
+def report_unavailable_features():
+    """提示配置了但当前环境不可用（缺少可选依赖）而被跳过的差异编码和预压缩格式"""
+    skipped = [name for name in PATCH_CONFIG.get('codecs', ['bsdiff']) if name not in PATCH_CODECS]
+    skipped += [name for name in COMPRESSION_CONFIG.get('encodings', []) if name not in PRECOMPRESS_ENCODINGS]
+    if skipped:
+        print(f"警告: {', '.join(skipped)} 不可用（未安装 zstandard？请按 requirements.txt 安装依赖），已跳过")
+
+def estimate_diff_memory(old_size, new_size):
+    """估算一个差异计算任务的峰值内存：后缀数组约 17 倍旧文件大小，外加新文件、bsdiff 数据流与一份候选差异数据
+
+    各差异编码共用一次 bsdiff 计算且候选逐个写出，所以与配置的编码数量无关。
+    """
+    return 17 * old_size + 3 * new_size
+
+def calculate_file_md5(file_path):
+    """计算文件MD5（供子进程使用）"""
+    return hash_file(file_path, ['md5'])['md5']
+
+def digest_fields(digests):
+    """版本配置中的摘要字段：md5 兼容旧客户端，digest 为配置的校验算法"""
+    fields = {'md5': digests['md5']}
+    digest = format_digest(HASH_CONFIG, digests)
+    if digest:
+        fields['digest'] = digest
+    return fields
+
+def generate_patch(key, prev_file, dest_file, patch_file, codec='bsdiff'):
+    """用指定的差异编码生成单个差异文件并测量解码耗时（在子进程中运行），写入时直接计算摘要"""
+    key, candidates = generate_patch_candidates(key, prev_file, dest_file, patch_file, [codec], suffix=False)
+    return key, candidates[0]
+
+def generate_patch_candidates(key, prev_file, dest_file, patch_file, codecs, suffix=True):
+    """用每个差异编码各生成一份候选差异文件（<patch_file>.<codec>），返回 (key, [差异文件信息])（在子进程中运行）
+
+    bsdiff 系列的编码共用同一次 bsdiff 计算，只重新压缩数据流；候选逐个写出，内存中同一时刻只有一份。
+    """
+    # 与 bsdiff4.file_diff 相同，两个文件整体读入内存
+    with open(prev_file, 'rb') as f:
+        old_data = f.read()
+    with open(dest_file, 'rb') as f:
+        new_data = f.read()
+    candidates = []
+    for codec, patch_data in encode_deltas(codecs, old_data, new_data):
+        start_time = time.perf_counter()
+        if decode_delta(codec, old_data, patch_data) != new_data:
+            raise ValueError(f"差异编码 {codec} 的解码结果与新文件不一致")
+        decode_seconds = time.perf_counter() - start_time
+        candidate_file = f'{patch_file}.{codec}' if suffix else patch_file
+        digests = write_and_hash(candidate_file, patch_data, DIGEST_ALGORITHMS, BLOCK_SIZE)
+        candidates.append(dict(
+            patch_file=os.path.basename(candidate_file),
+            size=len(patch_data),
+            codec=codec,
+            decode_seconds=decode_seconds,
+            block_hashes=digests['blocks'],
+            **digest_fields(digests)
+        ))
+        del patch_data
+    return key, candidates
+
+def build_tree_manifest(root_dir, digests=None):
+    """扫描目录，生成 相对路径 -> 大小/MD5/权限 的文件清单和 相对路径 -> 链接目标 的符号链接清单（路径统一使用 / 分隔）
+
+    digests 为复制时已计算的 文件路径 -> 摘要，提供时不再重新读取文件。指向目录的符号链接同样记入链接清单，不进入其中扫描。
+    返回 (文件清单, 符号链接清单)。
+    """
+    digests = digests or {}
+    files = {}
+    links = {}
+    for dirpath, dirnames, filenames in os.walk(root_dir):
+        dirnames.sort()
+        for filename in sorted(dirnames + filenames):
+            file_path = os.path.join(dirpath, filename)
+            rel_path = os.path.relpath(file_path, root_dir).replace(os.sep, '/')
+            if os.path.islink(file_path):
+                links[rel_path] = os.readlink(file_path)
+                continue
+            if not os.path.isfile(file_path):
+                continue
+            file_digests = digests.get(file_path) or hash_file(file_path, DIGEST_ALGORITHMS)
+            files[rel_path] = dict(
+                size=os.path.getsize(file_path),
+                mode=stat.S_IMODE(os.stat(file_path).st_mode),
+                **digest_fields(file_digests)
+            )
+    return files, links
+
+def tree_digest(files, links=None):
+    """目录清单的整体摘要：按路径排序后对 路径、MD5、权限 计算 MD5，之后是各符号链接的 路径、链接目标"""
+    md5_hash = hashlib.md5()
+    for rel_path in sorted(files):
+        info = files[rel_path]
+        md5_hash.update(f"{rel_path}\0{info['md5']}\0{info['mode']:o}\n".encode('utf-8'))
+    for rel_path in sorted(links or {}):
+        md5_hash.update(f"{rel_path}\0->{links[rel_path]}\n".encode('utf-8'))
+    return md5_hash.hexdigest()
+
+def init_on_demand_worker():
+    """按需生成进程的初始化函数：使用独立的进程组，服务器进程退出后终止整个进程组（包括内部的差异计算进程）"""
+    if not hasattr(os, 'setpgrp'):
+        return
+    os.setpgrp()
+    parent = os.getppid()
+
+    def watch_parent():
+        while os.getppid() == parent:
+            time.sleep(1)
+        os.killpg(0, signal.SIGTERM)
+
+    threading.Thread(target=watch_parent, daemon=True).start()
+
+def generate_patch_on_demand(from_version, to_version):
+    """按需生成两个已发布版本之间的差异文件（在服务器的后台进程中运行），返回差异文件信息"""
+    manager = VersionManager()
+    dest_file = os.path.join(manager.versions_dir, f'v{to_version}', 'app')
+    materialized = None
+    if not os.path.exists(dest_file):
+        # 完整文件已清理，从块存储临时重建
+        materialized = manager.chunk_store.materialize(
+            to_version, os.path.join(manager.base_dir, 'patches', f'.target_{to_version}_{os.getpid()}')
+        )
+        dest_file = materialized
+    try:
+        patch_info = manager.generate_patches(to_version, dest_file, [from_version], verbose=False)[0]
+    finally:
+        if materialized:
+            os.remove(materialized)
+    patch_info['to_version'] = to_version
+    return patch_info
 
 class ElapsedTimeThread(threading.Thread):
     """实时显示经过时间的线程"""
@@ -45,6 +204,12 @@ class VersionManager:
         self.config_dir = os.path.join(self.base_dir, 'config')
         self.config_path = os.path.join(self.config_dir, 'versions.json')
         self.versions_dir = os.path.join(self.base_dir, 'versions')
+        self.chunk_store = ChunkStore(os.path.join(self.base_dir, 'chunks'))
+        self.trees_dir = os.path.join(self.config_dir, 'trees')
+        self.blocks_dir = os.path.join(self.config_dir, 'blocks')
+        self.patch_cache = PatchCache(
+            os.path.join(self.base_dir, 'patches'), self.blocks_dir, self.config_dir, PATCH_CACHE_CONFIG
+        )
         
         # 使用配置文件中的端口
         self.server_url = f"http://localhost:{SERVER_CONFIG['port']}"
@@ -70,37 +235,294 @@ class VersionManager:
             return {"latest_version": "1.0", "versions": {}}
 
     def save_config(self, config):
-        """保存版本配置"""
-        with open(self.config_path, 'w', encoding='utf-8') as f:
+        """保存版本配置（先写临时文件再原子替换，避免服务器读到写了一半的配置）"""
+        temp_path = self.config_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
             json.dump(config, f, ensure_ascii=False, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.config_path)
 
     def calculate_md5(self, file_path):
         """计算文件MD5"""
-        md5_hash = hashlib.md5()
-        with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                md5_hash.update(chunk)
-        return md5_hash.hexdigest()
+        return calculate_file_md5(file_path)
+
+    def save_block_hashes(self, name, leaves):
+        """保存块哈希清单，返回写入版本配置的 blocks 字段（客户端用其中的 Merkle 根校验清单）"""
+        os.makedirs(self.blocks_dir, exist_ok=True)
+        file_name = f'{name}.json'
+        blocks_path = os.path.join(self.blocks_dir, file_name)
+        with open(blocks_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({
+                'algorithm': f'blake2b-{BLOCK_DIGEST_SIZE * 8}',
+                'block_size': BLOCK_SIZE,
+                'blocks': leaves
+            }, f, separators=(',', ':'))
+        os.replace(blocks_path + '.tmp', blocks_path)
+        return {
+            'file': file_name,
+            'block_size': BLOCK_SIZE,
+            'count': len(leaves),
+            'root': merkle_root(leaves)
+        }
 
     def version_to_float(self, version):
         """将版本号转换为浮点数用于比较"""
         return float(version)
 
     def copy_with_progress(self, src_file, dest_file):
-        """带进度显示的文件复制"""
+        """带进度显示的文件复制，复制过程中同时计算摘要并返回"""
         total_size = os.path.getsize(src_file)
-        with open(src_file, 'rb') as fsrc:
-            with open(dest_file, 'wb') as fdst:
-                with tqdm(total=total_size, unit='B', unit_scale=True, desc="复制文件") as pbar:
-                    while True:
-                        buf = fsrc.read(8192)
-                        if not buf:
-                            break
-                        fdst.write(buf)
-                        pbar.update(len(buf))
-
-    def add_version(self, version, file_path, description):
+        with tqdm(total=total_size, unit='B', unit_scale=True, desc="复制文件") as pbar:
+            return copy_and_hash(src_file, dest_file, DIGEST_ALGORITHMS, pbar.update, BLOCK_SIZE)
+
+    def choose_bases(self, versions, recent_bases=None, milestones=None):
+        """选择差异文件的基准版本：最近 N 个版本加上指定的里程碑版本"""
+        recent_bases = PATCH_CONFIG.get('recent_bases', 1) if recent_bases is None else recent_bases
+        milestones = PATCH_CONFIG.get('milestone_versions', []) if milestones is None else milestones
+        
+        bases = versions[-recent_bases:] if recent_bases > 0 else []
+        for milestone in milestones:
+            if milestone in versions and milestone not in bases:
+                bases.append(milestone)
+        return bases
+
+    def select_patch_bases(self, versions, recent_bases=None, milestones=None):
+        """选择单文件差异的基准版本，只保留完整文件或块索引仍然存在的版本"""
+        return [
+            base for base in self.choose_bases(versions, recent_bases, milestones)
+            if os.path.exists(os.path.join(self.versions_dir, f'v{base}', 'app'))
+            or self.chunk_store.has_index(base)
+        ]
+
+    def generate_patches(self, version, dest_file, bases, verbose=True):
+        """在进程池中并行生成多个基准版本的差异文件，同时运行的任务受内存预算限制
+
+        差异文件先写入临时文件再替换到位，服务器不会读到写了一半的差异文件。
+        """
+        patches_dir = os.path.join(self.base_dir, 'patches')
+        os.makedirs(patches_dir, exist_ok=True)
+        
+        new_size = os.path.getsize(dest_file)
+        # 超过阈值的大文件按窗口分别计算差异，单个任务的内存只与窗口大小有关
+        windowed = new_size > PATCH_CONFIG.get('windowed_threshold_mb', 512) * 1024 * 1024
+        window_size = PATCH_CONFIG.get('window_size_mb', 64) * 1024 * 1024
+        new_chunks = self.load_chunk_list(version) if windowed else None
+        
+        jobs = []
+        tasks = []
+        windows = {}
+        prev_files = {}
+        materialized = []
+        for base in bases:
+            prev_file = os.path.join(self.versions_dir, f'v{base}', 'app')
+            if not os.path.exists(prev_file):
+                # 完整文件已清理，从块存储临时重建
+                prev_file = self.chunk_store.materialize(base, os.path.join(patches_dir, f'.base_{base}_{os.getpid()}'))
+                materialized.append(prev_file)
+            prev_files[base] = prev_file
+            patch_file = os.path.join(patches_dir, f'patch_{base}_to_{version}.diff')
+            old_size = os.path.getsize(prev_file)
+            if not windowed:
+                jobs.append((base, prev_file, dest_file, patch_file))
+                continue
+            # 有块索引时按内容匹配窗口，否则按位置对齐
+            windows[base] = plan_windows(
+                old_size, new_size, window_size, self.load_chunk_list(base), new_chunks
+            )
+            for index, (old_offset, old_length, new_offset, new_length) in enumerate(windows[base]):
+                tasks.append((
+                    estimate_diff_memory(old_length, new_length),
+                    diff_window,
+                    ((base, index), WINDOW_CODEC, prev_file, old_offset, old_length, dest_file, new_offset, new_length)
+                ))
+        
+        try:
+            if windowed:
+                results = self.run_pool_tasks(tasks, show_progress=verbose)
+            else:
+                results = self.run_diff_jobs(jobs, verbose=verbose)
+            if windowed and PATCH_CONFIG.get('compare_whole_file'):
+                self.report_window_regression(version, dest_file, prev_files, results, windows)
+        finally:
+            for prev_file in materialized:
+                os.remove(prev_file)
+        
+        # 按基准版本顺序返回，块摘要写入单独的块哈希清单
+        patches = []
+        for base in bases:
+            if windowed:
+                patch_file = os.path.join(patches_dir, f'patch_{base}_to_{version}.diff')
+                hasher = MultiHasher(DIGEST_ALGORITHMS, BLOCK_SIZE)
+                parts = [results.pop((base, index)) for index in range(len(windows[base]))]
+                size = write_windowed_patch(
+                    patch_file + '.tmp', os.path.getsize(prev_files[base]), new_size, windows[base], parts,
+                    WINDOW_CODEC, hasher
+                )
+                os.replace(patch_file + '.tmp', patch_file)
+                digests = hasher.hexdigests()
+                info = dict(
+                    patch_file=os.path.basename(patch_file),
+                    size=size,
+                    codec=WINDOW_CODEC,
+                    format='windowed',
+                    windows=len(windows[base]),
+                    block_hashes=digests['blocks'],
+                    **digest_fields(digests)
+                )
+            else:
+                info = results[base]
+            leaves = info.pop('block_hashes')
+            info['blocks'] = self.save_block_hashes(info['patch_file'], leaves)
+            patches.append(dict(from_version=base, **info))
+        return patches
+
+    def load_chunk_list(self, version):
+        """读取某个版本块索引中的块列表，没有块索引时返回 None"""
+        if not self.chunk_store.has_index(version):
+            return None
+        return self.chunk_store.load_index(version)['chunks']
+
+    def report_window_regression(self, version, dest_file, prev_files, results, windows):
+        """与整体 bsdiff 比较分窗口差异文件的大小；整体计算超出内存预算的基准版本跳过"""
+        memory_budget = PATCH_CONFIG.get('memory_budget_mb', 4096) * 1024 * 1024
+        new_size = os.path.getsize(dest_file)
+        tasks = []
+        skipped = []
+        for base, prev_file in prev_files.items():
+            memory = estimate_diff_memory(os.path.getsize(prev_file), new_size)
+            if memory > memory_budget:
+                skipped.append(base)
+                continue
+            compare_file = os.path.join(os.path.dirname(prev_file), f'.compare_{base}_to_{version}.diff')
+            tasks.append((memory, generate_patch, (base, prev_file, dest_file, compare_file)))
+        
+        print(f"\n正在计算整体差异文件用于比较...")
+        whole = self.run_pool_tasks(tasks)
+        print(f"\n分窗口差异文件与整体差异文件大小比较:")
+        for base, info in whole.items():
+            os.remove(os.path.join(os.path.dirname(prev_files[base]), info['patch_file']))
+            windowed_size = sum(len(results[(base, index)]) for index in range(len(windows[base])))
+            print(
+                f"{base} -> {version}: 分窗口 {windowed_size/1024/1024:.2f} MB, "
+                f"整体 {info['size']/1024/1024:.2f} MB, "
+                f"增加 {(windowed_size - info['size'])/max(info['size'], 1)*100:.2f}%"
+            )
+        for base in skipped:
+            print(f"{base} -> {version}: 整体计算超出内存预算，跳过比较")
+
+    def run_diff_jobs(self, jobs, verbose=False):
+        """在进程池中并行执行差异计算任务，同时运行的任务受内存预算限制
+
+        jobs 为 [(key, 旧文件, 新文件, 差异文件)]。每个任务在一个子进程中计算一次 bsdiff，
+        再用全部配置的差异编码各生成一份候选，按 select_codec 保留一份，返回 key -> 差异文件信息（含 codec）。
+        """
+        tasks = []
+        for key, prev_file, new_file, patch_file in jobs:
+            memory = estimate_diff_memory(os.path.getsize(prev_file), os.path.getsize(new_file))
+            tasks.append((memory, generate_patch_candidates, (key, prev_file, new_file, patch_file, PATCH_CODECS)))
+        results = self.run_pool_tasks(tasks, show_progress=verbose)
+        
+        selected = {}
+        for key, prev_file, new_file, patch_file in jobs:
+            candidates = results[key]
+            best = self.select_codec(candidates, os.path.getsize(new_file))
+            for info in candidates:
+                candidate_file = f"{patch_file}.{info['codec']}"
+                if info is best:
+                    os.replace(candidate_file, patch_file)
+                else:
+                    os.remove(candidate_file)
+            if verbose and len(candidates) > 1:
+                print(f"{key}: " + ", ".join(
+                    f"{info['codec']} {info['size']/1024:.1f} KB / 解码 {info['decode_seconds']*1000:.0f} ms"
+                    for info in candidates
+                ) + f"，选择 {best['codec']}")
+            best['patch_file'] = os.path.basename(patch_file)
+            best.pop('decode_seconds')
+            selected[key] = best
+        return selected
+
+    def select_codec(self, candidates, new_size):
+        """在解码耗时预算内选择最小的差异文件（同样大小时选解码更快的），都超出预算时选择解码最快的"""
+        budget = PATCH_CONFIG.get('decode_budget_ms_per_mb', 200) / 1000 * max(new_size / 1024 / 1024, 1)
+        within_budget = [info for info in candidates if info['decode_seconds'] <= budget]
+        if within_budget:
+            return min(within_budget, key=lambda info: (info['size'], info['decode_seconds']))
+        return min(candidates, key=lambda info: info['decode_seconds'])
+
+    def precompress_full(self, version, dest_file):
+        """并行生成完整文件的各预压缩版本，压缩效果不足 min_ratio 的版本直接删除
+
+        返回 编码 -> {file, size, blocks}，写入版本配置的 encodings 字段。
+        """
+        if not PRECOMPRESS_ENCODINGS:
+            return {}
+        file_size = os.path.getsize(dest_file)
+        min_ratio = COMPRESSION_CONFIG.get('min_ratio', 0.95)
+        tasks = [
+            (ENCODING_MEMORY[encoding], precompress_file, (encoding, dest_file, encoding, BLOCK_SIZE))
+            for encoding in PRECOMPRESS_ENCODINGS
+        ]
+        encodings = {}
+        for encoding, info in self.run_pool_tasks(tasks).items():
+            variant_file = os.path.join(os.path.dirname(dest_file), info['file'])
+            if info['size'] >= file_size * min_ratio:
+                os.remove(variant_file)
+                print(f"{encoding}: {info['size']/1024/1024:.2f} MB，压缩效果不足，已跳过")
+                continue
+            encodings[encoding] = {
+                'file': info['file'],
+                'size': info['size'],
+                'blocks': self.save_block_hashes(f'v{version}{ENCODING_SUFFIXES[encoding]}', info['block_hashes'])
+            }
+            print(f"{encoding}: {info['size']/1024/1024:.2f} MB, 压缩比: {info['size']/file_size*100:.2f}%")
+        return encodings
+
+    def run_pool_tasks(self, tasks, show_progress=True):
+        """在进程池中并行执行任务，同时运行的任务受内存预算限制
+
+        tasks 为 [(内存估算, 函数, 参数)]，函数返回 (key, 结果)，返回 key -> 结果。
+        """
+        if not tasks:
+            return {}
+        max_workers = PATCH_CONFIG.get('max_workers') or multiprocessing.cpu_count()
+        memory_budget = PATCH_CONFIG.get('memory_budget_mb', 4096) * 1024 * 1024
+        
+        results = {}
+        timer = ElapsedTimeThread() if show_progress else None
+        if timer is not None:
+            timer.start()
+        try:
+            with ProcessPoolExecutor(max_workers=min(max_workers, len(tasks))) as executor:
+                running = {}
+                in_use = 0
+                for memory, func, args in tasks:
+                    # 超出内存预算时等待已有任务完成（单个任务超预算时单独运行）
+                    while running and in_use + memory > memory_budget:
+                        done, _ = wait(running, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            in_use -= running.pop(future)
+                            done_key, info = future.result()
+                            results[done_key] = info
+                    future = executor.submit(func, *args)
+                    running[future] = memory
+                    in_use += memory
+                
+                for future in as_completed(running):
+                    done_key, info = future.result()
+                    results[done_key] = info
+        finally:
+            if timer is not None:
+                timer.stop()
+                timer.join()
+        return results
+
+    def add_version(self, version, file_path, description, recent_bases=None, milestones=None):
         """添加新版本"""
+        report_unavailable_features()
+        if os.path.isdir(file_path):
+            return self.add_tree_version(version, file_path, description, recent_bases, milestones)
         try:
             config = self.load_config()
             
@@ -111,7 +533,7 @@ class VersionManager:
             # 复制可执行文件到版本目录（带进度显示）
             print(f"\n正在复制文件到版本目录...")
             dest_file = os.path.join(version_dir, 'app')
-            self.copy_with_progress(file_path, dest_file)
+            digests = self.copy_with_progress(file_path, dest_file)
             
             # 计算并显示文件大小
             file_size = os.path.getsize(dest_file)
@@ -119,61 +541,62 @@ class VersionManager:
             
             # 使用正确的版本号排序
             versions = sorted(
-                [v for v in config['versions'].keys()],
+                [v for v in config['versions'].keys() if v != version],
                 key=lambda x: tuple(map(int, x.split('.')))
             )
             
-            if versions:
-                prev_version = versions[-1]
-                prev_file = os.path.join(self.versions_dir, f'v{prev_version}', 'app')
+            version_entry = {
+                'files': ['app'],
+                **digest_fields(digests),
+                'size': file_size,
+                'blocks': self.save_block_hashes(f'v{version}', digests['blocks']),
+                'description': description
+            }
+            
+            if PRECOMPRESS_ENCODINGS:
+                print(f"\n正在生成预压缩版本...")
+                encodings = self.precompress_full(version, dest_file)
+                if encodings:
+                    version_entry['encodings'] = encodings
+            
+            # 先写入块存储，分窗口差异按块索引匹配窗口
+            if CHUNK_CONFIG.get('enabled'):
+                print(f"\n正在写入块存储...")
+                chunk_info = self.chunk_store.add_file(
+                    version, dest_file, version_entry['md5'],
+                    CHUNK_CONFIG.get('min_size_kb', 16) * 1024,
+                    CHUNK_CONFIG.get('avg_size_kb', 64) * 1024,
+                    CHUNK_CONFIG.get('max_size_kb', 256) * 1024
+                )
+                print(
+                    f"块数: {chunk_info['chunks']}, 新增块: {chunk_info['new_chunks']}, "
+                    f"新增数据: {chunk_info['new_bytes']/1024/1024:.2f} MB"
+                )
+                version_entry['chunk_index'] = chunk_info
+            
+            # 目录版本不能作为单文件差异的基准
+            file_versions = [v for v in versions if config['versions'][v].get('type') != 'tree']
+            bases = self.select_patch_bases(file_versions, recent_bases, milestones)
+            if bases:
+                print(f"\n正在生成与版本 {', '.join(bases)} 的差异文件...")
+                patches = self.generate_patches(version, dest_file, bases)
                 
-                if os.path.exists(prev_file):
-                    print(f"\n正在生成与版本 {prev_version} 的差异文件...")
-                    patch_file = os.path.join(self.base_dir, 'patches', f'patch_{prev_version}_to_{version}.diff')
-                    os.makedirs(os.path.dirname(patch_file), exist_ok=True)
-                    
-                    # 启动计时器线程
-                    timer = ElapsedTimeThread()
-                    timer.start()
-                    
-                    try:
-                        # 生成差异文件
-                        bsdiff4.file_diff(prev_file, dest_file, patch_file)
-                    finally:
-                        # 停止计时器线程
-                        timer.stop()
-                        timer.join()
-                    
-                    # 计算差异文件的MD5
-                    patch_md5 = self.calculate_md5(patch_file)
-                    patch_size = os.path.getsize(patch_file)
-                    
-                    print(f"\n差异文件生成完成:")
-                    print(f"差异文件大小: {patch_size/1024/1024:.2f} MB")
-                    print(f"压缩比: {patch_size/file_size*100:.2f}%")
-                    
-                    config['versions'][version] = {
-                        'files': ['app'],
-                        'md5': self.calculate_md5(dest_file),
-                        'description': description,
-                        'patch': {
-                            'from_version': prev_version,
-                            'patch_file': os.path.basename(patch_file),
-                            'md5': patch_md5
-                        }
-                    }
-                else:
-                    config['versions'][version] = {
-                        'files': ['app'],
-                        'md5': self.calculate_md5(dest_file),
-                        'description': description
-                    }
-            else:
-                config['versions'][version] = {
-                    'files': ['app'],
-                    'md5': self.calculate_md5(dest_file),
-                    'description': description
-                }
+                print(f"\n差异文件生成完成:")
+                for patch_info in patches:
+                    print(
+                        f"{patch_info['from_version']} -> {version}: "
+                        f"{patch_info['size']/1024/1024:.2f} MB, "
+                        f"压缩比: {patch_info['size']/file_size*100:.2f}%"
+                    )
+                
+                version_entry['patches'] = patches
+                # 兼容只读取 patch 字段的旧客户端：优先记录来自上一版本的差异文件
+                version_entry['patch'] = next(
+                    (p for p in patches if p['from_version'] == file_versions[-1]),
+                    patches[0]
+                )
+            
+            config['versions'][version] = version_entry
             
             # 更新最新版本号
             config['latest_version'] = version
@@ -182,10 +605,142 @@ class VersionManager:
             self.save_config(config)
             print(f"\n成功添加版本 {version}")
             
+            # 已进入块存储的旧版本不再保留完整副本
+            if CHUNK_CONFIG.get('enabled') and not CHUNK_CONFIG.get('keep_full_copies', True):
+                self.prune_full_copies(keep_version=version)
+            
+            # 差异文件超出缓存预算时按命中情况淘汰
+            self.cleanup_old_patches()
+            
+        except Exception as e:
+            print(f"\n添加版本失败: {str(e)}")
+            raise
+
+    def tree_manifest_path(self, version):
+        return os.path.join(self.trees_dir, f'v{version}.json')
+
+    def load_tree_manifest(self, version):
+        with open(self.tree_manifest_path(version), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def add_tree_version(self, version, src_dir, description, recent_bases=None, milestones=None):
+        """添加目录形式的新版本：生成文件清单，只为变化的文件生成差异文件"""
+        try:
+            config = self.load_config()
+            
+            # 复制目录到版本目录（保留权限，符号链接按链接复制）
+            print(f"\n正在复制目录到版本目录...")
+            version_dir = os.path.join(self.versions_dir, f'v{version}')
+            if os.path.exists(version_dir):
+                shutil.rmtree(version_dir)
+            digests = {}
+            
+            def copy_file(src, dst):
+                digests[dst] = copy_and_hash(src, dst, DIGEST_ALGORITHMS)
+                shutil.copystat(src, dst)
+                return dst
+            
+            shutil.copytree(src_dir, version_dir, symlinks=True, copy_function=copy_file)
+            
+            files, links = build_tree_manifest(version_dir, digests)
+            total_size = sum(info['size'] for info in files.values())
+            print(f"文件数: {len(files)}, 符号链接数: {len(links)}, 总大小: {total_size/1024/1024:.2f} MB")
+            
+            versions = sorted(
+                [v for v in config['versions'].keys() if v != version],
+                key=lambda x: tuple(map(int, x.split('.')))
+            )
+            tree_versions = [
+                v for v in versions
+                if config['versions'][v].get('type') == 'tree' and os.path.exists(self.tree_manifest_path(v))
+            ]
+            bases = self.choose_bases(tree_versions, recent_bases, milestones)
+            
+            # 只为两个版本中都存在且内容变化的文件生成差异文件
+            patches_dir = os.path.join(self.base_dir, 'patches')
+            jobs = []
+            base_files = {}
+            for base in bases:
+                base_files[base] = self.load_tree_manifest(base)['files']
+                for rel_path, info in files.items():
+                    base_info = base_files[base].get(rel_path)
+                    if base_info is None or base_info['md5'] == info['md5']:
+                        continue
+                    patch_file = os.path.join(patches_dir, f'tree_{base}_to_{version}', rel_path + '.diff')
+                    os.makedirs(os.path.dirname(patch_file), exist_ok=True)
+                    jobs.append((
+                        (base, rel_path),
+                        os.path.join(self.versions_dir, f'v{base}', rel_path),
+                        os.path.join(version_dir, rel_path),
+                        patch_file
+                    ))
+            
+            if jobs:
+                print(f"\n正在为 {len(jobs)} 个变化的文件生成差异文件...")
+            results = self.run_diff_jobs(jobs)
+            
+            patches = {base: {} for base in bases}
+            for (base, rel_path), info in results.items():
+                patch_file = os.path.join(patches_dir, f'tree_{base}_to_{version}', rel_path + '.diff')
+                # 差异文件不比原文件小时直接下发整个文件
+                if info['size'] >= files[rel_path]['size']:
+                    os.remove(patch_file)
+                    continue
+                patches[base][rel_path] = {
+                    **{key: info[key] for key in ('md5', 'digest', 'codec') if key in info},
+                    'size': info['size'],
+                    'base_md5': base_files[base][rel_path]['md5']
+                }
+            
+            for base in bases:
+                changed = sum(
+                    1 for rel_path, info in files.items()
+                    if base_files[base].get(rel_path, {}).get('md5') != info['md5']
+                )
+                removed = sum(1 for rel_path in base_files[base] if rel_path not in files)
+                print(
+                    f"{base} -> {version}: 变化 {changed} 个文件，"
+                    f"其中 {len(patches[base])} 个使用差异文件，删除 {removed} 个文件"
+                )
+            
+            # 保存目录清单
+            os.makedirs(self.trees_dir, exist_ok=True)
+            manifest_path = self.tree_manifest_path(version)
+            with open(manifest_path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump({'version': version, 'files': files, 'links': links, 'patches': patches}, f, ensure_ascii=False)
+            os.replace(manifest_path + '.tmp', manifest_path)
+            
+            config['versions'][version] = {
+                'type': 'tree',
+                'md5': tree_digest(files, links),
+                'size': total_size,
+                'file_count': len(files),
+                'description': description,
+                'tree_manifest': {
+                    'file': os.path.basename(manifest_path),
+                    'md5': self.calculate_md5(manifest_path)
+                }
+            }
+            config['latest_version'] = version
+            self.save_config(config)
+            print(f"\n成功添加版本 {version}")
+            
         except Exception as e:
             print(f"\n添加版本失败: {str(e)}")
             raise
 
+    def prune_full_copies(self, keep_version):
+        """删除已写入块存储的旧版本完整副本（含预压缩版本），只保留最新版本的完整文件"""
+        for name in os.listdir(self.versions_dir):
+            version = name[1:]
+            app_file = os.path.join(self.versions_dir, name, 'app')
+            if version != keep_version and os.path.exists(app_file) and self.chunk_store.has_index(version):
+                os.remove(app_file)
+                for suffix in ENCODING_SUFFIXES.values():
+                    if os.path.exists(app_file + suffix):
+                        os.remove(app_file + suffix)
+                print(f"已删除完整副本（可由块存储重建）: {name}")
+
     def cleanup_old_versions(self, max_versions=10):
         """清理旧版本信息"""
         try:
@@ -205,36 +760,17 @@ class VersionManager:
         except Exception as e:
             print(f"清理旧版本失败: {str(e)}")
 
-    def cleanup_old_patches(self, max_patches=10):
-        """清理旧的差异文件，只保留最近的几个"""
+    def cleanup_old_patches(self):
+        """差异文件总大小超出 PATCH_CACHE_CONFIG.max_size_mb 时，按实际下载命中情况淘汰差异文件"""
         try:
             patches_dir = os.path.join(self.base_dir, 'patches')
             if not os.path.exists(patches_dir):
                 return
-            
-            # 获取所有差异文件
-            patches = []
-            for item in os.listdir(patches_dir):
-                if item.startswith('patch_') and item.endswith('.diff'):
-                    patch_path = os.path.join(patches_dir, item)
-                    # 获取文件修改时间作为排序依据
-                    mtime = os.path.getmtime(patch_path)
-                    patches.append((mtime, patch_path))
-            
-            # 按时间戳排序
-            patches.sort(reverse=True)  # 最新的在前面
-            
-            # 如果差异文件数量超过限制，删除旧的文件
-            if len(patches) > max_patches:
-                for _, patch_path in patches[max_patches:]:
-                    try:
-                        os.remove(patch_path)
-                        print(f"已删除旧的差异文件: {os.path.basename(patch_path)}")
-                    except Exception as e:
-                        print(f"删除差异文件失败 {os.path.basename(patch_path)}: {str(e)}")
-                
-                remaining = len(patches) - len(patches[max_patches:])
-                print(f"已清理旧的差异文件，当前保留 {remaining} 个最新差异文件")
+            removed = self.patch_cache.evict()
+            for name in removed:
+                print(f"已淘汰差异文件: {name}")
+            if removed:
+                print(f"已清理 {len(removed)} 个差异文件，差异文件总大小回到预算以内")
         
         except Exception as e:
             print(f"清理旧的差异文件失败: {str(e)}")
@@ -247,6 +783,8 @@ if __name__ == "__main__":
     parser.add_argument('--version', type=str, help="版本号")
     parser.add_argument('--file', type=str, help="版本文件")
     parser.add_argument('--desc', type=str, help="版本描述")
+    parser.add_argument('--bases', type=int, help="基于最近 N 个版本生成差异文件")
+    parser.add_argument('--milestones', type=str, help="额外的里程碑基准版本，逗号分隔")
     
     args = parser.parse_args()
     
@@ -256,4 +794,5 @@ if __name__ == "__main__":
         if not all([args.version, args.file, args.desc]):
             print("添加版本需要提供: --version <版本号> --file <版本文件> --desc <版本描述>")
         else:
-            manager.add_version(args.version, args.file, args.desc)
\ No newline at end of file
+            milestones = args.milestones.split(',') if args.milestones else None
+            manager.add_version(args.version, args.file, args.desc, args.bases, milestones)
\ No newline at end of file
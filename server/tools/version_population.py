@@ -0,0 +1,87 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from tools.file_lock import locked
+
+# 计数分桶的时长（秒）
+BUCKET_SECONDS = 3600
+
+
+def bucket_count(value):
+    """桶中某个版本的人数：当前桶为客户端摘要列表，之前的桶（及旧格式记录）为整数"""
+    return len(value) if isinstance(value, list) else value
+
+
+class VersionPopulation:
+    """客户端版本分布的滚动计数
+
+    按小时分桶统计检查更新请求中上报的当前版本，同一客户端（按客户端标识的摘要区分）在一个桶内只计一次，
+    频繁轮询的少数客户端不会抬高排名；只保留最近 window_hours 小时的桶。
+    当前小时的桶保存各版本的客户端摘要列表以便去重，之前的桶收拢为人数。
+    进程内先累计，再定期合并写入 config/version_population.json（多个 worker 进程共用，合并时持有文件锁）。
+    """
+
+    def __init__(self, path, window_hours=168):
+        self.path = path
+        self.lock_path = path + '.lock'
+        self.window = window_hours * 3600
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def record(self, version, client):
+        """记录一次检查更新（只在内存中累计，由 flush 写入），client 为客户端标识（如 IP）"""
+        client_key = hashlib.blake2b(client.encode('utf-8'), digest_size=8).hexdigest()
+        with self.lock:
+            self.pending.setdefault(version, set()).add(client_key)
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def flush(self):
+        """把进程内累计的客户端合并到当前小时的桶，之前的桶收拢为人数，并丢弃窗口以外的桶"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        now = time.time()
+        bucket = str(int(now // BUCKET_SECONDS) * BUCKET_SECONDS)
+        with locked(self.lock_path):
+            buckets = {}
+            for key, counts in self.load().items():
+                if now - int(key) >= self.window + BUCKET_SECONDS:
+                    continue
+                if key != bucket:
+                    counts = {version: bucket_count(value) for version, value in counts.items()}
+                buckets[key] = counts
+            counts = buckets.setdefault(bucket, {})
+            for version, clients in pending.items():
+                merged = counts.get(version)
+                counts[version] = sorted(set(merged if isinstance(merged, list) else []) | clients)
+            temp_path = f'{self.path}.{os.getpid()}.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(buckets, f, separators=(',', ':'))
+            os.replace(temp_path, self.path)
+
+    def totals(self):
+        """窗口内各版本的客户端数（各小时桶内去重后的人数之和）"""
+        now = time.time()
+        totals = {}
+        for key, counts in self.load().items():
+            if now - int(key) < self.window + BUCKET_SECONDS:
+                for version, count in counts.items():
+                    totals[version] = totals.get(version, 0) + bucket_count(count)
+        return totals
+
+    def top_versions(self, k, exclude=()):
+        """窗口内客户端最多的 k 个版本，返回 [(版本, 客户端数)]"""
+        ranked = sorted(
+            ((version, count) for version, count in self.totals().items() if version not in exclude),
+            key=lambda item: item[1], reverse=True
+        )
+        return ranked[:k]
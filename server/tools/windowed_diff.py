@@ -0,0 +1,23 @@
+from tools.update_formats import encode_delta, plan_windows, windowed_prefix
+
+
+def diff_window(key, codec, old_file, old_offset, old_length, new_file, new_offset, new_length):
+    """用指定的差异编码计算单个窗口的差异数据（在子进程中运行），只读取两个文件中对应的区间"""
+    with open(old_file, 'rb') as f:
+        f.seek(old_offset)
+        old_data = f.read(old_length)
+    with open(new_file, 'rb') as f:
+        f.seek(new_offset)
+        new_data = f.read(new_length)
+    return key, encode_delta(codec, old_data, new_data)
+
+
+def write_windowed_patch(patch_file, old_size, new_size, windows, parts, codec, hasher):
+    """把各窗口的差异数据写成分窗口差异文件（格式见 update_formats），写入时同时更新 hasher，返回文件大小"""
+    size = 0
+    with open(patch_file, 'wb') as f:
+        for data in [windowed_prefix(codec, old_size, new_size, windows, parts)] + list(parts):
+            f.write(data)
+            hasher.update(data)
+            size += len(data)
+    return size
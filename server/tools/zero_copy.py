@@ -0,0 +1,206 @@
+import os
+import mmap
+import stat
+import time
+import threading
+from collections import OrderedDict
+from starlette.responses import Response
+from tools.file_serving import make_etag, build_range_response, iter_file_range
+
+# 不支持 zerocopysend 时每次发送的内存映射切片大小
+SEND_CHUNK_SIZE = 1024 * 1024
+
+
+class CachedFile:
+    """缓存的打开文件：文件对象、stat 结果和按需建立的只读内存映射"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb', buffering=0)
+        self.fd = self.file.fileno()
+        self.stat = os.fstat(self.fd)
+        if not stat.S_ISREG(self.stat.st_mode):
+            self.file.close()
+            raise FileNotFoundError(path)
+        self.key = (self.stat.st_ino, self.stat.st_size, self.stat.st_mtime_ns)
+        self.etag = make_etag(self.stat)
+        self.checked_at = time.monotonic()
+        self.refs = 0
+        self.discarded = False
+        self._mapping = None
+
+    @property
+    def size(self):
+        return self.stat.st_size
+
+    def mapping(self):
+        """返回整个文件的只读内存映射（空文件不能映射，返回空字节串）"""
+        if not self.size:
+            return b''
+        if self._mapping is None:
+            self._mapping = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+        return self._mapping
+
+    def close(self):
+        if self._mapping is not None:
+            try:
+                self._mapping.close()
+            except BufferError:
+                # 切片仍被发送缓冲引用，交给垃圾回收释放
+                pass
+            self._mapping = None
+        self.file.close()
+
+
+class OpenFileCache:
+    """按路径缓存打开的文件和 stat 结果，避免每个下载请求都重新 open/stat
+
+    条目超过 ttl 秒后重新 stat，文件被替换或删除时丢弃；正在发送的条目在释放后才关闭。
+    stat() 另外缓存预压缩版本等路径的查询结果（包括不存在）。
+    """
+
+    def __init__(self, max_entries=256, ttl=1.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, path):
+        """取得文件的缓存条目并增加引用，用完后必须调用 release；文件不存在时抛出 FileNotFoundError"""
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and now - entry.checked_at > self.ttl:
+                try:
+                    stat_result = os.stat(path)
+                    current = (stat_result.st_ino, stat_result.st_size, stat_result.st_mtime_ns)
+                except FileNotFoundError:
+                    current = None
+                if current != entry.key:
+                    self._discard(path)
+                    entry = None
+                else:
+                    entry.checked_at = now
+            if entry is None:
+                entry = CachedFile(path)
+                self.entries[path] = entry
+                while len(self.entries) > self.max_entries:
+                    self._discard(next(iter(self.entries)))
+            self.entries.move_to_end(path)
+            entry.refs += 1
+            return entry
+
+    def release(self, entry):
+        with self.lock:
+            entry.refs -= 1
+            if entry.refs == 0 and entry.discarded:
+                entry.close()
+
+    def _discard(self, path):
+        entry = self.entries.pop(path)
+        entry.discarded = True
+        if entry.refs == 0:
+            entry.close()
+
+    def stat(self, path):
+        """带缓存的 os.stat，文件不存在时抛出 FileNotFoundError"""
+        now = time.monotonic()
+        cached = self.stats.get(path)
+        if cached is None or now - cached[0] > self.ttl:
+            try:
+                stat_result = os.stat(path)
+            except FileNotFoundError:
+                stat_result = None
+            if len(self.stats) >= self.max_entries * 4:
+                self.stats.clear()
+            cached = self.stats[path] = (now, stat_result)
+        if cached[1] is None:
+            raise FileNotFoundError(path)
+        return cached[1]
+
+
+class ZeroCopyFileResponse(Response):
+    """从缓存的文件描述符发送 [offset, offset + count) 区间
+
+    ASGI 服务器支持 http.response.zerocopysend 扩展时交给 sendfile，否则按块发送内存映射切片，
+    不经过线程池读文件。发送结束后释放缓存条目。
+    """
+
+    def __init__(self, cache, entry, offset, count, status_code=200, headers=None,
+                 media_type='application/octet-stream'):
+        super().__init__(status_code=status_code, headers=headers, media_type=media_type)
+        self.cache = cache
+        self.entry = entry
+        self.offset = offset
+        self.count = count
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await send({'type': 'http.response.start', 'status': self.status_code, 'headers': self.raw_headers})
+            if scope.get('method') == 'HEAD' or not self.count:
+                await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+            elif 'http.response.zerocopysend' in scope.get('extensions', {}):
+                await send({
+                    'type': 'http.response.zerocopysend',
+                    'file': self.entry.fd,
+                    'offset': self.offset,
+                    'count': self.count,
+                    'more_body': False
+                })
+            else:
+                view = memoryview(self.entry.mapping())
+                end = self.offset + self.count
+                try:
+                    for start in range(self.offset, end, SEND_CHUNK_SIZE):
+                        await send({
+                            'type': 'http.response.body',
+                            'body': view[start:min(start + SEND_CHUNK_SIZE, end)],
+                            'more_body': True
+                        })
+                finally:
+                    view.release()
+                await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            self.cache.release(self.entry)
+
+
+def build_cached_file_response(cache, file_path, range_header=None, if_range=None, filename=None,
+                               media_type='application/octet-stream', extra_headers=None):
+    """构造支持 Range 的文件响应，文件描述符和 stat 结果来自 cache，完整内容和单区间以零拷贝方式发送
+
+    文件不存在时抛出 FileNotFoundError。
+    """
+    entry = cache.acquire(file_path)
+    handed_off = False
+
+    def zero_copy_response(headers, start, end, status_code):
+        nonlocal handed_off
+        handed_off = True
+        headers['Content-Length'] = str(end - start)
+        return ZeroCopyFileResponse(cache, entry, start, end - start, status_code, headers, media_type)
+
+    def full_response(headers):
+        if filename is not None:
+            headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return zero_copy_response(headers, 0, entry.size, 200)
+
+    try:
+        response = build_range_response(
+            lambda start, end: iter_file_range(file_path, start, end),
+            entry.size,
+            entry.etag,
+            entry.stat.st_mtime,
+            range_header,
+            if_range,
+            filename=filename,
+            media_type=media_type,
+            extra_headers=extra_headers,
+            full_response=full_response,
+            partial_response=lambda headers, start, end: zero_copy_response(headers, start, end + 1, 206)
+        )
+    finally:
+        # 416 和多区间响应不持有缓存条目
+        if not handed_off:
+            cache.release(entry)
+    return response
@@ -0,0 +1,34 @@
+import os
+import sys
+import json
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLIENT_DIR = os.path.join(ROOT_DIR, 'client')
+SERVER_DIR = os.path.join(ROOT_DIR, 'server')
+
+# 服务器代码按 `from tools.x import` 导入，客户端代码按 `from client import` 导入，与直接运行时一致
+for path in (ROOT_DIR, SERVER_DIR, CLIENT_DIR):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+@pytest.fixture
+def client_home(tmp_path, monkeypatch):
+    """把客户端的工作目录（当前版本、备份、缓存、临时文件和配置）放到临时目录中"""
+    import client as client_module
+    with open(os.path.join(CLIENT_DIR, 'client_config.json'), 'r') as f:
+        config = json.load(f)
+    config['CURRENT_VERSION'] = '1.0.0'
+    with open(tmp_path / 'client_config.json', 'w') as f:
+        json.dump(config, f, indent=4)
+    monkeypatch.setattr(client_module, '__file__', str(tmp_path / 'client.py'))
+    return tmp_path
+
+
+@pytest.fixture
+def update_client(client_home):
+    """在临时工作目录中运行的 UpdateClient，当前版本为 1.0.0"""
+    from client import UpdateClient
+    return UpdateClient()
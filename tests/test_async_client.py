@@ -0,0 +1,90 @@
+import time
+import threading
+import asyncio
+
+import pytest
+
+from async_client import AsyncUpdateClient, BlockingUpdateClient
+
+VERSION_INFO = {'latest_version': '1.0.1', 'versions': {'1.0.1': {}}}
+
+
+@pytest.fixture
+def engine(client_home):
+    return AsyncUpdateClient()
+
+
+def slow_install(engine, version, seconds=0.3):
+    """模拟耗时的本地安装步骤：完成时切换版本号"""
+    def install():
+        time.sleep(seconds)
+        engine.current_version = version
+        return True
+
+    async def run_update(version_info):
+        await asyncio.sleep(0.01)
+        return await engine.run_local(install)
+
+    return run_update
+
+
+def test_timeout_during_install_reports_success(engine, monkeypatch):
+    monkeypatch.setattr(engine, 'run_update', slow_install(engine, '1.0.1'))
+    assert asyncio.run(engine.update(VERSION_INFO, timeout=0.1))
+    assert engine.current_version == '1.0.1'
+    assert engine.trace.result == 'success'
+
+
+def test_timeout_before_install_reports_failure(engine, monkeypatch):
+    async def run_update(version_info):
+        await asyncio.sleep(1)
+        return True
+
+    monkeypatch.setattr(engine, 'run_update', run_update)
+    assert not asyncio.run(engine.update(VERSION_INFO, timeout=0.05))
+    assert engine.current_version == '1.0.0'
+
+
+def test_cancel_during_install_reports_success(engine, monkeypatch):
+    monkeypatch.setattr(engine, 'run_update', slow_install(engine, '1.0.1'))
+
+    async def main():
+        task = asyncio.ensure_future(engine.update(VERSION_INFO))
+        await asyncio.sleep(0.1)
+        task.cancel()
+        return await task
+
+    assert asyncio.run(main())
+    assert engine.current_version == '1.0.1'
+
+
+@pytest.fixture
+def blocking(engine):
+    client = BlockingUpdateClient(engine)
+    yield client
+    client.close()
+
+
+def test_rollback_runs_on_engine_thread(blocking, engine, monkeypatch):
+    threads = []
+
+    def rollback():
+        threads.append(threading.current_thread())
+        return True
+
+    monkeypatch.setattr(engine, 'rollback', rollback)
+    assert blocking.rollback()
+    assert threads and threads[0] is not threading.current_thread()
+
+
+def test_rollback_refused_while_updating(blocking, engine, monkeypatch):
+    rolled_back = []
+    monkeypatch.setattr(engine, 'run_update', slow_install(engine, '1.0.1'))
+    monkeypatch.setattr(engine, 'rollback', lambda: rolled_back.append(True) or True)
+    future = blocking.submit(engine.update(VERSION_INFO))
+    time.sleep(0.1)
+    assert not blocking.rollback()
+    assert not blocking.rollback_to('1.0.0')
+    assert future.result(5)
+    assert rolled_back == []
+    assert blocking.rollback()
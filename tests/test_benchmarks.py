@@ -0,0 +1,37 @@
+import os
+import sys
+import json
+import subprocess
+
+from conftest import SERVER_DIR
+
+
+def run_benchmark(script, arguments, tmp_path):
+    """在子进程中运行基准脚本（与命令行用法一致），返回输出的 JSON 结果"""
+    output = tmp_path / 'result.json'
+    subprocess.run(
+        [sys.executable, os.path.join(SERVER_DIR, script)] + arguments + ['--output', str(output)],
+        cwd=SERVER_DIR, check=True, capture_output=True, timeout=300
+    )
+    with open(output, 'r') as f:
+        return json.load(f)
+
+
+def test_load_benchmark_smoke(tmp_path):
+    report = run_benchmark('benchmark_load.py', [
+        '--clients', '4', '--processes', '1', '--duration', '1.5', '--think-ms', '50', '--artifact-mb', '2'
+    ], tmp_path)
+    assert report['config']['latest_version']
+    assert report['totals']['requests'] > 0
+    assert report['totals']['error_rate'] == 0
+
+
+def test_patch_benchmark_smoke(tmp_path):
+    report = run_benchmark('benchmark_patches.py', [
+        '--sizes', '1', '--kinds', 'small-edit', '--codecs', 'bsdiff', '--modes', 'whole,windowed', '--window-mb', '1',
+        '--workers', '1', '--repeat', '1', '--data-dir', str(tmp_path / 'data')
+    ], tmp_path)
+    assert [(entry['codec'], entry['mode']) for entry in report['results']] == [('bsdiff', 'whole'), ('bsdiff', 'windowed')]
+    for entry in report['results']:
+        assert 'skipped' not in entry
+        assert 0 < entry['patch_size'] < entry['new_size']
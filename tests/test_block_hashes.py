@@ -0,0 +1,93 @@
+import os
+import hashlib
+
+import pytest
+
+from tools.hashing import BlockHasher, hash_bytes, hash_file
+from tools.update_formats import BLOCK_DIGEST_SIZE, block_digest, merkle_root
+
+BLOCK_SIZE = 1024
+DATA = os.urandom(BLOCK_SIZE * 5 + 300)
+
+
+def node(left, right):
+    return hashlib.blake2b(bytes.fromhex(left) + bytes.fromhex(right), digest_size=BLOCK_DIGEST_SIZE).hexdigest()
+
+
+def test_block_hasher_is_independent_of_write_sizes():
+    expected = [block_digest(DATA[i:i + BLOCK_SIZE]) for i in range(0, len(DATA), BLOCK_SIZE)]
+    hasher = BlockHasher(BLOCK_SIZE)
+    for i in range(0, len(DATA), 333):
+        hasher.update(DATA[i:i + 333])
+    assert hasher.finish() == expected
+    assert hash_bytes(DATA, ['md5'], BLOCK_SIZE)['blocks'] == expected
+
+
+def test_hash_file_matches_hash_bytes(tmp_path):
+    path = tmp_path / 'data'
+    path.write_bytes(DATA)
+    assert hash_file(str(path), ['md5', 'blake2b'], BLOCK_SIZE) == hash_bytes(DATA, ['md5', 'blake2b'], BLOCK_SIZE)
+
+
+def test_merkle_root():
+    leaves = [block_digest(bytes([i])) for i in range(5)]
+    assert merkle_root([]) == block_digest(b'')
+    assert merkle_root(leaves[:1]) == leaves[0]
+    assert merkle_root(leaves[:2]) == node(leaves[0], leaves[1])
+    # 落单的节点直接进入上一层
+    assert merkle_root(leaves[:3]) == node(node(leaves[0], leaves[1]), leaves[2])
+    assert merkle_root(leaves) == node(
+        node(node(leaves[0], leaves[1]), node(leaves[2], leaves[3])), leaves[4]
+    )
+
+
+@pytest.fixture
+def published():
+    """服务器发布的块哈希清单和版本信息中的 blocks 字段"""
+    leaves = hash_bytes(DATA, ['md5'], BLOCK_SIZE)['blocks']
+    return leaves, {'file': 'v1.json', 'block_size': BLOCK_SIZE, 'root': merkle_root(leaves)}
+
+
+def test_client_verifies_server_blocks(update_client, published, tmp_path):
+    leaves, blocks = published
+    verifier = update_client.build_block_verifier(blocks, len(DATA), leaves)
+    assert verifier is not None
+    assert verifier.check(BLOCK_SIZE, DATA[BLOCK_SIZE:BLOCK_SIZE * 2])
+    assert not verifier.check(0, DATA[1:BLOCK_SIZE + 1])
+    assert verifier.block_end(BLOCK_SIZE * 5) == len(DATA)
+
+    path = tmp_path / 'partial'
+    corrupted = bytearray(DATA)
+    corrupted[BLOCK_SIZE * 3 + 10] ^= 0xff
+    path.write_bytes(corrupted)
+    assert verifier.valid_prefix(str(path), 0, len(DATA)) == BLOCK_SIZE * 3
+    # 不完整的最后一块不算有效
+    assert verifier.valid_prefix(str(path), 0, BLOCK_SIZE * 2 + 5) == BLOCK_SIZE * 2
+
+
+def test_client_rejects_mismatched_manifest(update_client, published):
+    leaves, blocks = published
+    assert update_client.build_block_verifier(dict(blocks, root=leaves[0]), len(DATA), leaves) is None
+    assert update_client.build_block_verifier(blocks, len(DATA) + BLOCK_SIZE, leaves) is None
+
+
+def test_verified_blocks_refetch_corrupted_block(update_client, published, monkeypatch):
+    leaves, blocks = published
+    verifier = update_client.build_block_verifier(blocks, len(DATA), leaves)
+    corrupted = bytearray(DATA)
+    corrupted[BLOCK_SIZE + 1] ^= 0xff
+    refetched = []
+
+    def refetch_block(url, etag, verifier, offset, length, encoding=None):
+        refetched.append((offset, length))
+        return DATA[offset:offset + length]
+
+    monkeypatch.setattr(update_client, 'refetch_block', refetch_block)
+    # 响应数据按与块大小无关的长度到达，最后提前结束
+    received = bytes(corrupted[:-100])
+    chunks = [received[i:i + 700] for i in range(0, len(received), 700)]
+    result = list(update_client.iter_verified_blocks(chunks, 0, verifier, 'url', None))
+    assert refetched == [(BLOCK_SIZE, BLOCK_SIZE)]
+    assert [offset for offset, _ in result] == [0, BLOCK_SIZE, BLOCK_SIZE * 2, BLOCK_SIZE * 3, BLOCK_SIZE * 4,
+                                                BLOCK_SIZE * 5]
+    assert b''.join(data for _, data in result) == DATA[:-100]
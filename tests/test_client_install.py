@@ -0,0 +1,201 @@
+import os
+import json
+
+from client import UpdateClient
+
+
+def write_app(client, data):
+    with open(os.path.join(client.current_dir, 'app'), 'wb') as f:
+        f.write(data)
+
+
+def read_app(client):
+    with open(os.path.join(client.current_dir, 'app'), 'rb') as f:
+        return f.read()
+
+
+def saved_version(client_home):
+    with open(client_home / 'client_config.json', 'r') as f:
+        return json.load(f)['CURRENT_VERSION']
+
+
+def install(client, version, data):
+    staged_file = os.path.join(client.temp_dir, 'app.full')
+    with open(staged_file, 'wb') as f:
+        f.write(data)
+    client.install_full_file(version, staged_file)
+
+
+def interrupt_after_rename(client, version):
+    """模拟切换目录时中断：写入安装日志并把当前版本目录改名为备份，暂存目录尚未就位"""
+    stage = client.stage_current_version()
+    backup = os.path.join(client.backup_dir, f'backup_{client.current_version}_1')
+    with open(client.install_journal, 'w') as f:
+        json.dump({'version': version, 'backup': backup, 'stage': stage}, f)
+    os.rename(client.current_dir, backup)
+    return stage, backup
+
+
+def test_install_keeps_independent_backup(update_client, client_home):
+    write_app(update_client, b'version 1.0.0')
+    install(update_client, '1.0.1', b'version 1.0.1')
+
+    assert update_client.current_version == '1.0.1'
+    assert saved_version(client_home) == '1.0.1'
+    assert read_app(update_client) == b'version 1.0.1'
+    [(_, version, backup_path)] = update_client.list_backups()
+    assert version == '1.0.0'
+    backup_file = os.path.join(backup_path, 'app')
+    with open(backup_file, 'rb') as f:
+        assert f.read() == b'version 1.0.0'
+    assert not os.path.exists(update_client.stage_dir)
+    assert not os.path.exists(update_client.install_journal)
+
+    # 之后安装的版本不与备份共享 inode，原地写入当前版本不会改掉备份
+    install(update_client, '1.0.2', b'version 1.0.2')
+    newest_backup = update_client.list_backups()[0][2]
+    assert not os.path.samefile(os.path.join(update_client.current_dir, 'app'), os.path.join(newest_backup, 'app'))
+    with open(os.path.join(update_client.current_dir, 'app'), 'r+b') as f:
+        f.write(b'X')
+    with open(os.path.join(newest_backup, 'app'), 'rb') as f:
+        assert f.read() == b'version 1.0.1'
+
+
+def test_rollback_restores_previous_version(update_client, client_home):
+    write_app(update_client, b'version 1.0.0')
+    install(update_client, '1.0.1', b'version 1.0.1')
+    assert update_client.rollback()
+    assert update_client.current_version == '1.0.0'
+    assert saved_version(client_home) == '1.0.0'
+    assert read_app(update_client) == b'version 1.0.0'
+    # 被替换的版本进入本地缓存，可不经网络重新安装
+    assert '1.0.1' in update_client.cache.versions()
+
+
+def test_recover_interrupted_swap_restores_original(update_client, client_home):
+    write_app(update_client, b'version 1.0.0')
+    stage, backup = interrupt_after_rename(update_client, '1.0.1')
+
+    recovered = UpdateClient()
+    assert recovered.current_version == '1.0.0'
+    assert read_app(recovered) == b'version 1.0.0'
+    assert not os.path.exists(backup)
+    assert not os.path.exists(stage)
+    assert not os.path.exists(recovered.install_journal)
+
+
+def test_recover_completed_swap_records_version(update_client, client_home):
+    write_app(update_client, b'version 1.0.0')
+    stage, backup = interrupt_after_rename(update_client, '1.0.1')
+    with open(os.path.join(stage, 'app'), 'wb') as f:
+        f.write(b'version 1.0.1')
+    os.rename(stage, update_client.current_dir)
+
+    recovered = UpdateClient()
+    assert recovered.current_version == '1.0.1'
+    assert saved_version(client_home) == '1.0.1'
+    assert read_app(recovered) == b'version 1.0.1'
+    assert os.path.exists(backup)
+    assert not os.path.exists(recovered.install_journal)
+
+
+def test_recover_before_swap_discards_stage(update_client, client_home):
+    write_app(update_client, b'version 1.0.0')
+    stage = update_client.stage_current_version()
+    with open(update_client.install_journal, 'w') as f:
+        json.dump({'version': '1.0.1', 'backup': os.path.join(update_client.backup_dir, 'backup_1.0.0_1'),
+                   'stage': stage}, f)
+
+    recovered = UpdateClient()
+    assert recovered.current_version == '1.0.0'
+    assert read_app(recovered) == b'version 1.0.0'
+    assert not os.path.exists(stage)
+    assert not os.path.exists(recovered.install_journal)
+
+
+class Crash(BaseException):
+    """模拟进程在切换途中被终止（不被 except Exception 捕获）"""
+
+
+def test_rollback_renames_full_backup(update_client):
+    write_app(update_client, b'version 1.0.0')
+    install(update_client, '1.0.1', b'version 1.0.1')
+    [(_, _, backup_path)] = update_client.list_backups()
+    backup_inode = os.stat(os.path.join(backup_path, 'app')).st_ino
+
+    assert update_client.rollback()
+    # 没有差异备份以它为基准：备份目录直接成为当前版本目录
+    assert os.stat(os.path.join(update_client.current_dir, 'app')).st_ino == backup_inode
+    assert update_client.list_backups() == []
+    assert not os.path.exists(update_client.install_journal)
+    assert not [name for name in os.listdir(update_client.temp_dir) if name.startswith('rollback_')]
+
+
+def test_rollback_keeps_base_of_delta_backup(update_client):
+    write_app(update_client, b'version 1.0.0' * 1000)
+    install(update_client, '1.0.1', b'version 1.0.1' * 1000)
+    install(update_client, '1.0.2', b'version 1.0.2' * 1000)
+    newest, older = [path for _, _, path in update_client.list_backups()]
+    assert update_client.is_delta_backup(older)
+
+    assert update_client.rollback()
+    assert read_app(update_client) == b'version 1.0.1' * 1000
+    # 基准备份保留，更早的差异备份仍可重建
+    assert [path for _, _, path in update_client.list_backups()] == [newest, older]
+    check_dir = os.path.join(update_client.temp_dir, 'check')
+    update_client.materialize_backup(older, check_dir)
+    with open(os.path.join(check_dir, 'app'), 'rb') as f:
+        assert f.read() == b'version 1.0.0' * 1000
+
+
+def test_recover_rollback_interrupted_between_renames(update_client, client_home, monkeypatch):
+    write_app(update_client, b'version 1.0.0')
+    install(update_client, '1.0.1', b'version 1.0.1')
+    [(_, _, backup_path)] = update_client.list_backups()
+    rename = os.rename
+
+    def crashing_rename(src, dst):
+        if src == backup_path:
+            raise Crash()
+        rename(src, dst)
+
+    monkeypatch.setattr(os, 'rename', crashing_rename)
+    try:
+        update_client.rollback()
+    except Crash:
+        pass
+    monkeypatch.setattr(os, 'rename', rename)
+    assert not os.path.exists(update_client.current_dir)
+
+    recovered = UpdateClient()
+    assert recovered.current_version == '1.0.1'
+    assert saved_version(client_home) == '1.0.1'
+    assert read_app(recovered) == b'version 1.0.1'
+    # 直接改名的备份在切换前中断时原样保留
+    assert [path for _, _, path in recovered.list_backups()] == [backup_path]
+    assert not os.path.exists(recovered.install_journal)
+
+
+def test_recover_rollback_interrupted_before_saving_version(update_client, client_home, monkeypatch):
+    write_app(update_client, b'version 1.0.0')
+    install(update_client, '1.0.1', b'version 1.0.1')
+
+    save_current_version = UpdateClient.save_current_version
+
+    def crash(self, version):
+        raise Crash()
+
+    monkeypatch.setattr(UpdateClient, 'save_current_version', crash)
+    try:
+        update_client.rollback()
+    except Crash:
+        pass
+    monkeypatch.setattr(UpdateClient, 'save_current_version', save_current_version)
+    assert saved_version(client_home) == '1.0.1'
+
+    recovered = UpdateClient()
+    assert recovered.current_version == '1.0.0'
+    assert saved_version(client_home) == '1.0.0'
+    assert read_app(recovered) == b'version 1.0.0'
+    assert not [name for name in os.listdir(recovered.temp_dir) if name.startswith('rollback_')]
+    assert not os.path.exists(recovered.install_journal)
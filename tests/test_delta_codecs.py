@@ -0,0 +1,99 @@
+import os
+import random
+
+import bsdiff4
+import pytest
+
+from tools import update_formats
+from tools.update_formats import (
+    CODECS, STREAM_CODECS, codec_from_magic, decode_delta, decode_detected, encode_delta, encode_deltas
+)
+from tools.version_manager import VersionManager, generate_patch_candidates
+
+
+def make_pair(seed, size=50000):
+    rng = random.Random(seed)
+    old = rng.randbytes(size)
+    new = old[:1000] + rng.randbytes(200) + old[1000:30000] + old[35000:] + b'tail'
+    return old, new
+
+
+@pytest.mark.parametrize('codec', sorted(CODECS))
+@pytest.mark.parametrize('old, new', [make_pair(1), (b'', b'new data'), (b'old data', b''), (b'same', b'same')])
+def test_codec_round_trip(codec, old, new):
+    patch = encode_delta(codec, old, new)
+    assert codec_from_magic(patch) == codec
+    assert decode_delta(codec, old, patch) == new
+    assert decode_detected(old, patch) == new
+
+
+def test_unknown_magic():
+    assert codec_from_magic(b'NOTADIFF' + bytes(32)) is None
+    with pytest.raises(ValueError):
+        decode_detected(b'', b'NOTADIFF' + bytes(32))
+
+
+def test_bsdiff_matches_bsdiff4():
+    old, new = make_pair(2)
+    assert encode_delta('bsdiff', old, new) == bsdiff4.diff(old, new)
+    assert dict(encode_deltas(['bsdiff'], old, new))['bsdiff'] == bsdiff4.diff(old, new)
+
+
+def test_encode_deltas_runs_bsdiff_once(monkeypatch):
+    calls = []
+    diff = update_formats.bsdiff_core.diff
+
+    def counting_diff(old, new):
+        calls.append(len(old))
+        return diff(old, new)
+
+    monkeypatch.setattr(update_formats.bsdiff_core, 'diff', counting_diff)
+    old, new = make_pair(3)
+    names = sorted(CODECS)
+    results = list(encode_deltas(names, old, new))
+    assert [name for name, _ in results] == names
+    assert len(calls) == 1
+    for name, patch in results:
+        assert decode_delta(name, old, patch) == new
+    assert len(calls) == 1
+    assert {'bsdiff', 'bsdiff-lzma'} <= set(STREAM_CODECS)
+
+
+def test_generate_patch_candidates(tmp_path):
+    old, new = make_pair(4)
+    (tmp_path / 'old').write_bytes(old)
+    (tmp_path / 'new').write_bytes(new)
+    patch_file = str(tmp_path / 'patch.diff')
+    codecs = sorted(CODECS)
+    key, candidates = generate_patch_candidates('k', str(tmp_path / 'old'), str(tmp_path / 'new'), patch_file, codecs)
+    assert key == 'k'
+    assert [info['codec'] for info in candidates] == codecs
+    for info in candidates:
+        assert info['patch_file'] == f"patch.diff.{info['codec']}"
+        data = (tmp_path / info['patch_file']).read_bytes()
+        assert len(data) == info['size']
+        assert decode_delta(info['codec'], old, data) == new
+    assert not os.path.exists(patch_file)
+
+
+def test_select_codec_prefers_smallest_within_budget():
+    manager = VersionManager.__new__(VersionManager)
+    candidates = [
+        {'codec': 'bsdiff', 'size': 300, 'decode_seconds': 0.01},
+        {'codec': 'bsdiff-lzma', 'size': 200, 'decode_seconds': 0.05},
+        {'codec': 'slow', 'size': 100, 'decode_seconds': 100},
+    ]
+    assert manager.select_codec(candidates, 1024 * 1024)['codec'] == 'bsdiff-lzma'
+    # 都超出预算时选解码最快的
+    assert manager.select_codec([dict(c, decode_seconds=c['decode_seconds'] + 100) for c in candidates],
+                                1024 * 1024)['codec'] == 'bsdiff'
+
+
+def test_client_decoders_accept_server_patches(client_home):
+    from client import DELTA_DECODERS
+    old, new = make_pair(5)
+    assert set(DELTA_DECODERS) == set(CODECS)
+    for name, (magic, decode) in DELTA_DECODERS.items():
+        patch = encode_delta(name, old, new)
+        assert patch.startswith(magic)
+        assert decode(old, patch) == new
@@ -0,0 +1,131 @@
+import os
+import time
+from email.utils import formatdate
+
+import pytest
+from fastapi import FastAPI, Header
+from fastapi.testclient import TestClient
+
+from tools.file_serving import (
+    RangeNotSatisfiable, build_file_response, if_range_matches, make_etag, parse_range_header
+)
+
+DATA = bytes(range(256)) * 40
+
+
+@pytest.fixture
+def served_file(tmp_path):
+    path = tmp_path / 'app'
+    path.write_bytes(DATA)
+    return str(path)
+
+
+@pytest.fixture
+def http(served_file):
+    app = FastAPI()
+
+    @app.get('/file')
+    async def get_file(range: str = Header(default=None), if_range: str = Header(default=None)):
+        return build_file_response(served_file, range, if_range)
+
+    return TestClient(app)
+
+
+@pytest.mark.parametrize('header, expected', [
+    ('bytes=0-99', [(0, 99)]),
+    ('bytes=100-', [(100, 9999)]),
+    ('bytes=-100', [(9900, 9999)]),
+    ('bytes=-20000', [(0, 9999)]),
+    ('bytes=9990-20000', [(9990, 9999)]),
+    ('bytes=0-9,5-20,21-30', [(0, 30)]),
+    ('bytes=500-599, 0-99', [(0, 99), (500, 599)]),
+    ('bytes=10000-,0-0', [(0, 0)]),
+])
+def test_parse_range_header(header, expected):
+    assert parse_range_header(header, 10000) == expected
+
+
+@pytest.mark.parametrize('header', [
+    'items=0-99', 'bytes=', 'bytes=abc-', 'bytes=5', 'bytes=50-10',
+    'bytes=' + ','.join(f'{i * 100}-{i * 100 + 10}' for i in range(17)),
+])
+def test_parse_range_header_falls_back_to_full_file(header):
+    assert parse_range_header(header, 10000) is None
+
+
+@pytest.mark.parametrize('header', ['bytes=10000-', 'bytes=20000-30000', 'bytes=-0'])
+def test_parse_range_header_unsatisfiable(header):
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range_header(header, 10000)
+
+
+def test_if_range_matches(served_file):
+    stat_result = os.stat(served_file)
+    etag = make_etag(stat_result)
+    assert if_range_matches(etag, etag, stat_result.st_mtime)
+    assert not if_range_matches('"0-0"', etag, stat_result.st_mtime)
+    assert if_range_matches(formatdate(stat_result.st_mtime, usegmt=True), etag, stat_result.st_mtime)
+    assert not if_range_matches(formatdate(stat_result.st_mtime - 60, usegmt=True), etag, stat_result.st_mtime)
+    assert not if_range_matches('not a date', etag, stat_result.st_mtime)
+
+
+def test_full_response(http):
+    response = http.get('/file')
+    assert response.status_code == 200
+    assert response.content == DATA
+    assert response.headers['Accept-Ranges'] == 'bytes'
+
+
+def test_single_range(http):
+    response = http.get('/file', headers={'Range': 'bytes=1000-1999'})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f'bytes 1000-1999/{len(DATA)}'
+    assert response.content == DATA[1000:2000]
+
+
+def test_multipart_ranges(http):
+    response = http.get('/file', headers={'Range': 'bytes=0-9,5000-5009,-10'})
+    assert response.status_code == 206
+    content_type = response.headers['Content-Type']
+    assert content_type.startswith('multipart/byteranges; boundary=')
+    boundary = content_type.split('boundary=')[1].encode()
+    assert int(response.headers['Content-Length']) == len(response.content)
+
+    parts = response.content.split(b'--' + boundary)
+    assert parts[-1] == b'--\r\n'
+    bodies = {}
+    for part in parts[1:-1]:
+        head, _, body = part.partition(b'\r\n\r\n')
+        content_range = next(line for line in head.split(b'\r\n') if line.startswith(b'Content-Range'))
+        start, end = map(int, content_range.split(b' ')[-1].split(b'/')[0].split(b'-'))
+        assert body[-2:] == b'\r\n'
+        bodies[start, end] = body[:-2]
+    assert bodies == {
+        (0, 9): DATA[:10],
+        (5000, 5009): DATA[5000:5010],
+        (len(DATA) - 10, len(DATA) - 1): DATA[-10:],
+    }
+
+
+def test_unsatisfiable_range(http):
+    response = http.get('/file', headers={'Range': f'bytes={len(DATA)}-'})
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == f'bytes */{len(DATA)}'
+
+
+def test_if_range_with_current_etag_resumes(http):
+    etag = http.get('/file').headers['ETag']
+    response = http.get('/file', headers={'Range': 'bytes=100-', 'If-Range': etag})
+    assert response.status_code == 206
+    assert response.content == DATA[100:]
+
+
+def test_if_range_after_change_returns_full_file(http, served_file):
+    etag = http.get('/file').headers['ETag']
+    changed = DATA[::-1]
+    with open(served_file, 'wb') as f:
+        f.write(changed)
+    os.utime(served_file, ns=(time.time_ns(), time.time_ns() + 10 ** 9))
+    response = http.get('/file', headers={'Range': 'bytes=100-', 'If-Range': etag})
+    assert response.status_code == 200
+    assert response.content == changed
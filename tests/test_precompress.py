@@ -0,0 +1,49 @@
+import os
+import gzip
+import lzma
+
+import pytest
+
+from tools import precompress
+from tools.precompress import ENCODING_SUFFIXES, available_encodings, precompress_file
+
+DECOMPRESS = {'gzip': gzip.decompress, 'xz': lzma.decompress}
+if precompress.zstandard is not None:
+    DECOMPRESS['zstd'] = lambda data: precompress.zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+
+@pytest.fixture
+def app_file(tmp_path):
+    path = tmp_path / 'app'
+    path.write_bytes(os.urandom(100000) + bytes(1024 * 1024))
+    return str(path)
+
+
+@pytest.mark.parametrize('encoding', available_encodings(list(ENCODING_SUFFIXES)))
+def test_precompress_round_trip(app_file, encoding):
+    key, info = precompress_file('v', app_file, encoding, 64 * 1024)
+    variant = app_file + ENCODING_SUFFIXES[encoding]
+    assert key == 'v' and info['file'] == os.path.basename(variant)
+    with open(variant, 'rb') as f:
+        data = f.read()
+    assert info['size'] == len(data)
+    with open(app_file, 'rb') as f:
+        assert DECOMPRESS[encoding](data) == f.read()
+    assert not os.path.exists(variant + '.tmp')
+
+
+def test_failed_precompress_keeps_previous_variant(app_file, monkeypatch):
+    variant = app_file + '.gz'
+    with open(variant, 'wb') as f:
+        f.write(b'previous')
+
+    class Failing:
+        def compress(self, data):
+            raise OSError("磁盘已满")
+
+    monkeypatch.setattr(precompress, 'make_compressor', lambda encoding: Failing())
+    with pytest.raises(OSError):
+        precompress_file('v', app_file, 'gzip', 64 * 1024)
+    with open(variant, 'rb') as f:
+        assert f.read() == b'previous'
+    assert not os.path.exists(variant + '.tmp')
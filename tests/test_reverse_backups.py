@@ -0,0 +1,127 @@
+import os
+import random
+import shutil
+
+import pytest
+
+from client import BACKUP_ENCODERS
+
+
+def make_version(index):
+    """第 index 个版本的目录内容：app 每个版本有小改动，lib 不变，notes 只在旧版本中存在"""
+    rng = random.Random(0)
+    app = bytearray(rng.randbytes(300 * 1024))
+    for i in range(index):
+        app[50000 * (i + 1):50000 * (i + 1) + 10] = bytes([i + 1]) * 10
+    files = {
+        'app': bytes(app),
+        'lib/core.bin': rng.randbytes(20000),
+        'config.json': f'{{"version": {index}}}'.encode(),
+    }
+    if index == 0:
+        files['notes.txt'] = b'removed later'
+    return files
+
+
+def write_backup(client, version, timestamp, files):
+    path = os.path.join(client.backup_dir, f'backup_{version}_{timestamp}')
+    for rel_path, data in files.items():
+        file_path = os.path.join(path, *rel_path.split('/'))
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'wb') as f:
+            f.write(data)
+    os.chmod(os.path.join(path, 'app'), 0o755)
+    os.symlink('lib/core.bin', os.path.join(path, 'core'))
+    return path
+
+
+def read_tree(path):
+    result = {}
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            file_path = os.path.join(dirpath, filename)
+            rel_path = os.path.relpath(file_path, path).replace(os.sep, '/')
+            if os.path.islink(file_path):
+                result[rel_path] = ('link', os.readlink(file_path))
+            else:
+                with open(file_path, 'rb') as f:
+                    result[rel_path] = (os.stat(file_path).st_mode & 0o777, f.read())
+    return result
+
+
+@pytest.fixture
+def backups(update_client):
+    """三个完整备份（1.0.0 最旧），返回 [(备份路径, 原始目录内容)]，最新的在前面"""
+    update_client.backup_window_size = 64 * 1024
+    result = []
+    for index, version in enumerate(['1.0.0', '1.0.1', '1.0.2']):
+        path = write_backup(update_client, version, index + 1, make_version(index))
+        result.insert(0, (path, read_tree(path)))
+    return result
+
+
+@pytest.mark.parametrize('codec', sorted(BACKUP_ENCODERS))
+def test_compaction_round_trip(update_client, backups, codec, tmp_path):
+    update_client.backup_codec = codec
+    before = sum(update_client.tree_size(path) for path, _ in backups)
+    update_client.compact_backups()
+
+    assert [update_client.is_delta_backup(path) for path, _ in backups] == [False, True, True]
+    assert sum(update_client.tree_size(path) for path, _ in backups) < before / 2
+    for index, (path, original) in enumerate(backups):
+        dest = str(tmp_path / f'materialized_{index}')
+        update_client.materialize_backup(path, dest)
+        assert read_tree(dest) == original
+    # 重建时的中间目录用完即删
+    assert not [name for name in os.listdir(update_client.temp_dir) if name.startswith('rebuild_')]
+
+
+def test_compaction_is_idempotent(update_client, backups):
+    update_client.compact_backups()
+    stored = {path: read_tree(path) for path, _ in backups}
+    update_client.compact_backups()
+    assert {path: read_tree(path) for path, _ in backups} == stored
+
+
+def test_restore_from_delta_backup(update_client, backups):
+    update_client.compact_backups()
+    oldest_path, oldest = backups[-1]
+    assert update_client.restore_from_backup(oldest_path)
+    assert update_client.current_version == '1.0.0'
+    assert read_tree(update_client.current_dir) == oldest
+    # 备份本身保留，仍作为更早备份的基准
+    assert update_client.is_delta_backup(oldest_path)
+
+
+def test_budget_removes_oldest_and_keeps_newest(update_client, backups):
+    newest_path, newest = backups[0]
+    update_client.backup_budget = update_client.tree_size(newest_path) + 1
+    update_client.cleanup_old_backups()
+    remaining = [path for _, _, path in update_client.list_backups()]
+    assert remaining[0] == newest_path
+    assert backups[-1][0] not in remaining
+    assert read_tree(newest_path) == newest
+
+    update_client.backup_budget = 0
+    update_client.cleanup_old_backups()
+    assert [path for _, _, path in update_client.list_backups()] == [newest_path]
+
+
+def test_missing_base_is_reported(update_client, backups, tmp_path):
+    update_client.compact_backups()
+    shutil.rmtree(backups[0][0])
+    with pytest.raises(FileNotFoundError):
+        update_client.materialize_backup(backups[1][0], str(tmp_path / 'dest'))
+
+
+def test_interrupted_compaction_is_recovered(update_client, backups, tmp_path):
+    path, original = backups[1]
+    name = os.path.basename(path)
+    # 临时差异目录写了一半；原备份已改名为 .old 但差异目录未就位
+    os.makedirs(os.path.join(update_client.backup_dir, f'.{name}.delta'))
+    os.rename(path, os.path.join(update_client.backup_dir, f'.{name}.old'))
+
+    update_client.compact_backups()
+    assert sorted(os.listdir(update_client.backup_dir)) == sorted(os.path.basename(p) for p, _ in backups)
+    update_client.materialize_backup(path, str(tmp_path / 'dest'))
+    assert read_tree(str(tmp_path / 'dest')) == original
@@ -0,0 +1,64 @@
+import os
+import shutil
+import hashlib
+
+import pytest
+
+from tools.version_manager import build_tree_manifest, tree_digest
+
+
+def write_tree(root, mode=0o644):
+    os.makedirs(root / 'lib')
+    (root / 'run.sh').write_bytes(b'#!/bin/sh\n')
+    os.chmod(root / 'run.sh', mode)
+    (root / 'lib' / 'libfoo.so.1').write_bytes(b'library')
+    os.symlink('libfoo.so.1', root / 'lib' / 'libfoo.so')
+    os.symlink('lib', root / 'Current')
+
+
+def test_manifest_records_symlinks(tmp_path):
+    write_tree(tmp_path)
+    files, links = build_tree_manifest(str(tmp_path))
+    assert sorted(files) == ['lib/libfoo.so.1', 'run.sh']
+    assert links == {'Current': 'lib', 'lib/libfoo.so': 'libfoo.so.1'}
+    assert files['run.sh']['mode'] == 0o644
+    # 没有符号链接时整体摘要与只含文件的清单一致
+    assert tree_digest(files, {}) == tree_digest(files)
+    assert tree_digest(files, links) != tree_digest(files, {'Current': 'lib'})
+
+
+def target_manifest(client):
+    files = {}
+    for rel_path in ('run.sh', 'lib/libfoo.so.1'):
+        with open(os.path.join(client.current_dir, *rel_path.split('/')), 'rb') as f:
+            files[rel_path] = {'md5': hashlib.md5(f.read()).hexdigest(), 'mode': 0o644}
+    files['run.sh']['mode'] = 0o755
+    return {'files': files, 'links': {'lib/libfoo.so': 'libfoo.so.1', 'Current': 'lib/libfoo.so', 'bin': 'run.sh'}}
+
+
+def test_install_tree_applies_modes_and_links(update_client, tmp_path):
+    write_tree(tmp_path / 'tree')
+    shutil.rmtree(update_client.current_dir)
+    os.replace(tmp_path / 'tree', update_client.current_dir)
+    os.symlink('run.sh', os.path.join(update_client.current_dir, 'old.link'))
+    manifest = target_manifest(update_client)
+    managed = {'files': manifest['files'], 'links': {'Current': 'lib', 'lib/libfoo.so': 'libfoo.so.1', 'old.link': 'run.sh'}}
+
+    state, local_files, changed, _ = update_client.scan_tree_changes(manifest)
+    staging_dir = os.path.join(update_client.temp_dir, 'tree_staging')
+    _, removed = update_client.plan_tree_update(manifest, local_files, changed, managed, staging_dir)
+    assert changed == [] and removed == ['old.link']
+    update_client.install_tree('1.0.1', manifest['files'], changed, removed, staging_dir, manifest['links'])
+
+    current = update_client.current_dir
+    assert os.stat(os.path.join(current, 'run.sh')).st_mode & 0o777 == 0o755
+    assert {name: os.readlink(os.path.join(current, name)) for name in ('Current', 'bin', 'lib/libfoo.so')} == manifest['links']
+    assert not os.path.lexists(os.path.join(current, 'old.link'))
+    assert update_client.load_tree_state()['links'] == manifest['links']
+
+
+@pytest.mark.parametrize('target', ['../../outside', '/etc/passwd', '../lib/../../outside'])
+def test_links_outside_tree_are_refused(update_client, tmp_path, target):
+    with pytest.raises(ValueError):
+        update_client.place_tree_link(str(tmp_path), 'lib/link', target)
+    assert not os.path.lexists(tmp_path / 'lib' / 'link')
@@ -0,0 +1,124 @@
+import pytest
+
+from tools.update_planner import build_patch_graph, find_cheapest_chain, plan_update
+
+FULL_SIZE = 10000
+
+
+def patch(from_version, to_version, size):
+    return {
+        'from_version': from_version,
+        'patch_file': f'patch_{from_version}_to_{to_version}.diff',
+        'md5': f'md5-{from_version}-{to_version}',
+        'size': size
+    }
+
+
+@pytest.fixture
+def version_info():
+    # 1.0 -> 1.1 -> 1.2 -> 1.3 逐版本的小差异，外加一个较大的 1.0 -> 1.3 直达差异
+    return {
+        'latest_version': '1.3',
+        'versions': {
+            '1.0': {'md5': 'v1.0', 'size': FULL_SIZE},
+            '1.1': {'md5': 'v1.1', 'size': FULL_SIZE, 'patches': [patch('1.0', '1.1', 100)]},
+            '1.2': {'md5': 'v1.2', 'size': FULL_SIZE, 'patches': [patch('1.1', '1.2', 200)]},
+            '1.3': {
+                'md5': 'v1.3',
+                'size': FULL_SIZE,
+                'patches': [patch('1.2', '1.3', 300), patch('1.0', '1.3', 1000)]
+            },
+        }
+    }
+
+
+@pytest.fixture
+def patches_dir(tmp_path, version_info):
+    for info in version_info['versions'].values():
+        for patch_info in info.get('patches', []):
+            (tmp_path / patch_info['patch_file']).write_bytes(b'x' * patch_info['size'])
+    return str(tmp_path)
+
+
+def plan(version_info, patches_dir, current_version, **kwargs):
+    return plan_update(version_info, current_version, patches_dir, patches_dir, **kwargs)
+
+
+def test_cheapest_chain_prefers_smaller_total(version_info, patches_dir):
+    result = plan(version_info, patches_dir, '1.0')
+    assert result['method'] == 'patch'
+    assert result['base_version'] == '1.0'
+    assert [(step['from_version'], step['to_version']) for step in result['steps']] == [
+        ('1.0', '1.1'), ('1.1', '1.2'), ('1.2', '1.3')
+    ]
+    assert result['total_size'] == 600
+    assert result['steps'][-1]['target_md5'] == 'v1.3'
+
+
+def test_direct_patch_when_cheaper(version_info, patches_dir):
+    version_info['versions']['1.3']['patches'][1]['size'] = 500
+    result = plan(version_info, patches_dir, '1.0')
+    assert [step['patch_file'] for step in result['steps']] == ['patch_1.0_to_1.3.diff']
+    assert result['total_size'] == 500
+
+
+def test_missing_patch_file_is_skipped(version_info, patches_dir, tmp_path):
+    (tmp_path / 'patch_1.1_to_1.2.diff').unlink()
+    result = plan(version_info, patches_dir, '1.0')
+    assert [step['patch_file'] for step in result['steps']] == ['patch_1.0_to_1.3.diff']
+
+
+def test_full_download_when_chain_is_larger(version_info, patches_dir):
+    version_info['versions']['1.3']['size'] = 550
+    result = plan(version_info, patches_dir, '1.0')
+    assert result['method'] == 'full'
+    assert result['total_size'] == 550
+    assert result['steps'] == []
+
+
+def test_unknown_version_downloads_full_or_on_demand(version_info, patches_dir):
+    result = plan(version_info, patches_dir, '0.9')
+    assert result['method'] == 'full'
+    assert 'on_demand' not in result
+
+    result = plan(version_info, patches_dir, '0.9', can_generate=lambda src, dst: (src, dst) == ('0.9', '1.3'))
+    assert result['method'] == 'full'
+    assert result['on_demand'] is True
+
+
+def test_up_to_date(version_info, patches_dir):
+    result = plan(version_info, patches_dir, '1.3')
+    assert result['method'] == 'none'
+    assert result['total_size'] == 0
+
+
+def test_unreachable_target(version_info, patches_dir):
+    graph = build_patch_graph(version_info, patches_dir)
+    assert find_cheapest_chain(graph, '1.3', '1.0') is None
+    assert find_cheapest_chain(graph, '1.2', '1.2') == []
+
+
+def test_held_version_is_used_as_base(version_info, patches_dir):
+    # 当前版本 0.9 不在图中，但客户端备份里还有 1.1
+    result = plan(version_info, patches_dir, '0.9', held_versions=['1.1'])
+    assert result['method'] == 'patch'
+    assert result['base_version'] == '1.1'
+    assert result['total_size'] == 500
+
+
+def test_held_version_wins_when_cheaper(version_info, patches_dir):
+    result = plan(version_info, patches_dir, '1.0', held_versions=['1.2'])
+    assert result['base_version'] == '1.2'
+    assert [step['patch_file'] for step in result['steps']] == ['patch_1.2_to_1.3.diff']
+
+
+def test_current_version_wins_ties(version_info, patches_dir):
+    # 1.0 -> 1.3 与 1.1 -> 1.2 -> 1.3 同为 500 字节时优先从当前版本出发
+    version_info['versions']['1.3']['patches'][1]['size'] = 500
+    result = plan(version_info, patches_dir, '1.0', held_versions=['1.1'])
+    assert result['base_version'] == '1.0'
+
+
+def test_unknown_and_target_held_versions_are_ignored(version_info, patches_dir):
+    result = plan(version_info, patches_dir, '0.9', held_versions=['0.8', '1.3'])
+    assert result['method'] == 'full'
@@ -0,0 +1,93 @@
+import io
+import os
+import random
+import hashlib
+
+import pytest
+
+from tools.windowed_diff import diff_window, write_windowed_patch
+from tools.update_formats import CODECS, plan_windows, read_windowed_header
+
+WINDOW_SIZE = 64 * 1024
+
+
+def make_versions(seed, size=300 * 1024):
+    """旧文件和在开头插入、中间修改、末尾追加后的新文件"""
+    rng = random.Random(seed)
+    old = rng.randbytes(size)
+    new = rng.randbytes(5000) + old[:100000] + b'changed' + old[100007:] + rng.randbytes(3000)
+    return old, new
+
+
+def write_patch(tmp_path, old, new, codec, windows=None):
+    old_file, new_file, patch_file = (str(tmp_path / name) for name in ('old', 'new', 'patch'))
+    with open(old_file, 'wb') as f:
+        f.write(old)
+    with open(new_file, 'wb') as f:
+        f.write(new)
+    windows = windows or plan_windows(len(old), len(new), WINDOW_SIZE)
+    parts = [
+        diff_window(index, codec, old_file, old_offset, old_length, new_file, new_offset, new_length)[1]
+        for index, (old_offset, old_length, new_offset, new_length) in enumerate(windows)
+    ]
+    hasher = hashlib.md5()
+    size = write_windowed_patch(patch_file, len(old), len(new), windows, parts, codec, hasher)
+    assert size == os.path.getsize(patch_file)
+    assert hasher.hexdigest() == hashlib.md5(open(patch_file, 'rb').read()).hexdigest()
+    return old_file, patch_file
+
+
+def test_plan_windows_covers_new_file():
+    windows = plan_windows(200000, 450000, WINDOW_SIZE)
+    assert [new_offset for _, _, new_offset, _ in windows] == list(range(0, 450000, WINDOW_SIZE))
+    assert sum(new_length for _, _, _, new_length in windows) == 450000
+    for old_offset, old_length, _, _ in windows:
+        assert 0 <= old_offset and old_offset + old_length <= 200000
+
+
+def test_plan_windows_follows_matching_chunks():
+    # 新文件在开头插入了 50000 字节，之后的块与旧文件相同
+    old_chunks = [[f'c{i}', 10000] for i in range(30)]
+    new_chunks = [['inserted', 50000]] + old_chunks
+    windows = plan_windows(300000, 350000, 100000, old_chunks, new_chunks)
+    # 第二个窗口（新文件 100000 起）对应旧文件 50000 起，两侧各留 1/4 窗口余量
+    assert windows[1] == (25000, 150000, 100000, 100000)
+
+
+@pytest.mark.parametrize('codec', sorted(CODECS))
+def test_windowed_round_trip(tmp_path, update_client, codec):
+    old, new = make_versions(1)
+    old_file, patch_file = write_patch(tmp_path, old, new, codec)
+    with open(patch_file, 'rb') as f:
+        header = read_windowed_header(f)
+    assert header['codec'] == codec
+    assert (header['old_size'], header['new_size']) == (len(old), len(new))
+
+    assert update_client.is_windowed_patch(patch_file)
+    out_file = str(tmp_path / 'out')
+    hasher = hashlib.md5()
+    update_client.apply_windowed_patch(old_file, out_file, patch_file, hasher)
+    assert open(out_file, 'rb').read() == new
+    assert hasher.hexdigest() == hashlib.md5(new).hexdigest()
+
+
+def test_windowed_round_trip_to_empty_file(tmp_path, update_client):
+    old, _ = make_versions(2, size=1000)
+    old_file, patch_file = write_patch(tmp_path, old, b'', 'bsdiff')
+    out_file = str(tmp_path / 'out')
+    update_client.apply_windowed_patch(old_file, out_file, patch_file, hashlib.md5())
+    assert os.path.getsize(out_file) == 0
+
+
+def test_windowed_patch_rejects_wrong_base(tmp_path, update_client):
+    old, new = make_versions(3)
+    old_file, patch_file = write_patch(tmp_path, old, new, 'bsdiff')
+    with open(old_file, 'ab') as f:
+        f.write(b'extra')
+    with pytest.raises(ValueError):
+        update_client.apply_windowed_patch(old_file, str(tmp_path / 'out'), patch_file, hashlib.md5())
+
+
+def test_read_windowed_header_rejects_other_formats():
+    with pytest.raises(ValueError):
+        read_windowed_header(io.BytesIO(b'BSDIFF40' + bytes(100)))
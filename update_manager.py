@@ -1,7 +1,8 @@
 import os
 import sys
+import shutil
 import logging
-from client.client import UpdateClient
+from client.async_client import BlockingUpdateClient
 from PySide6.QtCore import QObject, Signal
 import json
 import platform
@@ -9,8 +10,9 @@ import platform
 class UpdateManager(QObject):
     # 定义信号
     update_available = Signal(str, str)  # 版本号, 更新说明
-    update_progress = Signal(str, int)   # 描述, 进度
+    update_progress = Signal(str, int)   # 阶段描述（含已处理量和吞吐）, 当前阶段的进度百分比
     update_finished = Signal(bool, str)  # 成功/失败, 消息
+    no_update = Signal()                 # 后台检查完成，当前已是最新版本
     
     def __init__(self):
         super().__init__()
@@ -23,12 +25,19 @@ class UpdateManager(QObject):
         
         # 动态获取系统类型
         self.system_type = platform.system()
-        self.client = UpdateClient()
+        # 更新引擎在后台线程的事件循环中运行，界面线程不会被网络请求阻塞；信号跨线程排队投递到界面线程
+        self.client = BlockingUpdateClient()
+        # 客户端各阶段（检查、规划、下载、校验、应用、备份、替换、恢复）的进度转发为信号
+        self.client.engine.progress_callback = self.update_progress.emit
+        # 最近一次检查得到的版本信息，确认更新时直接使用，无需再次检查
+        self.pending_update_info = None
+        self.update_future = None
     
     def check_update(self):
         """检查更新"""
         try:
             update_info = self.client.check_for_updates()
+            self.pending_update_info = update_info
             if update_info:
                 version = update_info['latest_version']
                 desc = update_info['versions'][version].get('description', '')
@@ -39,6 +48,78 @@ class UpdateManager(QObject):
             self.update_finished.emit(False, f"检查更新失败: {str(e)}")
             return None
     
+    def check_update_async(self):
+        """在后台检查更新并立即返回，结果通过 update_available 或 no_update 信号通知"""
+        future = self.client.submit(self.client.engine.check())
+        future.add_done_callback(self.on_check_done)
+        return future
+    
+    def on_check_done(self, future):
+        """后台检查完成（在后台线程中调用，只发送信号）"""
+        if future.cancelled():
+            return
+        try:
+            update_info = future.result()
+        except Exception as e:
+            self.update_finished.emit(False, f"检查更新失败: {str(e)}")
+            return
+        self.pending_update_info = update_info
+        if update_info:
+            version = update_info['latest_version']
+            desc = update_info['versions'][version].get('description', '')
+            self.update_available.emit(version, desc)
+        else:
+            self.no_update.emit()
+    
+    def start_update(self, update_info=None):
+        """在后台执行更新并立即返回，进度和结果通过 update_progress、update_finished 信号通知
+
+        不传 update_info 时使用最近一次检查得到的版本信息。
+        """
+        update_info = update_info or self.pending_update_info
+        if not update_info:
+            self.update_finished.emit(False, "没有可用的更新")
+            return None
+        if self.update_running():
+            return self.update_future
+        # Windows系统检查
+        if self.system_type == 'Windows':
+            pid = self.client.check_app_running()
+            if pid:
+                self.update_finished.emit(False, "请先关闭应用后再更新")
+                return None
+        
+        version = update_info['latest_version']
+        self.update_progress.emit("准备更新...", 0)
+        self.update_future = self.client.submit(self.client.engine.update(update_info))
+        self.update_future.add_done_callback(lambda future: self.on_update_done(future, version))
+        return self.update_future
+    
+    def on_update_done(self, future, version):
+        """后台更新结束（在后台线程中调用，只发送信号）"""
+        if future.cancelled():
+            self.update_finished.emit(False, "更新已取消，已下载的部分将在下次更新时继续")
+            return
+        try:
+            success = future.result()
+        except Exception as e:
+            self.update_finished.emit(False, f"更新失败: {str(e)}")
+            return
+        if success:
+            self.pending_update_info = None
+            self.update_finished.emit(True, f"更新到版本 {version} 成功")
+        else:
+            trace_path = self.client.last_trace_path
+            self.update_finished.emit(False, "更新失败" + (f"，追踪记录: {trace_path}" if trace_path else ""))
+    
+    def cancel_update(self):
+        """取消进行中的检查或更新（正在执行的安装步骤会先完成）"""
+        self.client.cancel()
+    
+    def close(self):
+        """取消进行中的操作并停止后台事件循环"""
+        self.client.close()
+    
     def do_update(self, update_info):
         """执行更新"""
         try:
@@ -51,17 +132,55 @@ class UpdateManager(QObject):
             
             # 执行更新
             version = update_info['latest_version']
-            self.update_progress.emit("正在更新...", 0)
+            self.update_progress.emit("准备更新...", 0)
             
             success = self.client.download_update(update_info)
             
             if success:
                 self.update_finished.emit(True, f"更新到版本 {version} 成功")
             else:
-                self.update_finished.emit(False, "更新失败")
+                trace_path = self.client.last_trace_path
+                self.update_finished.emit(False, "更新失败" + (f"，追踪记录: {trace_path}" if trace_path else ""))
             
             return success
             
         except Exception as e:
             self.update_finished.emit(False, f"更新失败: {str(e)}")
-            return False 
\ No newline at end of file
+            return False 
+    
+    def rollback(self):
+        """回滚到最近的备份（不需要连接服务器；完整备份直接改名为当前版本，反向差异备份需先合成），返回是否成功
+
+        在更新引擎的事件循环中执行，后台更新进行中时拒绝。
+        """
+        if self.update_running():
+            self.update_finished.emit(False, "更新进行中，无法回滚")
+            return False
+        return self.client.rollback()
+    
+    def rollback_to(self, version):
+        """切换到本地备份或缓存中持有的指定版本（不需要连接服务器），返回是否成功；后台更新进行中时拒绝"""
+        if self.update_running():
+            self.update_finished.emit(False, "更新进行中，无法切换版本")
+            return False
+        return self.client.rollback_to(version)
+    
+    def update_running(self):
+        """后台更新是否正在进行"""
+        return self.update_future is not None and not self.update_future.done()
+    
+    def local_versions(self):
+        """本地持有的版本号列表（当前版本、备份和缓存），可用于 rollback_to"""
+        return sorted(self.client.local_version_sources())
+    
+    def last_trace_path(self):
+        """最近一次更新尝试的追踪 JSON 路径（各阶段的耗时、字节数和吞吐），没有时返回 None"""
+        return self.client.last_trace_path
+    
+    def export_trace(self, dest_path):
+        """把最近一次更新尝试的追踪复制到指定位置（如供用户提交给技术支持），返回是否成功"""
+        source = self.client.last_trace_path
+        if not source or not os.path.exists(source):
+            return False
+        shutil.copyfile(source, dest_path)
+        return True